@@ -4,7 +4,7 @@ This script creates a lineage forest with no parent relationships.
 The label names are inferred from the label volume data.
 Both the label volumes and the image volumes are loaded from tiff formatted files.
 
-The node inference is done at the "for" loop marked "***"
+The node inference is done at the line marked "***"
 """
 
 
@@ -41,8 +41,8 @@ F.image_volume_loader = img_loader
 F.label_volume_loader = label_loader
 
 # **** Create nodes inferred from label volumes for timestamps 1 and 2
-for timestamp_ordinal in range(1, 3):
-    F.create_nodes_for_labels_in_timestamp(timestamp_ordinal)
+# (the label volumes are scanned in parallel worker processes)
+F.create_nodes_for_labels(range(1, 3))
 
 # Create a viewer for the forest
 viewer = images_gizmos.LineageViewer(F, 400, title="sample nodes only -- only timestamps 1 and 2 have images")
@@ -53,6 +53,8 @@ else:
 
     F.image_volume_loader = img_loader
     F.label_volume_loader = label_loader
+    # keep recent volumes in memory and read neighbouring timestamps in the background.
+    F.use_volume_cache()
 
     test_ordinal = 29
     img = F.load_image_for_timestamp(test_ordinal)
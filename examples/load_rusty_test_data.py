@@ -63,6 +63,8 @@ else:
             image_pattern=image_pattern,
             label_pattern=label_pattern,
         )
+    # keep recent volumes in memory and read neighbouring timestamps in the background.
+    F.use_volume_cache()
     test_ordinal = 29
     img = F.load_image_for_timestamp(test_ordinal)
     assert img is not None, "Could not load image for: " + repr(test_ordinal)
@@ -0,0 +1,6 @@
+"""
+Benchmarks for lineage_viewer loading and computation paths.
+
+Each benchmark module can be run with "python -m lineage_viewer.benchmarks.<module>"
+and reports timings as JSON.
+"""
@@ -0,0 +1,115 @@
+"""
+Compare json.load + make_forest_from_haydens_json_graph with the streaming graph_stream reader
+on synthetic MATLAB graph dumps, for example:
+
+    python -m lineage_viewer.benchmarks.haydens_graph --sizes 10000 100000 1000000 --output timings.json
+"""
+
+import os
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+from .. import lineage_forest
+from .. import graph_stream
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+def synthetic_graph(nnodes, ntimestamps=200, division_probability=0.01, seed=0):
+    """
+    JSON object shaped like examples/Combined.json with about nnodes nodes.
+    Cells persist from one timestamp to the next and occasionally divide.
+    """
+    rng = np.random.default_rng(seed)
+    ncells = max(1, nnodes // ntimestamps)
+    names = []
+    edges = []
+    label_counts = {}
+    def new_name(ts):
+        label = label_counts.get(ts, 0) + 1
+        label_counts[ts] = label
+        name = "%03d_%03d" % (ts, label)
+        names.append(name)
+        return name
+    current = [new_name(1) for i in range(ncells)]
+    ts = 1
+    while len(names) < nnodes:
+        ts += 1
+        following = []
+        for parent in current:
+            nchildren = 2 if rng.random() < division_probability else 1
+            for i in range(nchildren):
+                child = new_name(ts)
+                edges.append((parent, child))
+                following.append(child)
+                if len(names) >= nnodes:
+                    break
+            if len(names) >= nnodes:
+                break
+        # keep the population from growing without bound
+        current = following[:ncells]
+    return {
+        "G_based_on_nn": {
+            "Edges": [{"EndNodes": [parent, child]} for (parent, child) in edges],
+            "Nodes": [{"Name": name} for name in names],
+        }
+    }
+
+def time_call(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return (time.perf_counter() - start, result)
+
+def peak_bytes(function, *args, **kwargs):
+    "Peak Python heap allocation during the call (slow: tracemalloc traces every allocation)."
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def load_with_json(path):
+    with open(path) as f:
+        json_graph = json.load(f)
+    return lineage_forest.make_forest_from_haydens_json_graph(json_graph)
+
+def benchmark_size(nnodes, folder, repeat=1, memory=False):
+    path = os.path.join(folder, "graph_%d.json" % nnodes)
+    with open(path, "w") as f:
+        json.dump(synthetic_graph(nnodes), f)
+    result = dict(nodes=nnodes, file_bytes=os.path.getsize(path))
+    for (name, loader) in [("json_load", load_with_json), ("streaming", graph_stream.make_forest_from_haydens_json_file)]:
+        timings = []
+        for i in range(repeat):
+            (elapsed, forest) = time_call(loader, path)
+            timings.append(elapsed)
+        assert len(forest.id_to_node) == nnodes, repr((name, len(forest.id_to_node), nnodes))
+        result[name + "_seconds"] = min(timings)
+        if memory:
+            result[name + "_peak_bytes"] = peak_bytes(loader, path)
+    result["speedup"] = result["json_load_seconds"] / max(result["streaming_seconds"], 1e-9)
+    os.remove(path)
+    return result
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark MATLAB graph JSON loading.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="node counts")
+    parser.add_argument("--repeat", type=int, default=1, help="report the best of this many runs")
+    parser.add_argument("--memory", action="store_true", help="also report peak memory allocation")
+    parser.add_argument("--output", help="write the timings as JSON to this file")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as folder:
+        results = [benchmark_size(nnodes, folder, args.repeat, args.memory) for nnodes in args.sizes]
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Headless timings for the forest computations and the image pipeline of the viewer,
+using synthetic lineages and volumes with blob shaped cells, for example:
+
+    python -m lineage_viewer.benchmarks.viewer_suite --nodes 10000 100000 --volume-shape 60 200 200 --output suite.json
+
+The viewer gizmos are created but never displayed: slider values are set directly and
+images sent to the browser are only counted, so no browser is needed.
+"""
+
+import json
+import numpy as np
+from .. import lineage_forest
+from .haydens_graph import synthetic_graph, time_call
+
+DEFAULT_NODES = (10000, 100000)
+DEFAULT_TIMESTAMPS = 200
+DEFAULT_DIVISION_RATE = 0.01
+DEFAULT_VOLUME_SHAPE = (60, 200, 200)
+DEFAULT_CELLS = 60
+# rotation used for the image pipeline timings
+ANGLES = (0.3, 0.5, 0.2)
+
+def best_time(repeat, function, *args, **kwargs):
+    "Best elapsed seconds of repeat calls and the result of the last call."
+    timings = []
+    result = None
+    for i in range(repeat):
+        (elapsed, result) = time_call(function, *args, **kwargs)
+        timings.append(elapsed)
+    return (min(timings), result)
+
+def benchmark_forest(nnodes, ntimestamps=DEFAULT_TIMESTAMPS, division_rate=DEFAULT_DIVISION_RATE, repeat=1, regions=10):
+    "Time building and laying out a synthetic forest of about nnodes nodes."
+    json_graph = synthetic_graph(nnodes, ntimestamps, division_rate)
+    result = dict(nodes=nnodes, timestamps=ntimestamps, division_rate=division_rate)
+    (result["make_forest_seconds"], forest) = best_time(
+        repeat, lineage_forest.make_forest_from_haydens_json_graph, json_graph)
+    (result["find_tracks_and_lineages_seconds"], ignored) = best_time(repeat, forest.find_tracks_and_lineages)
+    def layout():
+        # a full layout: assign_offsets only shifts lineages which already have one.
+        for lineage in forest.id_to_lineage.values():
+            lineage.cursor_range = None
+        forest.assign_offsets()
+    (result["assign_offsets_seconds"], ignored) = best_time(repeat, layout)
+    (result["json_ob_seconds"], ignored) = best_time(repeat, forest.json_ob)
+    ordinals = sorted(forest.ordinal_to_timestamp.keys())
+    sample = ordinals[:: max(1, len(ordinals) // regions)][:regions]
+    def all_regions():
+        # uncached layouts, as for the first click on each timestamp
+        forest.ordinal_to_region_layout = {}
+        for ordinal in sample:
+            forest.timestamp_region_json(ordinal)
+    (elapsed, ignored) = best_time(repeat, all_regions)
+    result["timestamp_region_json_seconds"] = elapsed / max(1, len(sample))
+    return result
+
+def synthetic_volumes(shape=DEFAULT_VOLUME_SHAPE, ncells=DEFAULT_CELLS, seed=0):
+    """
+    Label and image volumes with ncells ellipsoidal cells (labels 1..ncells).
+    Image intensity falls off from each cell center, with background noise.
+    """
+    rng = np.random.default_rng(seed)
+    shape = tuple(shape)
+    labels = np.zeros(shape, dtype=np.int32)
+    image = rng.integers(0, 60, shape).astype(np.float32)
+    margin = np.array(shape) * 0.1
+    typical = (np.prod(shape) / max(ncells, 1)) ** (1.0 / 3) * 0.45
+    for label in range(1, ncells + 1):
+        center = rng.uniform(margin, np.array(shape) - margin)
+        radii = typical * rng.uniform(0.6, 1.3, 3)
+        low = np.maximum(np.floor(center - radii), 0).astype(int)
+        high = np.minimum(np.ceil(center + radii) + 1, shape).astype(int)
+        box = tuple(slice(l, h) for (l, h) in zip(low, high))
+        (I, J, K) = np.ogrid[box]
+        distance = (
+            ((I - center[0]) / radii[0]) ** 2 +
+            ((J - center[1]) / radii[1]) ** 2 +
+            ((K - center[2]) / radii[2]) ** 2
+        )
+        inside = distance <= 1
+        labels[box][inside] = label
+        image[box] += np.where(inside, 900 * np.exp(-2 * distance), 0)
+    return (labels, image.astype(np.uint16))
+
+def volume_forest(labels):
+    "Forest with timestamps 1 and 2 sharing the volume labels, each cell continuing to the next timestamp."
+    forest = lineage_forest.Forest()
+    cells = np.unique(labels)
+    cells = cells[cells > 0].tolist()
+    for ordinal in (1, 2):
+        for label in cells:
+            forest.add_node(forest.label_node_name(ordinal, label), ordinal, label)
+    for label in cells:
+        parent = forest.id_to_node[forest.label_node_name(1, label)]
+        parent.set_child(forest.id_to_node[forest.label_node_name(2, label)])
+    forest.find_tracks_and_lineages()
+    forest.assign_offsets()
+    forest.assign_colors_to_tracks()
+    return forest
+
+class StubSlider:
+
+    "Stands in for slider gizmos: just holds the values."
+
+    def __init__(self, value):
+        self.value = self.values = value
+
+class StubSelect:
+
+    def __init__(self, values):
+        self.selected_values = values
+
+def stub_comparison(comparison, shape):
+    "Make a CompareTimeStamps usable without a browser.  Returns the list of (panel, bytes) sent."
+    sent = []
+    comparison.reset_slider_maxes = lambda: None
+    comparison.info_area.text = lambda text: None
+    for (name, value) in zip(("theta", "phi", "gamma"), ANGLES):
+        setattr(comparison, name + "_slider", StubSlider(value))
+    for name in ("theta2", "phi2", "gamma2"):
+        setattr(comparison, name + "_slider", StubSlider(0.0))
+    (I, J, K) = shape
+    comparison.I_slider = StubSlider([0, I])
+    comparison.J_slider = StubSlider([0, J])
+    comparison.K_slider = StubSlider([0, K])
+    comparison.stride_select = StubSelect(["1"])
+    comparison.adaptive = False
+    for display in (comparison.parent_display, comparison.child_display):
+        display.info_area.text = lambda text: None
+        for image in (display.image_display, display.labels_display):
+            def change_content(content, mime_type=None, image=image):
+                sent.append((image, len(content)))
+            image.change_content = change_content
+    return sent
+
+def benchmark_viewer(shape=DEFAULT_VOLUME_SHAPE, ncells=DEFAULT_CELLS, repeat=1, selected=3):
+    "Time the image pipeline of CompareTimeStamps on synthetic volumes."
+    # the viewer gizmos are only needed for this benchmark.
+    from .. import images_gizmos
+    from array_gizmos import operations3d
+    (labels, image) = synthetic_volumes(shape, ncells)
+    forest = volume_forest(labels)
+    forest.label_volume_loader = lambda ordinal: labels
+    forest.image_volume_loader = lambda ordinal: image
+    comparison = images_gizmos.CompareTimeStamps(forest, side=400)
+    sent = stub_comparison(comparison, labels.shape)
+    comparison.set_parent_timestamp(1)
+    comparison.set_child_timestamp(2)
+    comparison.project_and_display()
+    child = comparison.child_display
+    child.select_ids([forest.label_node_name(2, label) for label in range(1, selected + 1)])
+    result = dict(shape=list(labels.shape), cells=ncells, selected=selected)
+    def rotate_labels():
+        # include computing the rotation grid.
+        comparison.rotation_grids.clear()
+        return comparison.rotate_image(labels)
+    (result["rotate_image_seconds"], rotated) = best_time(repeat, rotate_labels)
+    rotated_labels = np.array(rotated)
+    (image2d, rotated_labels) = child.trim_black_borders(comparison.rotate_image(image), rotated_labels)
+    label_to_color = {node.label: node.color_array for node in child.timestamp.label_to_node.values()}
+    selected_labels = list(child.label_to_nodes.keys())
+    (result["mask_imaging_seconds"], ignored) = best_time(
+        repeat, images_gizmos.MaskImaging, rotated_labels, selected_labels, label_to_color)
+    (result["extrude_seconds"], ignored) = best_time(repeat, operations3d.extrude0, rotated_labels)
+    for fused in (True, False):
+        if comparison.fused != fused:
+            comparison.toggle_fused()
+        kind = "fused" if fused else "rotated"
+        def display():
+            # an uncached view: rotate (or project) and display.
+            comparison.rotation_cache.clear()
+            comparison.rotation_grids.clear()
+            comparison.parent_display.base_layer = comparison.child_display.base_layer = None
+            comparison.rotate_volumes()
+            comparison.display_images()
+        (result["display_images_%s_seconds" % kind], ignored) = best_time(repeat, display)
+        # redisplay of the same view (for example after a selection change)
+        (result["redisplay_%s_seconds" % kind], ignored) = best_time(repeat, comparison.display_images)
+    result["images_sent"] = len(sent)
+    result["bytes_sent"] = sum(nbytes for (image, nbytes) in sent)
+    return result
+
+def benchmark_rotation(shape=DEFAULT_VOLUME_SHAPE, ncells=DEFAULT_CELLS, workers=(1,), repeat=1):
+    "Time computing a rotation grid and rotating a label and image volume pair with each worker count."
+    from .. import projection
+    (labels, image) = synthetic_volumes(shape, ncells)
+    results = []
+    for count in workers:
+        result = dict(shape=list(labels.shape), workers=count)
+        (result["grid_seconds"], grid) = best_time(
+            repeat, projection.RotationGrid, labels.shape, *ANGLES, workers=count)
+        (result["rotate_seconds"], ignored) = best_time(repeat, grid.rotate, [labels, image], count)
+        results.append(result)
+    return results
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Headless benchmarks for the lineage viewer.")
+    parser.add_argument("--nodes", type=int, nargs="*", default=list(DEFAULT_NODES), help="forest node counts")
+    parser.add_argument("--timestamps", type=int, default=DEFAULT_TIMESTAMPS, help="timestamps in synthetic forests")
+    parser.add_argument("--division-rate", type=float, default=DEFAULT_DIVISION_RATE, help="cell division probability")
+    parser.add_argument("--volume-shape", type=int, nargs=3, default=list(DEFAULT_VOLUME_SHAPE), help="I J K")
+    parser.add_argument("--cells", type=int, default=DEFAULT_CELLS, help="cells in the synthetic volumes")
+    parser.add_argument("--repeat", type=int, default=1, help="report the best of this many runs")
+    parser.add_argument("--no-viewer", action="store_true", help="skip the image pipeline timings")
+    parser.add_argument("--rotation-workers", type=int, nargs="*", default=[],
+        help="time rotating the synthetic volumes with these thread counts")
+    parser.add_argument("--output", help="write the timings as JSON to this file")
+    args = parser.parse_args(argv)
+    results = dict(
+        forest=[
+            benchmark_forest(nnodes, args.timestamps, args.division_rate, args.repeat)
+            for nnodes in args.nodes
+        ],
+    )
+    if not args.no_viewer:
+        results["viewer"] = benchmark_viewer(args.volume_shape, args.cells, args.repeat)
+    if args.rotation_workers:
+        results["rotation"] = benchmark_rotation(args.volume_shape, args.cells, args.rotation_workers, args.repeat)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+
+"""
+Streaming reader for JSON dumps of MATLAB lineage graphs (like examples/Combined.json).
+
+The file is scanned in chunks and only the node names of the Nodes and Edges arrays are extracted,
+so the whole JSON structure is never built in memory.  Node names like "009_004" are parsed
+in bulk with numpy and the forest is populated directly from the resulting columns.
+A dump holding several graphs (like {"G_raw": ..., "G_corrected": ...}) gives the last graph,
+as make_forest_from_haydens_json_graph does.
+
+write_haydens_json_file writes a forest back in the same format, also in chunks.
+"""
+
+import json
+import re
+import numpy as np
+from . import lineage_forest
+from . import lineage_files
+
+CHUNK_BYTES = 2 ** 22
+GRAPH_NAME = "G_based_on_nn"
+
+section_start = re.compile(r'"(Edges|Nodes)"\s*:\s*\[')
+section_end = re.compile(r'\}\s*\]')
+section_closed = re.compile(r'[\s,]*\]')
+element_patterns = {
+    "Edges": re.compile(r'"EndNodes"\s*:\s*\[\s*"([^"\\]*)"\s*,\s*"([^"\\]*)"\s*\]'),
+    "Nodes": re.compile(r'"Name"\s*:\s*"([^"\\]*)"'),
+}
+
+class GraphScanner:
+
+    "Incremental scanner collecting node names from the Nodes and Edges arrays of a graph dump."
+
+    def __init__(self):
+        self.buffer = ""
+        self.section = None
+        self.start_graph()
+
+    def start_graph(self):
+        "Forget the names collected so far: a later graph replaces them."
+        self.node_names = []
+        self.edge_parents = []
+        self.edge_children = []
+        # sections of the current graph seen so far
+        self.graph_sections = set()
+
+    def scan_file(self, path, chunk_bytes=CHUNK_BYTES):
+        with open(path) as f:
+            while True:
+                chunk = f.read(chunk_bytes)
+                if not chunk:
+                    break
+                self.feed(chunk)
+        self.finish()
+        return self
+
+    def feed(self, text):
+        buffer = self.buffer + text
+        position = 0
+        while True:
+            if self.section is None:
+                match = section_start.search(buffer, position)
+                if match is None:
+                    # keep a tail which might hold the start of a section key
+                    position = max(position, len(buffer) - 64)
+                    break
+                section = self.section = match.group(1)
+                if section in self.graph_sections:
+                    # a second Edges or Nodes array starts the next graph
+                    self.start_graph()
+                self.graph_sections.add(section)
+                position = match.end()
+            else:
+                closed = section_closed.match(buffer, position)
+                if closed is not None:
+                    # empty array, or all elements already scanned
+                    position = closed.end()
+                    self.section = None
+                    continue
+                end = section_end.search(buffer, position)
+                if end is not None:
+                    self.scan_elements(buffer[position: end.start() + 1])
+                    position = end.end()
+                    self.section = None
+                else:
+                    # only scan complete elements; the rest waits for more text
+                    last = buffer.rfind("}", position)
+                    if last >= 0:
+                        self.scan_elements(buffer[position: last + 1])
+                        position = last + 1
+                    break
+        self.buffer = buffer[position:]
+
+    def scan_elements(self, text):
+        section = self.section
+        found = element_patterns[section].findall(text)
+        nelements = text.count("{")
+        if len(found) != nelements:
+            raise ValueError(
+                "unexpected %s element format near %s; use make_forest_from_haydens_json_graph."
+                % (section, repr(text[:100])))
+        if section == "Nodes":
+            self.node_names.extend(found)
+        elif found:
+            (parents, children) = zip(*found)
+            self.edge_parents.extend(parents)
+            self.edge_children.extend(children)
+
+    def finish(self):
+        assert self.section is None, "graph JSON ended inside the %s array." % self.section
+        assert self.node_names or self.edge_parents, "Could not find Nodes or Edges in graph JSON."
+
+def parse_node_names(names):
+    "Parse names like '009_004' into (ordinals, labels) integer arrays in bulk."
+    names = list(names)
+    if not names:
+        empty = np.zeros((0,), dtype=np.int64)
+        return (empty, empty)
+    tokens = "_".join(names).split("_")
+    assert len(tokens) == 2 * len(names), "node names should look like '009_004'."
+    numbers = np.fromiter(map(int, tokens), dtype=np.int64, count=len(tokens)).reshape((len(names), 2))
+    return (numbers[:, 0], numbers[:, 1])
+
+def graph_arrays(scanner, label_assignment=None, add_parents=True, verbose=False):
+    "Build lineage_files.ForestArrays columns from the names collected by a GraphScanner."
+    node_names = np.array(scanner.node_names, dtype=str)
+    edge_parents = np.array(scanner.edge_parents, dtype=str)
+    edge_children = np.array(scanner.edge_children, dtype=str)
+    all_names = np.concatenate([node_names, edge_parents, edge_children])
+    (unique_names, inverse) = np.unique(all_names, return_inverse=True)
+    nnodes = len(node_names)
+    nedges = len(edge_parents)
+    parent_indices = inverse[nnodes: nnodes + nedges]
+    child_indices = inverse[nnodes + nedges:]
+    parents = np.full((len(unique_names),), lineage_files.NO_PARENT, dtype=np.int64)
+    if add_parents and nedges > 0:
+        # the last edge for a child wins, as in make_forest_from_haydens_json_graph
+        (last_children, reversed_positions) = np.unique(child_indices[::-1], return_index=True)
+        last_positions = nedges - 1 - reversed_positions
+        parents[last_children] = parent_indices[last_positions]
+    names = unique_names.tolist()
+    (ordinals, labels) = parse_node_names(names)
+    if label_assignment is not None:
+        labels = np.full((len(names),), lineage_files.NO_LABEL, dtype=np.int64)
+        for (index, name) in enumerate(names):
+            assigned = label_assignment.get(name)
+            if assigned is not None:
+                labels[index] = assigned
+            elif verbose:
+                print("no correction label assigned for node", name)
+    return lineage_files.ForestArrays(names, ordinals, labels, parents)
+
+def make_forest_from_haydens_json_file(
+    path,
+    label_assignment=None,
+    add_parents=True,
+    verbose=False,
+    forest=None,
+    chunk_bytes=CHUNK_BYTES,
+):
+    """
+    Streaming equivalent of make_forest_from_haydens_json_graph(json.load(open(path)), ...).
+    Return the populated forest.
+    """
+    scanner = GraphScanner().scan_file(path, chunk_bytes)
+    arrays = graph_arrays(scanner, label_assignment, add_parents, verbose)
+    if forest is None:
+        forest = lineage_forest.Forest()
+    return arrays.populate(forest)
+
+def graph_text_chunks(arrays, graph_name=GRAPH_NAME, chunk_rows=lineage_files.CHUNK_ROWS):
+    "Text of a graph dump (formatted like examples/Combined.json) for ForestArrays columns, in chunks of rows."
+    node_ids = arrays.node_ids
+    parents = arrays.parents
+    yield '{%s: {"Edges": [' % json.dumps(graph_name)
+    separator = ""
+    children = np.nonzero(parents != lineage_files.NO_PARENT)[0]
+    for chunk in lineage_files.chunked(children, chunk_rows):
+        yield separator + ", ".join(
+            '{"EndNodes": [%s, %s]}' % (json.dumps(node_ids[parents[child]]), json.dumps(node_ids[child]))
+            for child in chunk.tolist())
+        separator = ", "
+    yield '], "Nodes": ['
+    separator = ""
+    for chunk in lineage_files.chunked(node_ids, chunk_rows):
+        yield separator + ", ".join('{"Name": %s}' % json.dumps(node_id) for node_id in chunk)
+        separator = ", "
+    yield "]}}"
+
+def write_haydens_json_file(path, arrays, graph_name=GRAPH_NAME, chunk_rows=lineage_files.CHUNK_ROWS):
+    """
+    Write ForestArrays columns as a graph dump readable by make_forest_from_haydens_json_file.
+    The format only stores node names: readers derive ordinals and labels from names like '009_004',
+    so labels which differ from the name (from a label_assignment) are not stored.
+    """
+    (ordinals, labels) = parse_node_names(arrays.node_ids)
+    differ = int(np.sum((ordinals != arrays.ordinals) | (labels != arrays.labels)))
+    if differ:
+        print("warning: %s nodes have an ordinal or label which differs from their name and is not stored."
+            % differ)
+    with open(path, "w") as f:
+        for text in graph_text_chunks(arrays, graph_name, chunk_rows):
+            f.write(text)
+
+def save_haydens_json_file(forest, path, graph_name=GRAPH_NAME, chunk_rows=lineage_files.CHUNK_ROWS):
+    "Store the nodes and parent relationships of the forest as a graph dump like examples/Combined.json."
+    write_haydens_json_file(path, lineage_files.ForestArrays.from_forest(forest), graph_name, chunk_rows)
@@ -0,0 +1,183 @@
+
+"""
+Display sized, compressed transfer of image arrays to H5Gizmos Image components.
+
+Image.change_array sends a full resolution PNG on every redraw.  Here arrays are first
+reduced to at most the on screen size, encoded as PNG, JPEG or WebP, and not sent at all
+if the panel already shows the same pixels.  Pixel coordinates reported by mouse events
+refer to the sent image and are mapped back to the full resolution array.
+
+Arrays are reduced by blocks rather than by taking every step'th pixel, which aliases and
+drops thin outlines: microscopy images average each block, while colored labels keep the
+largest color of each block, so outlines and small cells survive and no new colors appear.
+"""
+
+import io
+import hashlib
+import numpy as np
+
+DEFAULT_FORMAT = "PNG"
+DEFAULT_QUALITY = 85
+
+MIME_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+def display_step(shape, side):
+    "Smallest reduction step which fits a 2d array of the shape in side by side pixels."
+    largest = max(shape[:2])
+    if side is None or side <= 0 or largest <= side:
+        return 1
+    return -(-int(largest) // int(side))
+
+def blocks(array, step):
+    "View of the array as (rows, step, columns, step, ...) blocks, padded by repeating the last row and column."
+    (height, width) = array.shape[:2]
+    padding = [(0, -height % step), (0, -width % step)] + [(0, 0)] * (array.ndim - 2)
+    if padding[0][1] or padding[1][1]:
+        array = np.pad(array, padding, mode="edge")
+    (height, width) = array.shape[:2]
+    return array.reshape((height // step, step, width // step, step) + array.shape[2:])
+
+def packed_colors(array):
+    "Integer for each pixel which orders colors (or grey values) like their (r, g, b) tuples."
+    array = np.asarray(array)
+    if array.ndim == 2:
+        return array.astype(np.int32)
+    rgb = array[..., :3].astype(np.int32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+def unpack_colors(packed, like):
+    "Inverse of packed_colors for an array shaped like like."
+    if like.ndim == 2:
+        return packed.astype(like.dtype)
+    rgb = np.stack([(packed >> 16) & 255, (packed >> 8) & 255, packed & 255], axis=-1)
+    return rgb.astype(like.dtype)
+
+def reduce_mean(array, step):
+    "Average step by step blocks (for intensity images)."
+    if step == 1:
+        return array
+    mean = blocks(array, step).mean(axis=(1, 3), dtype=np.float32)
+    return np.rint(mean).astype(array.dtype)
+
+def reduce_max(array, step, keep=None):
+    """
+    Largest color in each step by step block (for colored labels: white outlines always win and
+    labels win over black background, and no new colors are mixed).
+    If keep is given only the pixels marked in keep count.
+    Returns (reduced array, mask of the blocks with a counted pixel).
+    """
+    packed = packed_colors(array)
+    if keep is not None:
+        packed = np.where(keep, packed, -1)
+    block_max = blocks(packed, step).max(axis=(1, 3))
+    found = block_max >= 0
+    return (unpack_colors(np.maximum(block_max, 0), array), found)
+
+def reduce_array(array, step, reduction="max", keep=None):
+    """
+    Reduce the 2d grey or rgb array by step along both axes using the reduction ("mean" or "max").
+    Pixels marked in keep (for example outlines drawn over an image) take the "max" reduction
+    wherever a block contains one of them.
+    """
+    if step == 1:
+        return array
+    if reduction == "mean":
+        result = reduce_mean(array, step)
+    else:
+        assert reduction == "max", "unknown reduction: " + repr(reduction)
+        return reduce_max(array, step)[0]
+    if keep is not None and keep.shape == array.shape[:2] and keep.any():
+        (kept, found) = reduce_max(array, step, keep)
+        result = np.where(found.reshape(found.shape + (1,) * (array.ndim - 2)), kept, result)
+    return result
+
+def to_bytes_array(array):
+    "The array as uint8 (values must be in 0..255, as Image.change_array requires)."
+    array = np.asarray(array)
+    if array.dtype == np.uint8:
+        return np.ascontiguousarray(array)
+    if array.size:
+        (m, M) = (array.min(), array.max())
+        assert m >= 0 and M < 256, "Array not in range 0..255 " + repr((m, M))
+    return np.ascontiguousarray(array, dtype=np.uint8)
+
+def encode(array, format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY):
+    "Encode a 2d grey or rgb uint8 array as image file bytes.  Returns (bytes, mime_type)."
+    from PIL import Image
+    format = format.upper()
+    assert format in MIME_TYPES, "unsupported image format: " + repr(format)
+    f = io.BytesIO()
+    image = Image.fromarray(array)
+    if format == "PNG":
+        image.save(f, format=format)
+    else:
+        image.save(f, format=format, quality=quality)
+    return (f.getvalue(), MIME_TYPES[format])
+
+class PanelTransport:
+
+    "Send arrays to an H5Gizmos Image at display size, skipping arrays that are already shown."
+
+    def __init__(self, image, side, format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY, reduction="max"):
+        self.image = image
+        self.side = side
+        self.format = format
+        self.quality = quality
+        # "mean" for intensity images, "max" for colored labels (see reduce_array).
+        self.reduction = reduction
+        # reduction step and full resolution shape of the array last sent.
+        self.step = 1
+        self.shape = None
+        self.digest = None
+        self.bytes_sent = 0
+        self.sent = 0
+        self.skipped = 0
+
+    def configure(self, format=None, quality=None):
+        "Change the encoding (the next array is always sent)."
+        if format is not None:
+            assert format.upper() in MIME_TYPES, "unsupported image format: " + repr(format)
+            self.format = format
+        if quality is not None:
+            self.quality = quality
+        self.digest = None
+
+    def send(self, array, keep=None):
+        """
+        Show the array in the image.  Returns False if it was skipped because it is already shown.
+        keep optionally marks pixels (like outlines) which must stay visible when the array is reduced.
+        """
+        step = display_step(array.shape, self.side)
+        small = to_bytes_array(reduce_array(np.asarray(array), step, self.reduction, keep))
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(repr((small.shape, self.format, self.quality)).encode())
+        hasher.update(small.tobytes())
+        digest = hasher.digest()
+        self.step = step
+        self.shape = array.shape[:2]
+        if digest == self.digest:
+            self.skipped += 1
+            return False
+        (content, mime_type) = encode(small, self.format, self.quality)
+        image = self.image
+        image.change_content(content, mime_type)
+        # pixel events are computed from the size of the sent image.
+        (image.img_height, image.img_width) = small.shape[:2]
+        self.digest = digest
+        self.bytes_sent += len(content)
+        self.sent += 1
+        return True
+
+    def full_resolution(self, row, column):
+        "Map pixel coordinates in the sent image to the center of their block in the full resolution array."
+        step = self.step
+        (row, column) = (row * step + step // 2, column * step + step // 2)
+        if self.shape is not None:
+            (height, width) = self.shape
+            row = min(row, height - 1)
+            column = min(column, width - 1)
+        return (row, column)
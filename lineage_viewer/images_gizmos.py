@@ -9,11 +9,23 @@ from H5Gizmos import (
     DropDownSelect)
 from H5Gizmos.python.file_selector import select_any_file
 from array_gizmos import colorizers, operations3d
-from scipy.ndimage import gaussian_filter
 from . import lineage_gizmo
-from . import lineage_forest
+from . import lineage_files
+from . import label_index
+from . import label_outlines
+from . import volume_cache
+from . import level_of_detail
+from . import projection
+from . import render_scheduler
+from . import image_transport
+from . import instrumentation
+from . import preprocessing
+from . import volume_pyramid
+import asyncio
+import itertools
 import json
 import os
+import threading
 import time
 
 ENHANCE_CONTRAST = True
@@ -29,8 +41,12 @@ YES_SPECKLE = "✓ speckled"
 NO_SPECKLE = "✖ unspeckled"
 YES_RESTRICT = "✓ restricted"
 NO_RESTRICT = "✖ unrestricted"
+YES_ADAPTIVE = "✓ adaptive detail"
+NO_ADAPTIVE = "✖ fixed detail"
 YES_SHADED = "✓ shaded"
 NOT_SHADED = "✖ not shaded"
+YES_FUSED = "✓ fused projection"
+NO_FUSED = "✖ rotated volumes"
 YES_PREFIX = "✓ "
 NO_PREFIX = "✖ "
 
@@ -38,6 +54,15 @@ STD_SPECKLE_RATIO = 0.03
 
 STRIDES = [1, 2, 4, 8]
 
+# bytes of rotated volumes kept for reuse when the view geometry repeats.
+ROTATION_CACHE_BYTES = 2 * 2 ** 30
+# bytes of blurred volumes kept for reloads with the same data.
+PREPROCESS_CACHE_BYTES = 2 ** 30
+# rotation grids (source voxel indices) shared by the volumes rotated the same way
+ROTATION_GRID_BYTES = 2 ** 30
+# grids without precomputed indices (large or axis aligned views) hold no arrays, so limit their number too.
+ROTATION_GRID_ENTRIES = 32
+
 class LineageViewer:
 
     def __init__(self, forest, side, title="Lineage Viewer", colorize="tracks"):
@@ -102,32 +127,41 @@ class LineageViewer:
     def load_click(self, *ignored):
         self.info("load clicked.")
         filename = self.filename_input.value
+        compact = lineage_files.is_compact_filename(filename)
         try:
-            infile = open(filename)
+            infile = open(filename, "rb" if compact else "r")
         except Exception as e:
             self.info("could not open %s: %s" % (repr(filename), e))
             raise
         else:
-            json_ob = json.load(infile)
-            infile.close()
-            new_forest = lineage_forest.Forest()
-            self.forest.use_same_loaders(new_forest)
-            new_forest.load_json(json_ob)
+            new_forest = self.forest.empty_clone()
+            if compact:
+                infile.close()
+                lineage_files.load_forest(filename, new_forest)
+            else:
+                json_ob = json.load(infile)
+                infile.close()
+                new_forest.load_json(json_ob)
             self.recalculate_forest(new_forest)
             self.info("lineage loaded from " + repr(filename))
 
     def save_click(self, *ignored):
         self.info("save clicked.")
         filename = self.filename_input.value
+        compact = lineage_files.is_compact_filename(filename)
         try:
-            outfile = open(filename, 'w')
+            outfile = open(filename, "wb" if compact else "w")
         except Exception as e:
             self.info("could not open %s: %s" % (repr(filename), e))
             raise
         else:
-            json_ob = self.forest.json_ob(exclude_isolated=False)
-            json.dump(json_ob, outfile)
-            outfile.close()
+            if compact:
+                outfile.close()
+                lineage_files.save_forest(self.forest, filename)
+            else:
+                json_ob = self.forest.json_ob(exclude_isolated=False)
+                json.dump(json_ob, outfile)
+                outfile.close()
             self.info("lineage stored to " + repr(filename))
 
     def reparent_click(self, *ignored):
@@ -137,11 +171,16 @@ class LineageViewer:
         parent_node = compare.parent_display.focus_node()
         if child_node is None:
             self.info("cannot reparent: no child selected.")
-        elif parent_node is None:
+            return
+        if parent_node is None:
             self.info("cannot reparent: no parent selected.")
-        else:
-            child_node.parent = parent_node
-            self.recalculate_forest()
+            return
+        problem = self.forest.reparent_problem(child_node, parent_node)
+        if problem is not None:
+            self.info("cannot reparent: " + problem)
+            return
+        changes = self.forest.reparent(child_node, parent_node)
+        self.update_forest(changes)
 
     def disconnect_click(self, *ignored):
         self.info("disconnect clicked.")
@@ -151,8 +190,22 @@ class LineageViewer:
         if current_parent is None:
             self.info("cannot disconnect -- node has no parent.")
         else:
-            child_node.parent = None
-            self.recalculate_forest()
+            changes = self.forest.disconnect(child_node)
+            self.update_forest(changes)
+
+    def update_forest(self, changes):
+        "Show the changes from an incremental lineage edit without reloading the forest or volumes."
+        if changes is None:
+            return self.recalculate_forest()
+        forest = self.forest
+        self.lineage.update_forest(forest, changes)
+        child_ts = self.compare.child_display.timestamp
+        if child_ts is not None:
+            ordinal = child_ts.ordinal
+            self.detail.load_json(forest.timestamp_region_json(ordinal))
+            self.lineage.focus_ts(ordinal)
+        # redisplay with new colors and reset the edit buttons
+        self.update_label_selection()
 
     def recalculate_forest(self, new_forest=None):
         compare = self.compare
@@ -196,12 +249,13 @@ class LineageViewer:
             raise
         else:
             self.detail.load_json(tjson, special_ids)
-            self.compare.clear_images()
-            self.compare.set_child_timestamp(ordinal)
+            parent_ordinal = None
             if ordinal > 0:
-                self.compare.set_parent_timestamp(ordinal - 1)
-            self.compare.rotate_volumes()
-            self.compare.display_images()
+                parent_ordinal = ordinal - 1
+            # the volumes are loaded and rendered off the event loop.
+            self.compare.select_timestamps(ordinal, parent_ordinal)
+            # warm the shared volume cache for the likely next selections.
+            self.forest.prefetch_volumes(ordinal)
 
     def update_label_selection(self, *ignored):
         compare = self.compare
@@ -278,6 +332,25 @@ class CompareTimeStamps:
         self.side = side
         self.title = title
         self.stride = 1
+        self.rotation_cache = volume_cache.ByteLimitedLRU(ROTATION_CACHE_BYTES)
+        self.preprocess_cache = volume_cache.ByteLimitedLRU(PREPROCESS_CACHE_BYTES)
+        self.rotation_grids = volume_cache.ByteLimitedLRU(ROTATION_GRID_BYTES, max_entries=ROTATION_GRID_ENTRIES)
+        # threads rotating volumes (None for projection.WORKERS)
+        self.rotation_workers = None
+        # adaptive level of detail while the view is changing
+        self.adaptive = True
+        self.stride_costs = level_of_detail.StrideCostModel(STRIDES)
+        self.rendered_stride = None
+        self.refine_handle = None
+        # render off the event loop, keeping only the latest request.
+        self.scheduler = render_scheduler.RenderScheduler()
+        self.request_lock = threading.Lock()
+        self.requested = None
+        # set when timestamps were loaded by a render whose result was not shown yet
+        # (results of superseded renders are dropped, but the sliders must still be reset).
+        self.timestamps_loaded = False
+        # project without materializing rotated volumes (except when shaded)
+        self.fused = True
         # gizmo scaffolding
         self.title_area = Text(self.title)
         self.title_area.resize(width=side * 2)
@@ -291,6 +364,8 @@ class CompareTimeStamps:
         self.speckle_link = ClickableText(NO_SPECKLE, on_click=self.toggle_speckle)
         self.restrict_link = ClickableText(NO_RESTRICT, on_click=self.toggle_restrict)
         self.shaded_link = ClickableText(NOT_SHADED, on_click=self.toggle_shaded)
+        self.adaptive_link = ClickableText(YES_ADAPTIVE, on_click=self.toggle_adaptive)
+        self.fused_link = ClickableText(YES_FUSED, on_click=self.toggle_fused)
         self.configurable_link = ClickableText(NO_PREFIX + "(none)", on_click=self.toggle_configurable)
         self.configurable_link.css({"display": "none"})
         stride_pairs = [(str(s), str(s)) for s in STRIDES]
@@ -306,6 +381,8 @@ class CompareTimeStamps:
         self.do_callback = False
         info_bar = [
             self.stride_select,
+            self.adaptive_link,
+            self.fused_link,
             self.enhanced_link, 
             self.shaded_link,
             self.blur_link, 
@@ -338,6 +415,15 @@ class CompareTimeStamps:
         self.mousedown_phi_gamma = None
         self.child_display.rotation_callback = self.rotation_callback
         self.parent_display.rotation_callback = self.rotation_callback
+        self.child_display.fused = self.fused
+        self.parent_display.fused = self.fused
+        self.child_display.scheduler = self.scheduler
+        self.parent_display.scheduler = self.scheduler
+        self.scheduler.on_error = self.info
+
+    def info(self, text):
+        # may be called from the render thread.
+        self.scheduler.call_in_loop(self.info_area.text, text)
 
     def toggle_shaded(self, *ignored):
         e = self.shaded = not self.shaded
@@ -349,6 +435,24 @@ class CompareTimeStamps:
             self.shaded_link.text(NOT_SHADED)
         self.reload_volumes_and_images()    
 
+    def toggle_adaptive(self, *ignored):
+        e = self.adaptive = not self.adaptive
+        if e:
+            self.adaptive_link.text(YES_ADAPTIVE)
+        else:
+            self.adaptive_link.text(NO_ADAPTIVE)
+            self.refine()
+
+    def toggle_fused(self, *ignored):
+        e = self.fused = not self.fused
+        self.child_display.fused = e
+        self.parent_display.fused = e
+        if e:
+            self.fused_link.text(YES_FUSED)
+        else:
+            self.fused_link.text(NO_FUSED)
+        self.reload_volumes_and_images()
+
     def rotation_callback(self, do_rotation, deltai, deltaj):
         if do_rotation:
             self.mousedown_phi_gamma = (self.phi, self.gamma)
@@ -549,10 +653,97 @@ class CompareTimeStamps:
         self.reload_volumes_and_images()
 
     def reload_volumes_and_images(self):
-        self.child_display.reload_cached_volumes()
-        self.parent_display.reload_cached_volumes()
-        self.rotate_volumes()
-        self.display_images()
+        self.request_render(reload=True)
+
+    def request_render(self, rotate=False, stride=None, reload=False, timestamps=None):
+        """
+        Render in the render thread.  The request is merged with any request which has not started yet:
+        timestamps (child and parent ordinals) to load, reload the cached volumes, rotate at the stride.
+        """
+        with self.request_lock:
+            request = self.requested
+            if request is None:
+                request = self.requested = dict(
+                    timestamps=None, reload=False, rotate=False, stride=None, view=None, selections=None)
+            if timestamps is not None:
+                request["timestamps"] = timestamps
+            if reload:
+                request["reload"] = True
+            if rotate or reload or timestamps is not None:
+                request["rotate"] = True
+            if rotate:
+                request["stride"] = stride
+            # the latest view and selections, read here on the event loop.
+            request["view"] = self.current_view()
+            request["selections"] = self.current_selections()
+        self.scheduler.submit(self.render_requested, self.show_rendered)
+
+    def render_requested(self):
+        "Carry out the merged request (in the render thread); returns what show_rendered needs."
+        with self.request_lock:
+            request = self.requested
+            self.requested = None
+        if request is None:
+            # handled by an earlier render.
+            return None
+        request["interaction"] = instrumentation.begin_interaction(self.request_kind(request))
+        selections = request["selections"]
+        if request["timestamps"] is not None:
+            # loading a timestamp clears its selection.
+            selections = ((), ())
+            (child_ordinal, parent_ordinal) = request["timestamps"]
+            with instrumentation.stage("load child"):
+                self.load_timestamp(self.child_display, child_ordinal, "child")
+            with instrumentation.stage("load parent"):
+                self.load_timestamp(self.parent_display, parent_ordinal, "parent")
+            with self.request_lock:
+                self.timestamps_loaded = True
+        elif request["reload"]:
+            with instrumentation.stage("reload volumes"):
+                self.child_display.reload_cached_volumes()
+                self.parent_display.reload_cached_volumes()
+        if request["rotate"]:
+            with instrumentation.stage("rotate volumes"):
+                self.rotate_volumes(request["stride"], request["view"])
+        with instrumentation.stage("render images"):
+            rendered = self.render_images(selections)
+        return (request, rendered)
+
+    def request_kind(self, request):
+        "Interaction name for instrumentation."
+        if request["timestamps"] is not None:
+            return "select timestamps"
+        if request["reload"]:
+            return "reload"
+        if request["rotate"]:
+            return "rotate"
+        return "redisplay"
+
+    def show_rendered(self, rendered):
+        "Show the result of render_requested (on the event loop)."
+        if rendered is None:
+            return
+        (request, (parent_images, child_images)) = rendered
+        with self.request_lock:
+            loaded = self.timestamps_loaded
+            self.timestamps_loaded = False
+        if loaded:
+            self.reset_slider_maxes()
+        with instrumentation.stage("show images"):
+            self.parent_display.show_images(parent_images)
+            self.child_display.show_images(child_images)
+        self.schedule_refine()
+        if instrumentation.enabled():
+            # rolling summary of the latest interaction.
+            self.info(instrumentation.summary_text())
+        # later stages (like forest edits) are not part of this render.
+        instrumentation.end_interaction(request.get("interaction"))
+
+    def select_timestamps(self, child_ordinal, parent_ordinal=None):
+        "Load and display the timestamps (no parent if parent_ordinal is None)."
+        self.parent_display.clear_images()
+        self.child_display.clear_images()
+        self.request_render(timestamps=(child_ordinal, parent_ordinal))
 
     def reset_slider_maxes(self):
         Mc = self.child_display.shape()
@@ -579,19 +770,24 @@ class CompareTimeStamps:
         self.gizmo.css({"background-color": "#ddd"})
 
     def set_parent_timestamp(self, ordinal):
-        ts = self.forest.ordinal_to_timestamp.get(ordinal)
-        if ts is None:
-            self.info_area.text("No such parent timestamp ordinal: " + repr(ordinal))
-        self.parent_display.reset(ts, self.forest, self)
+        ts = self.load_timestamp(self.parent_display, ordinal, "parent")
         self.reset_slider_maxes()
         return ts
 
     def set_child_timestamp(self, ordinal):
+        ts = self.load_timestamp(self.child_display, ordinal, "child")
+        self.reset_slider_maxes()
+        return ts
+
+    def load_timestamp(self, display, ordinal, kind):
+        "Load the volumes for the timestamp into the display (or clear it if ordinal is None)."
+        if ordinal is None:
+            display.reset()
+            return None
         ts = self.forest.ordinal_to_timestamp.get(ordinal)
         if ts is None:
-            self.info_area.text("No such child timestamp ordinal: " + repr(ordinal))
-        self.child_display.reset(ts, self.forest, self)
-        self.reset_slider_maxes()
+            self.info("No such %s timestamp ordinal: %s" % (kind, repr(ordinal)))
+        display.reset(ts, self.forest, self)
         return ts
 
     def project_and_display(self, *ignored):
@@ -609,8 +805,63 @@ class CompareTimeStamps:
             self.K_slider.values,
         ]
         self.slicing = np.array(s, dtype=np.int)
-        self.rotate_volumes()
-        self.display_images()
+        stride = self.stride
+        if self.adaptive and self.event_loop() is not None:
+            # render coarsely while the view is changing and refine when input is idle.
+            stride = self.interactive_stride()
+        self.request_render(rotate=True, stride=stride)
+
+    def event_loop(self):
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def rotation_voxels(self, stride):
+        "Number of voxels rotate_volumes rotates at the stride."
+        total = 0
+        for display in (self.parent_display, self.child_display):
+            for volume in (display.label_volume, display.image_volume):
+                if volume is not None:
+                    if self.slicing is not None:
+                        volume = operations3d.slice3(volume, self.slicing)
+                    total += level_of_detail.strided_voxels(volume.shape[:3], stride)
+        return total
+
+    def interactive_stride(self, budget=level_of_detail.FRAME_BUDGET_SECONDS):
+        "Stride to use while the view is changing."
+        if self.displays_cached(self.stride):
+            return self.stride
+        return self.stride_costs.choose_stride(self.rotation_voxels, budget, self.stride)
+
+    def displays_cached(self, stride):
+        return (
+            self.parent_display.rotation_is_cached(self, True, stride) and
+            self.child_display.rotation_is_cached(self, False, stride)
+        )
+
+    def schedule_refine(self, delay=level_of_detail.REFINE_DELAY_SECONDS):
+        "Render at full detail after delay seconds unless the view changes again first."
+        handle = self.refine_handle
+        if handle is not None:
+            handle.cancel()
+            self.refine_handle = None
+        if self.rendered_stride == self.stride:
+            return
+        loop = self.event_loop()
+        if loop is None:
+            return self.refine()
+        self.refine_handle = loop.call_later(delay, self.refine)
+
+    def refine(self):
+        self.refine_handle = None
+        if self.rendered_stride is not None and self.rendered_stride != self.stride:
+            self.request_render(rotate=True)
+
+    def set_image_transport(self, format=None, quality=None):
+        "Encoding for the microscopy image panels: 'PNG', 'JPEG' or 'WEBP' and the lossy quality."
+        for display in (self.parent_display, self.child_display):
+            display.image_transport.configure(format, quality)
 
     def image_callback(self, name, callback):
         self.configurable_name = name
@@ -621,19 +872,31 @@ class CompareTimeStamps:
         #self.parent_display.image_callback(callback)
         #self.display_images()
 
-    def rotate_volumes(self, stride=None):
+    def rotate_volumes(self, stride=None, view=None):
+        "Rotate both displays for the view (default the current view) at the stride (default the selected stride)."
+        view = self.view_settings(view)
         if stride is None:
-            stride = self.stride
-        self.parent_display.rotate_volumes(self, parent=True, stride=stride)
-        self.child_display.rotate_volumes(self, parent=False, stride=stride)
+            stride = view.stride
+        self.parent_display.rotate_volumes(self, parent=True, stride=stride, view=view)
+        self.child_display.rotate_volumes(self, parent=False, stride=stride, view=view)
+        self.rendered_stride = stride
 
     def display_images(self):
-        self.parent_display.create_mask()
-        self.child_display.create_mask()
+        self.request_render()
+
+    def render_images(self, selections=None):
+        """
+        Arrays to show in the parent and child displays (safe to call in the render thread).
+        selections are the (parent, child) selected labels from current_selections.
+        """
+        if selections is None:
+            selections = self.current_selections()
+        (parent_labels, child_labels) = selections
+        self.parent_display.create_mask(parent_labels)
+        self.child_display.create_mask(child_labels)
         self.parent_display.load_mask(self.child_display)
         self.child_display.load_mask(self.parent_display)
-        self.parent_display.display_images()
-        self.child_display.display_images()
+        return (self.parent_display.render_images(), self.child_display.render_images())
 
     def clear_images(self):
         self.parent_display.clear_images()
@@ -641,49 +904,176 @@ class CompareTimeStamps:
         self.parent_display.reset()
         self.child_display.reset()
 
-    def rotate_image(self, img, parent=False, stride=1, timing=False):
-        sl = self.slicing
+    def current_selections(self):
+        "The (parent, child) selected labels (read on the event loop: clicks change the selections)."
+        return (self.parent_display.selected_labels(), self.child_display.selected_labels())
+
+    def current_view(self):
+        "ViewSettings for the current angles, slicing and stride (read on the event loop)."
+        return ViewSettings(
+            (self.theta, self.phi, self.gamma), (self.theta2, self.phi2, self.gamma2), self.slicing, self.stride)
+
+    def view_settings(self, view=None):
+        if view is None:
+            return self.current_view()
+        return view
+
+    def rotation_angles(self, parent=False, view=None):
+        "(theta, phi, gamma) for the parent or child display in the view (default the current view)."
+        return self.view_settings(view).rotation_angles(parent)
+
+    def rotation_key(self, parent=False, stride=1, view=None):
+        "Geometry part of the rotation cache key: angles, stride and I/J/K slicing."
+        view = self.view_settings(view)
+        return (view.rotation_angles(parent), stride, view.slicing_key())
+
+    def view_volume(self, img, stride=1, level=1, view=None):
+        """
+        The volume restricted to the I/J/K slicing of the view and subsampled at the stride.
+        img may be a pyramid level downsampled by level (which divides the stride).
+        """
+        sl = self.view_settings(view).slicing
         simg = img
         if sl is not None:
+            if level > 1:
+                sl = volume_pyramid.level_slicing(sl, level)
             simg = operations3d.slice3(img, sl)
-        if stride > 1:
-            simg = simg[::stride, ::stride, ::stride]
-        buffer = operations3d.rotation_buffer(simg)
-        def adjust_range(theta):
-            if theta > np.pi:
-                return theta - 2 * np.pi
-            elif theta < -np.pi:
-                return theta + 2 * np.pi
-            else:
-                return theta
-        if parent:
-            theta = adjust_range(self.theta)
-            phi = adjust_range(self.phi)
-            gamma = adjust_range(self.gamma)
-        else:
-            theta = adjust_range(self.theta + self.theta2)
-            phi = adjust_range(self.phi + self.phi2)
-            gamma = adjust_range(self.gamma + self.gamma2)
-        if timing:
+        step = stride // level
+        if step > 1:
+            simg = simg[::step, ::step, ::step]
+        return simg
+
+    def rotate_image(self, img, parent=False, stride=1, timing=False, level=1, view=None):
+        [rbuffer] = self.rotate_images([img], parent, stride, timing, level, view)
+        return rbuffer
+
+    def rotate_images(self, imgs, parent=False, stride=1, timing=False, level=1, view=None):
+        """
+        Rotate volumes of the same shape for the view, like operations3d.rotate3d of their rotation_buffer,
+        sharing one rotation grid (None entries stay None).  Axis aligned and quarter turn views
+        are returned as transposed and flipped views of the volumes without the zero padding of the
+        rotation buffer (which trim_black_borders would remove).
+        """
+        view = self.view_settings(view)
+        simgs = [None if img is None else self.view_volume(img, stride, level, view) for img in imgs]
+        present = [simg for simg in simgs if simg is not None]
+        if not present:
+            return simgs
+        with instrumentation.stage("rotate") as stage:
+            for (index, simg) in enumerate(present):
+                stage.array("volume%s" % index, simg)
+            grid = self.rotation_grid(present[0].shape, parent, view)
             start_time = time.time()
-        rbuffer = operations3d.rotate3d(buffer, theta, phi, gamma)
+            if grid.plan.axis_aligned:
+                rbuffers = [None if simg is None else grid.plan.axis_view(simg)[0] for simg in simgs]
+            else:
+                rbuffers = grid.rotate(simgs, self.rotation_workers)
         # xxxxx airplane rotation is slower???
         #rbuffer = operations3d.airplane_rotate_array3d(buffer, theta, phi, gamma)
+        end_time = time.time()
+        if not grid.plan.axis_aligned:
+            # learn rotation costs for adaptive level of detail, per voxel (not per channel) as rotation_voxels
+            # predicts them; axis aligned views are not resampled and grid builds are one-time costs.
+            voxels = sum(level_of_detail.strided_voxels(simg.shape[:3], 1) for simg in present)
+            self.stride_costs.record(stride, voxels, end_time - start_time)
         if timing:
-            end_time = time.time()
             print(f"Rotation took {end_time - start_time} seconds")
-        return rbuffer
+        return rbuffers
+
+    def rotation_grid(self, shape, parent=False, view=None):
+        "projection.RotationGrid for volumes of the shape in the view, shared with the other panel if it matches."
+        angles = self.rotation_angles(parent, view)
+        key = (tuple(shape[:3]),) + angles
+        cache = self.rotation_grids
+        found = cache.get(key)
+        if found is not volume_cache.MISSING:
+            return found
+        with instrumentation.stage("rotation grid"):
+            grid = projection.RotationGrid(shape, *angles, workers=self.rotation_workers)
+        return cache.put(key, grid)
+
+    def project_volumes(
+        self, label_volume, image_volume, selected_labels, parent=False, stride=1,
+        mask=False, restricted=False, speckle_ratio=None, level=1, view=None):
+        "Project the volumes for the view using projection.project_volumes, without rotating them."
+        view = self.view_settings(view)
+        slabels = self.view_volume(label_volume, stride, level, view)
+        simage = self.view_volume(image_volume, stride, level, view)
+        (theta, phi, gamma) = self.rotation_angles(parent, view)
+        axis_aligned = projection.RotationPlan(slabels.shape, theta, phi, gamma).axis_aligned
+        start_time = time.time()
+        with instrumentation.stage("project") as stage:
+            stage.array("labels", slabels)
+            stage.array("image", simage)
+            result = projection.project_volumes(
+                slabels, simage, theta, phi, gamma, selected_labels, mask, restricted, speckle_ratio)
+            stage.note("nbytes", result.nbytes)
+        end_time = time.time()
+        if not axis_aligned:
+            # as in rotate_images: voxels, not channels, and no axis aligned views.
+            voxels = sum(level_of_detail.strided_voxels(volume.shape[:3], 1) for volume in (slabels, simage))
+            self.stride_costs.record(stride, voxels, end_time - start_time)
+        return result
+
+def adjust_range(theta):
+    if theta > np.pi:
+        return theta - 2 * np.pi
+    elif theta < -np.pi:
+        return theta + 2 * np.pi
+    else:
+        return theta
+
+class ViewSettings:
+
+    """
+    The rotation angles, I/J/K slicing and selected stride of a render, copied on the event loop
+    so the render thread never reads slider state which may change while it runs.
+    """
+
+    def __init__(self, angles=(0, 0, 0), angles2=(0, 0, 0), slicing=None, stride=1):
+        self.angles = tuple(angles)
+        self.angles2 = tuple(angles2)
+        if slicing is not None:
+            slicing = np.array(slicing, dtype=int)
+            slicing.flags.writeable = False
+        self.slicing = slicing
+        self.stride = stride
+
+    def rotation_angles(self, parent=False):
+        "(theta, phi, gamma) for the parent or child display (the child adds the primed offsets)."
+        (theta, phi, gamma) = self.angles
+        if not parent:
+            (theta2, phi2, gamma2) = self.angles2
+            (theta, phi, gamma) = (theta + theta2, phi + phi2, gamma + gamma2)
+        return (adjust_range(theta), adjust_range(phi), adjust_range(gamma))
+
+    def slicing_key(self):
+        sl = self.slicing
+        if sl is None:
+            return None
+        return tuple(map(int, np.ravel(sl)))
+
+# distinguishes volumes loaded without a forest in rotation cache keys.
+volume_serial_numbers = itertools.count()
 
 class CachedVolumeData:
 
-    def __init__(self, ordinal, label_volume, image_volume):
+    def __init__(self, ordinal, label_volume, image_volume, forest=None):
         self.ordinal = ordinal
         self.label_volume = label_volume
         self.image_volume = image_volume
+        # identifies the volumes in cache keys: reloading the timestamp from the same loaders gives the same data.
+        if forest is not None:
+            self.volume_key = ("ordinal", forest.volume_generation, ordinal)
+        else:
+            self.volume_key = ("serial", next(volume_serial_numbers))
+        # positive_slicing of the label volume, when it was scanned
+        self.positive_slicing = None
 
 class MaskImaging:
 
-    def __init__(self, label_array, selected_labels, label_to_color, shaded=False):
+    @instrumentation.timed("MaskImaging")
+    def __init__(self, label_array, selected_labels, label_to_color, shaded=False, outline=True):
         self.shaded = shaded
         self.rotated_labels = None
         self.label_array = np.array(label_array, dtype=np.int32)
@@ -699,10 +1089,27 @@ class MaskImaging:
             self.label_mapper[label] = label
         self.restricted_label_array = self.label_mapper[self.label_array]
         self.selected_label_mask = (self.restricted_label_array > 0).astype(np.uint8)
+        self.setup_colors()
+        #self.extruded_labels = operations3d.extrude0(self.restricted_label_array)
+        #REC = self.restricted_extruded_colors = self.color_mapper[self.extruded_labels]
+        # bounding boxes of the selected labels from one pass over the volume
+        self.label_boxes = label_index.label_boxes(self.restricted_label_array, selected_labels)
+        self.selected_box = label_index.union_box(list(self.label_boxes.values()))
+        boundaries = None
+        if selected_labels and outline:
+            with instrumentation.stage("label boundaries"):
+                boundaries = label_outlines.label_boundaries(self.label_array, selected_labels, self.selected_box)
+        self.boundaries = boundaries
+        self.colored_boundaries = self.color_mapper[boundaries]
+
+    def setup_colors(self):
+        "Color mappers for labels up to self.maxlabel."
+        label_to_color = self.label_to_color
+        selected_labels = self.selected_labels
         self.color_mapper = np.zeros((self.maxlabel + 1, 3), dtype=np.int32)
         for label in label_to_color.keys():
             self.color_mapper[label] = label_to_color[label]
-        if shaded:
+        if self.shaded:
             # add shaded colors and compute shadow indexing
             original_colors = self.color_mapper
             ncolors = len(original_colors)
@@ -725,22 +1132,19 @@ class MaskImaging:
         self.selected_color_mapper = np.zeros(self.color_mapper.shape, dtype=np.int32)
         for label in selected_labels:
             self.selected_color_mapper[label] = self.color_mapper[label]
-        #self.extruded_labels = operations3d.extrude0(self.restricted_label_array)
-        #REC = self.restricted_extruded_colors = self.color_mapper[self.extruded_labels]
-        boundaries = None
-        if selected_labels:
-            for label in selected_labels:
-                target = (label_array == label).astype(np.ubyte)
-                projected = operations3d.extrude0(target)
-                mask = colorizers.boundary_image(projected, 1)
-                if boundaries is None:
-                    boundaries = mask * label
-                else:
-                    boundaries = np.choose(mask, [boundaries, label])
-        self.boundaries = boundaries
-        self.colored_boundaries = self.color_mapper[boundaries]
 
     def max_value_projection(self, r_image, mask=False, restricted=False):
+        if self.nontrivial() and restricted and self.selected_box is not None:
+            # only the box around the selected labels can be nonzero.
+            ((z0, z1), (y0, y1), (x0, x1)) = self.selected_box
+            rla = self.restricted_label_array[z0:z1, y0:y1, x0:x1]
+            sub_image = r_image[z0:z1, y0:y1, x0:x1]
+            if len(r_image.shape) > 3:
+                rla = rla.reshape(rla.shape + (1,))
+            projected = np.where(rla > 0, sub_image, 0).max(axis=0)
+            result = np.zeros(r_image.shape[1:], dtype=projected.dtype)
+            result[y0:y1, x0:x1] = projected
+            return result
         if self.nontrivial() and restricted:
             rla = self.restricted_label_array
             if len(r_image.shape) > 3:
@@ -772,6 +1176,12 @@ class MaskImaging:
             shadowed = operations3d.shadow3d(label_array, shadow_index_map, axis=2)
             shadowed2 = operations3d.shadow3d(shadowed, shadow_index_map, axis=1)
             label_array = shadowed2
+        elif restricted and self.nontrivial() and self.selected_box is not None:
+            # extrude only the box around the selected labels.
+            ((z0, z1), (y0, y1), (x0, x1)) = self.selected_box
+            result = np.zeros(label_array.shape[1:], dtype=label_array.dtype)
+            result[y0:y1, x0:x1] = operations3d.extrude0(label_array[z0:z1, y0:y1, x0:x1])
+            return result
         return operations3d.extrude0(label_array)
 
     def colored_extrusion(self, speckle_ratio=None): # not used?
@@ -786,6 +1196,77 @@ class MaskImaging:
         mask = (self.boundaries > 0)
         return colorizers.overlay_color(on_image, mask, color, center=True)
 
+class ProjectionImaging(MaskImaging):
+
+    """
+    MaskImaging interface for a projection.Projection of volumes which were never rotated.
+    The image projection was computed with fixed mask and restricted settings.
+    """
+
+    @instrumentation.timed("ProjectionImaging")
+    def __init__(self, projected, selected_labels, label_to_color, mask=False, restricted=False, outline=True):
+        self.shaded = False
+        self.projection = projected
+        self.mask = mask
+        self.restricted = restricted
+        self.selected_labels = selected_labels
+        self.label_to_color = label_to_color
+        self.maxlabel = projected.maxlabel
+        if label_to_color:
+            self.maxlabel = max(self.maxlabel, max(label_to_color.keys()))
+        self.setup_colors()
+        boundaries = None
+        if selected_labels and outline:
+            boundaries = projected.label_bits.boundaries(projected.labels2d.shape)
+        self.boundaries = boundaries
+        self.colored_boundaries = self.color_mapper[boundaries]
+
+    def max_value_projection(self, r_image=None, mask=False, restricted=False):
+        assert (mask, restricted) == (self.mask, self.restricted), "projection computed for other settings."
+        return self.projection.image2d
+
+    def extrusion(self, speckle_ratio=None, restricted=False):
+        projected = self.projection
+        if speckle_ratio is not None:
+            assert projected.speckled_labels2d is not None, "projection computed without speckling."
+            return projected.speckled_labels2d
+        if restricted and self.nontrivial():
+            return projected.restricted_labels2d
+        return projected.labels2d
+
+class Outlines:
+
+    "Outlines of the selected labels in a 2d view, drawn over the base layer images."
+
+    def __init__(self, boundaries, color_mapper):
+        self.boundaries = boundaries
+        self.colored_boundaries = None
+        if boundaries is not None:
+            self.colored_boundaries = color_mapper[boundaries]
+
+    def overlay_boundaries(self, on_image, color=None):
+        if self.boundaries is None:
+            return on_image
+        if color is None:
+            color = self.colored_boundaries
+        mask = (self.boundaries > 0)
+        return colorizers.overlay_color(on_image, mask, color, center=True)
+
+class BaseLayer:
+
+    """
+    The part of a display which does not depend on the selected labels (unless restricted)
+    for one view state: the imaging and the image and colored labels before outlines are drawn.
+    """
+
+    def __init__(self, key, imaging):
+        self.key = key
+        self.imaging = imaging
+        # (image, colored labels, click labels), rendered on first use.
+        self.rendered = None
+        # bounding boxes of all labels in the rotated labels, for outlines.
+        self.label_boxes = None
+
 class ImageAndLabels2d:
 
     """
@@ -800,6 +1281,10 @@ class ImageAndLabels2d:
         self.labels_display = Image(height=side, width=side)
         self.image_display.css({"image-rendering": "pixelated"})
         self.labels_display.css({"image-rendering": "pixelated"})
+        # arrays are sent at display size; labels stay lossless.
+        # image blocks are averaged, except where outlines are drawn; label blocks keep their largest color.
+        self.image_transport = image_transport.PanelTransport(self.image_display, side, reduction="mean")
+        self.labels_transport = image_transport.PanelTransport(self.labels_display, side, reduction="max")
         self.focus_label = None
         self._focus_node = None
         displays = Shelf([
@@ -825,6 +1310,14 @@ class ImageAndLabels2d:
         self.mousedown_ij = None
         self.rotation_callback = None
         self.shaded = False
+        self.fused = False
+        # (comparison, parent, stride) of the view to project in create_mask when fused.
+        self.projection_geometry = None
+        # (comparison, parent, stride) of the rotated or projected view.
+        self.view_geometry = None
+        # pyramid level of the view.
+        self.level = 1
+        self.scheduler = None
         self.reset(timestamp)
 
     def image_callback(self, callback):
@@ -841,6 +1334,11 @@ class ImageAndLabels2d:
         self.img = None  # 2d image before annotation
         self.labels = None  # 2d labels before annotation
         self.labels_imaging = None  # labels imaging encapsulation
+        self.base_layer = None  # BaseLayer for the current view
+        self.pyramid = None  # downsampled volumes for coarse strides
+        self.outlines = None  # Outlines of the selected labels
+        self.outlines_key = None
+        self.compare_outlines = None  # comparison outlines
         self.label_to_nodes = {}  # currently selected nodes indexed by label
         self.compare_labels_imaging = None  # comparison labels imaging encapsulation
         #self.focus_mask = None # labels mask for outlines
@@ -852,6 +1350,8 @@ class ImageAndLabels2d:
         self.volume_shape = None
         self.label_volume = None
         self.image_volume = None
+        # (start, end) I/J/K crop of the loaded volumes as a flat tuple
+        self.crop = None
         # flag set when the projection is derived from real data
         self.valid_projection = False
         if comparison is not None:
@@ -864,13 +1364,15 @@ class ImageAndLabels2d:
                 #print ("using cached volumes for", ordinal)
                 self.load_volumes(cached.label_volume, cached.image_volume)
             else:
-                label_volume = forest.load_labels_for_timestamp(ordinal)
+                with instrumentation.stage("read labels") as stage:
+                    label_volume = stage.array("labels", forest.load_labels_for_timestamp(ordinal))
                 if label_volume is None:
                     msg = "Timestamp %s has no label data" % ordinal
                     #print(msg)
                     self.info(msg)
                 else:
-                    image_volume = forest.load_image_for_timestamp(ordinal)
+                    with instrumentation.stage("read image") as stage:
+                        image_volume = stage.array("image", forest.load_image_for_timestamp(ordinal))
                     if image_volume is None:
                         msg = "Timestamp %s has no image data" % ordinal
                         print(msg)
@@ -917,23 +1419,80 @@ class ImageAndLabels2d:
                 (I, J, K) = min_s
                 label_volume = label_volume[:I, :J, :K]
                 image_volume = image_volume[:I, :J, :K]
-        # need to fix this so slicing is unified across timestamps! xxxxx
-        slicing = operations3d.positive_slicing(label_volume)
-        self.label_volume = operations3d.slice3(label_volume, slicing)
-        self.image_volume = operations3d.slice3(image_volume, slicing)
-        self.cached_volume_data = CachedVolumeData(self.timestamp.ordinal, label_volume, image_volume)
+        cached = self.cached_volume_data
+        if cached is None or cached.label_volume is not label_volume or cached.image_volume is not image_volume:
+            cached = self.cached_volume_data = CachedVolumeData(self.timestamp.ordinal, label_volume, image_volume, self.forest)
+        slicing = None
+        if self.forest is not None:
+            # the bounding box of all timestamps if known (see Forest.unify_slicing), so the I/J/K sliders
+            # agree across timestamps, else the precomputed box of this timestamp.
+            slicing = self.forest.label_slicing_for_timestamp(self.timestamp.ordinal)
+        with instrumentation.stage("crop volumes"):
+            if slicing is None:
+                # scan the volume only once per load.
+                if cached.positive_slicing is None:
+                    cached.positive_slicing = operations3d.positive_slicing(label_volume)
+                slicing = cached.positive_slicing
+            self.label_volume = operations3d.slice3(label_volume, slicing)
+            self.image_volume = operations3d.slice3(image_volume, slicing)
+        self.crop = tuple(map(int, np.ravel(slicing)))
         # masking NOT HERE
         #if self.mask:
         #    self.image_volume = np.where((self.label_volume != 0), self.image_volume, 0)
         # image enhancement
         if self.blur:
-            im = self.unenhanced_image_volume = self.image_volume
-            im = im.astype(np.float)
-            im = gaussian_filter(im, sigma=1)
-            im = colorizers.scaleN(im, to_max=10000)
-            #im = colorizers.enhance_contrast(im,cutoff=0.01)
-            self.image_volume = im
+            with instrumentation.stage("blur") as stage:
+                self.unenhanced_image_volume = self.image_volume
+                self.image_volume = stage.array("blurred", self.blurred_image_volume())
         self.volume_shape = self.label_volume.shape
+        self.pyramid = self.volume_pyramid()
+
+    def volume_pyramid(self):
+        "Pyramid of the (sliced, maybe blurred) volumes, shared with earlier loads and built in the background."
+        comparison = self.comparison
+        if comparison is None:
+            return None
+        key = ("pyramid", self.cached_volume_data.volume_key, self.crop, self.blur)
+        cache = comparison.preprocess_cache
+        found = cache.get(key)
+        if found is not volume_cache.MISSING:
+            return found
+        pyramid = volume_pyramid.VolumePyramid(self.label_volume, self.image_volume, STRIDES)
+        pyramid.build_in_background()
+        return cache.put(key, pyramid)
+
+    def view_level(self, comparison, stride, wait=True, view=None):
+        """
+        Pyramid level for the view at the stride: the level for the selected stride
+        (waiting for it to be built), otherwise the coarsest level built so far.
+        """
+        if self.pyramid is None:
+            return 1
+        selected = comparison.view_settings(view).stride
+        return self.pyramid.level(stride, wait=wait and stride == selected)
+
+    def level_volumes(self, level):
+        "(label volume, image volume) downsampled by level."
+        if level == 1:
+            return (self.label_volume, self.image_volume)
+        return self.pyramid.volumes(level)
+
+    def blurred_image_volume(self):
+        "The blurred (sliced) image volume, reused from the comparison cache if it was blurred before."
+        comparison = self.comparison
+        if comparison is None:
+            return preprocessing.blur_volume(self.image_volume)
+        key = (
+            "blur", self.cached_volume_data.volume_key, self.crop,
+            preprocessing.BLUR_SIGMA, preprocessing.BLUR_MAX)
+        cache = comparison.preprocess_cache
+        found = cache.get(key)
+        if found is not volume_cache.MISSING:
+            return found
+        blurred = preprocessing.blur_volume(self.image_volume)
+        # shared with later loads of the same volume.
+        blurred.flags.writeable = False
+        return cache.put(key, blurred)
 
     def trim_black_borders(self, rimage, rlabels):
         "trim black borders from rimage and trim rlabels to match"
@@ -962,17 +1521,98 @@ class ImageAndLabels2d:
             rlabels = rlabels[minI:maxI+1, minJ:maxJ+1, minK:maxK+1]
         return (rimage, rlabels)
 
-    def rotate_volumes(self, comparison, parent=False, stride=1):
+    def uses_fused_projection(self):
+        # shading needs the rotated label volume.
+        return self.fused and not self.shaded
+
+    def rotate_volumes(self, comparison, parent=False, stride=1, view=None):
+        """
+        Rotate (and trim) the volumes for the view (a ViewSettings, default the current view),
+        reusing a cached result if the geometry was seen before.
+        """
+        view = comparison.view_settings(view)
+        geometry = self.view_geometry = (comparison, parent, stride, view)
+        self.level = self.view_level(comparison, stride, view=view)
+        if self.uses_fused_projection():
+            # the projection depends on the selected labels, so it is computed in create_mask.
+            self.rotated_labels = self.rotated_image = None
+            self.projection_geometry = geometry
+            return
+        self.projection_geometry = None
+        cached = self.cached_volume_data
+        if self.label_volume is None or self.image_volume is None or cached is None:
+            return self.rotate_volumes_uncached(comparison, parent, stride, view)
+        self.valid_projection = False # default
+        key = self.rotation_cache_key(comparison, parent, stride, self.level, view)
+        cache = comparison.rotation_cache
+        found = cache.get(key)
+        if found is not volume_cache.MISSING:
+            (self.rotated_labels, self.rotated_image) = found
+            return
+        self.rotate_volumes_uncached(comparison, parent, stride, view)
+        for array in (self.rotated_labels, self.rotated_image):
+            # shared with later displays of the same geometry.
+            array.flags.writeable = False
+        cache.put(key, (self.rotated_labels, self.rotated_image))
+
+    def rotation_cache_key(self, comparison, parent=False, stride=1, level=1, view=None):
+        # the volumes depend on the timestamp data, its crop, the blur setting and the pyramid level.
+        key = (self.cached_volume_data.volume_key, self.crop, self.blur, level)
+        return key + comparison.rotation_key(parent, stride, view)
+
+    def rotation_is_cached(self, comparison, parent=False, stride=1):
+        if self.label_volume is None or self.image_volume is None or self.cached_volume_data is None:
+            return False
+        # called on the event loop: do not wait for the pyramid.
+        level = self.view_level(comparison, stride, wait=False)
+        if self.uses_fused_projection():
+            selected = self.base_selection(self.selected_labels())
+            key = self.projection_cache_key(comparison, parent, stride, selected, level)
+        else:
+            key = self.rotation_cache_key(comparison, parent, stride, level)
+        return key in comparison.rotation_cache
+
+    def speckle_ratio(self):
+        if self.speckle:
+            return STD_SPECKLE_RATIO
+        return None
+
+    def projection_cache_key(self, comparison, parent, stride, selected_labels, level=1, view=None):
+        # selection order decides which outline is drawn where outlines overlap.
+        settings = (self.mask, self.restrict, self.speckle, tuple(selected_labels))
+        return ("projection",) + self.rotation_cache_key(comparison, parent, stride, level, view) + settings
+
+    def fused_projection(self, selected_labels):
+        "Projection of the volumes for the current view computed without rotating them, or None."
+        if self.label_volume is None or self.image_volume is None or self.cached_volume_data is None:
+            return None
+        (comparison, parent, stride, view) = self.projection_geometry
+        key = self.projection_cache_key(comparison, parent, stride, selected_labels, self.level, view)
+        cache = comparison.rotation_cache
+        found = cache.get(key)
+        if found is not volume_cache.MISSING:
+            return found
+        (label_volume, image_volume) = self.level_volumes(self.level)
+        projected = comparison.project_volumes(
+            label_volume, image_volume, selected_labels, parent, stride,
+            self.mask, self.restrict, self.speckle_ratio(), self.level, view)
+        cache.put(key, projected)
+        return projected
+
+    def rotate_volumes_uncached(self, comparison, parent=False, stride=1, view=None):
         self.valid_projection = False # default
         #image2d = labels2d = None
         rlabels = None
         rimage = None
-        if self.label_volume is not None:
-            rlabels = comparison.rotate_image(self.label_volume, parent=parent, stride=stride)
+        level = self.level
+        (label_volume, image_volume) = self.level_volumes(level)
+        # the labels and the image share one rotation grid.
+        (rlabels, rimage) = comparison.rotate_images(
+            [label_volume, image_volume], parent=parent, stride=stride, level=level, view=view)
+        if label_volume is not None:
             self.rotated_labels = rlabels
             #labels2d = operations3d.extrude0(rlabels)
-        if self.image_volume is not None:
-            rimage = comparison.rotate_image(self.image_volume, parent=parent, stride=stride)
+        if image_volume is not None:
             (rimage, rlabels) = self.trim_black_borders(rimage, rlabels)
             self.rotated_image = rimage
             self.rotated_labels = rlabels
@@ -984,22 +1624,29 @@ class ImageAndLabels2d:
         #self.load_images(image2d, labels2d)
 
     def info(self, text):
+        if self.scheduler is not None:
+            # may be called from the render thread.
+            return self.scheduler.call_in_loop(self.info_area.text, text)
         self.info_area.text(text)
 
     def configure_gizmo(self):
         ld = self.labels_display
-        ld.change_array(dummy_image)
+        self.labels_transport.send(dummy_image)
         self.labels_display.on_pixel(self.pixel_callback)
         id = self.image_display
-        id.change_array(dummy_image)
+        self.image_transport.send(dummy_image)
         id.on_pixel(self.down_callback, type="pointerdown")
         id.on_pixel(self.up_callback, type="pointerup")
         id.on_pixel(self.move_callback, type="pointermove")
         id.on_pixel(self.out_callback, type="pointerout")
         do(id.element.attr("draggable", False))
 
+    def event_pixel(self, event, transport):
+        "Full resolution (row, column) of a pixel event on a panel."
+        return transport.full_resolution(event["pixel_row"], event["pixel_column"])
+
     def down_callback(self, event):
-        ij = (event["pixel_row"], event["pixel_column"])
+        ij = self.event_pixel(event, self.image_transport)
         self.info("down: " + repr(ij))
         self.mousedown_ij = ij
         rc = self.rotation_callback
@@ -1008,7 +1655,7 @@ class ImageAndLabels2d:
             rc(True, 0, 0)
 
     def up_callback(self, event):
-        ij = (event["pixel_row"], event["pixel_column"])
+        ij = self.event_pixel(event, self.image_transport)
         self.info("up: " + repr(ij))
         self.mousedown_ij = None
         rc = self.rotation_callback
@@ -1017,7 +1664,7 @@ class ImageAndLabels2d:
             rc(False, None, None)
 
     def move_callback(self, event):
-        ij = (event["pixel_row"], event["pixel_column"])
+        ij = self.event_pixel(event, self.image_transport)
         mij = self.mousedown_ij
         rc = self.rotation_callback
         self.info("move: " + repr(ij) + " mij " + repr(mij))
@@ -1037,6 +1684,10 @@ class ImageAndLabels2d:
     def selected_ids(self):
         return [node.node_id for node in self.label_to_nodes.values()]
 
+    def selected_labels(self):
+        "Snapshot of the selected labels in selection order (read on the event loop)."
+        return tuple(self.label_to_nodes.keys())
+
     def select_ids(self, ids):
         self.label_to_nodes = {}
         for identity in ids:
@@ -1047,8 +1698,7 @@ class ImageAndLabels2d:
                     self.label_to_nodes[label] = node
 
     def pixel_callback(self, event):
-        row = event["pixel_row"]
-        column = event["pixel_column"]
+        (row, column) = self.event_pixel(event, self.labels_transport)
         labels = self.labels
         if labels is None:
             self.info("No labels to select")
@@ -1115,14 +1765,20 @@ class ImageAndLabels2d:
             self.focus_label = node.label
             self.focus_color = node.color_array
 
-    def create_mask(self):
+    def create_mask(self, labels):
+        """
+        Set up the base layer for the view (reused if only the selection changed)
+        and the outlines of the selected labels (a snapshot from selected_labels).
+        """
         self.labels_imaging = None
+        outlines = self.outlines
+        self.outlines = None
         rotated_labels = self.rotated_labels
-        if rotated_labels is None:
+        fused = self.projection_geometry is not None
+        if rotated_labels is None and not fused:
             self.info("Can't create mask -- no rotated labels.")
             return
-        #nodes = list(self.label_to_nodes.values())
-        labels = list(self.label_to_nodes.keys())
+        labels = list(labels)
         all_nodes = self.timestamp.label_to_node.values()
         label_to_color = {}
         for node in all_nodes:
@@ -1130,7 +1786,74 @@ class ImageAndLabels2d:
             label = node.label
             if color is not None and label is not None:
                 label_to_color[label] = color
-        self.labels_imaging = MaskImaging(rotated_labels, labels, label_to_color, self.shaded)
+        key = self.base_layer_key(label_to_color, labels)
+        layer = self.base_layer
+        if key is None or layer is None or layer.key != key:
+            layer = self.base_layer = None
+            base_labels = self.base_selection(labels)
+            if fused:
+                projected = self.fused_projection(base_labels)
+                if projected is None:
+                    self.info("Can't create mask -- no volumes to project.")
+                    return
+                imaging = ProjectionImaging(
+                    projected, base_labels, label_to_color, self.mask, self.restrict, outline=False)
+            else:
+                imaging = MaskImaging(rotated_labels, base_labels, label_to_color, self.shaded, outline=False)
+            layer = self.base_layer = BaseLayer(key, imaging)
+        self.labels_imaging = layer.imaging
+        outlines_key = (key, tuple(labels))
+        if key is None or outlines is None or outlines_key != self.outlines_key:
+            with instrumentation.stage("outlines"):
+                outlines = Outlines(self.label_boundaries(layer, labels), layer.imaging.color_mapper)
+            self.outlines_key = outlines_key
+        self.outlines = outlines
+
+    def base_selection(self, labels):
+        "Selected labels the base layer depends on: only restricted views depend on the selection."
+        if self.restrict:
+            return list(labels)
+        return []
+
+    def base_layer_key(self, label_to_color, labels):
+        "The view state the base layer depends on, or None if it should not be reused."
+        geometry = self.view_geometry
+        if geometry is None or self.cached_volume_data is None:
+            return None
+        (comparison, parent, stride, view) = geometry
+        colors = tuple(sorted((label, tuple(map(int, color))) for (label, color) in label_to_color.items()))
+        settings = (
+            self.projection_geometry is not None, self.shaded, self.mask, self.restrict, self.speckle,
+            self.enhance, self.configurable_callback, tuple(self.base_selection(labels)), colors)
+        return self.rotation_cache_key(comparison, parent, stride, self.level, view) + settings
+
+    def label_boundaries(self, layer, labels):
+        "Outline label image for the selected labels in the view of the base layer (None if none are selected)."
+        if not labels:
+            return None
+        imaging = layer.imaging
+        if isinstance(imaging, ProjectionImaging):
+            projected = imaging.projection
+            (comparison, parent, stride, view) = self.projection_geometry
+            (label_volume, image_volume) = self.level_volumes(self.level)
+            view_labels = comparison.view_volume(label_volume, stride, self.level, view)
+            if layer.label_boxes is None:
+                # one pass over the labels for all later selections.
+                layer.label_boxes = label_index.label_boxes(view_labels)
+            (theta, phi, gamma) = comparison.rotation_angles(parent, view)
+            label_bits = projection.project_outlines(
+                view_labels, theta, phi, gamma, labels, projected.crop, projected.maxlabel, layer.label_boxes)
+            return label_bits.boundaries(projected.labels2d.shape)
+        label_array = imaging.label_array
+        if layer.label_boxes is None:
+            # one pass over the rotated labels for all later selections.
+            layer.label_boxes = label_index.label_boxes(label_array)
+        boxes = layer.label_boxes
+        box = label_index.union_box([boxes[label] for label in labels if label in boxes])
+        if box is None:
+            # no selected label is visible.
+            return np.zeros(label_array.shape[1:], dtype=np.int32)
+        return label_outlines.label_boundaries(label_array, labels, box, imaging.maxlabel)
 
     def create_mask_delete(self):
         "create the focus mask"
@@ -1151,8 +1874,8 @@ class ImageAndLabels2d:
     def clear_images(self):
         #self.load_images(None, None)
         #self.display_images()
-        self.image_display.change_array(dummy_image)
-        self.labels_display.change_array(dummy_image)
+        self.image_transport.send(dummy_image)
+        self.labels_transport.send(dummy_image)
 
     def load_images_delete(self, img, labels):
         "load images *before* added annotations (like outlines)."
@@ -1175,46 +1898,103 @@ class ImageAndLabels2d:
         #self.compare_mask = other.focus_mask
         #self.compare_color = other.focus_color
         self.compare_labels_imaging = other.labels_imaging
+        self.compare_outlines = other.outlines
 
     def display_images(self):
+        self.show_images(self.render_images())
+
+    def render_images(self):
+        """
+        Return the (image, colored labels, labels, outline mask) arrays to display, or None if there is no imaging.
+        The base layer images are rendered once per view state; outlines are drawn over them.
+        The outline mask (None if the image is sent at full size) keeps the outlines when the image is reduced.
+        Does not update the gizmos, so it may run in the render thread.
+        """
         imaging = self.labels_imaging
         if imaging is None:
-            self.clear_images()
-            self.info("No imaging to display for " + repr(self.timestamp))
-            return
-        c_imaging = self.compare_labels_imaging
+            return None
+        layer = self.base_layer
+        if layer.rendered is None:
+            layer.rendered = self.render_base_layer(imaging)
+        (img, colored_labels, click_labels) = layer.rendered
+        outlines = self.outlines
+        c_outlines = self.compare_outlines
+        with instrumentation.stage("overlay outlines"):
+            # add color boundaries to img
+            img = outlines.overlay_boundaries(img)
+            if c_outlines is not None:
+                img = c_outlines.overlay_boundaries(img)
+            # labels with white outlines
+            white = [255,255,255]
+            colored_labels = outlines.overlay_boundaries(colored_labels, white)
+            if c_outlines is not None:
+                colored_labels = c_outlines.overlay_boundaries(colored_labels, white)
+            outline_mask = None
+            if image_transport.display_step(img.shape, self.image_transport.side) > 1:
+                outline_mask = self.outline_mask(layer.rendered[0].shape)
+        return (img, colored_labels, click_labels, outline_mask)
+
+    def outline_mask(self, shape):
+        "Pixels covered by the outlines drawn over an image of the shape (centered like overlay_boundaries)."
+        white = [255, 255, 255]
+        mask = np.zeros(shape[:2], dtype=np.ubyte)
+        for outlines in (self.outlines, self.compare_outlines):
+            if outlines is not None:
+                mask = outlines.overlay_boundaries(mask, white)
+        if mask.ndim == 3:
+            mask = mask[..., 0]
+        return mask > 0
+
+    def render_base_layer(self, imaging):
+        "The (image, colored labels, click labels) arrays of the imaging before outlines are drawn."
         rimage = self.rotated_image
         #if imaging.nontrivial() and self.mask:
         #    rimage = np.where(imaging.selected_label_mask, rimage, 0)
         #image2d = rimage.max(axis=0)  # maximum value projection.
-        image2d = imaging.max_value_projection(rimage, mask=self.mask, restricted=self.restrict)
+        with instrumentation.stage("max value projection") as stage:
+            image2d = imaging.max_value_projection(rimage, mask=self.mask, restricted=self.restrict)
+            stage.array("image2d", image2d)
         if self.configurable_callback:
             #print("LineageViewer.display_images: applying configurable_callback")
-            image2d = self.configurable_callback(image2d)
+            with instrumentation.stage("configurable callback"):
+                image2d = self.configurable_callback(image2d)
         if self.enhance:
-            image2d = colorizers.enhance_contrast(image2d, cutoff=0.05)
+            with instrumentation.stage("enhance contrast"):
+                image2d = preprocessing.enhance_contrast(image2d, cutoff=0.05)
         img = colorizers.scale256(image2d)  # ???? xxxx
-        # add color boundaries to img
-        img = imaging.overlay_boundaries(img)
-        if c_imaging is not None:
-            img = c_imaging.overlay_boundaries(img)
-        # get labels with white outlines
-        speckle_ratio = None
+        speckle_ratio = self.speckle_ratio()
         restricted = self.restrict
-        if self.speckle:
-            speckle_ratio = STD_SPECKLE_RATIO
-        labels = imaging.extrusion(speckle_ratio=speckle_ratio, restricted=restricted)
+        with instrumentation.stage("extrusion"):
+            labels = imaging.extrusion(speckle_ratio=speckle_ratio, restricted=restricted)
+            click_labels = labels
+            if self.speckle:
+                # unspeckled array for mouse clicks
+                click_labels = imaging.extrusion(speckle_ratio=None, restricted=restricted)
+        with instrumentation.stage("color labels"):
+            colored_labels = imaging.color_mapper[labels]
+        for array in (img, colored_labels, click_labels):
+            # shared by later renders of the view.
+            array.flags.writeable = False
+        return (img, colored_labels, click_labels)
+
+    def show_images(self, rendered):
+        "Send arrays from render_images to the gizmos (on the event loop)."
+        if rendered is None:
+            self.clear_images()
+            self.info("No imaging to display for " + repr(self.timestamp))
+            return
+        (img, colored_labels, labels, outline_mask) = rendered
+        # labels for mouse clicks match the image shown.
         self.labels = labels
-        if self.speckle:
-            # unspeckled array for mouse clicks
-            self.labels = imaging.extrusion(speckle_ratio=None, restricted=restricted)
-        colored_labels = imaging.color_mapper[labels]
-        white = [255,255,255]
-        colored_labels = imaging.overlay_boundaries(colored_labels, white)
-        if c_imaging is not None:
-            colored_labels = c_imaging.overlay_boundaries(colored_labels, white)
-        self.image_display.change_array(img)
-        self.labels_display.change_array(colored_labels)
+        for (transport, array, keep, name) in (
+            (self.image_transport, img, outline_mask, "send image"),
+            (self.labels_transport, colored_labels, None, "send labels"),
+        ):
+            with instrumentation.stage(name, "transport") as stage:
+                stage.array("array", array)
+                bytes_sent = transport.bytes_sent
+                transport.send(array, keep)
+                stage.note("bytes_sent", transport.bytes_sent - bytes_sent)
 
     def display_images_delete(self):
         #label = self.focus_label
@@ -0,0 +1,402 @@
+
+"""
+Opt in timing and memory instrumentation for viewer interactions.
+
+When enabled, stages of the viewer pipeline (volume loading, blurring, rotation, mask imaging,
+contrast enhancement, image transfer) and of forest computations record their wall time,
+the sizes of the arrays they handle and optionally the bytes they allocate (using tracemalloc).
+Stages are grouped by interaction (for example one timestamp click) for summaries, and the
+records can be exported as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+Stages run between interactions (for example forest edits) have interaction None.
+
+    from lineage_viewer import instrumentation
+    instrumentation.enable(memory=True)
+    # ... use the viewer ...
+    print(instrumentation.summary_text())
+    instrumentation.export_chrome_trace("trace.json")
+
+When disabled the stages do nothing.
+
+tracemalloc counts the allocations of all threads and has one peak for the whole process.
+While stages run in more than one thread at once (the render thread and the event loop)
+their allocated_bytes include the other threads' allocations and no peak_bytes are recorded.
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+import collections
+
+# records kept for summaries and export (older records are dropped)
+DEFAULT_MAX_RECORDS = 100000
+
+class NullStage:
+
+    "Stage used while instrumentation is disabled."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def array(self, name, array):
+        return array
+
+    def note(self, name, value):
+        pass
+
+NULL_STAGE = NullStage()
+
+class Stage:
+
+    "Context manager recording one stage of an interaction."
+
+    def __init__(self, recorder, name, category):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.arrays = {}
+        self.notes = {}
+        self.parent = None
+        self.depth = 0
+        self.interaction = None
+        self.start = None
+        self.start_bytes = None
+        # largest traced memory seen in nested stages
+        self.child_peak = 0
+        # recorder.overlaps when the stage started (see Recorder.enter_thread)
+        self.overlaps = None
+
+    def array(self, name, array):
+        "Record the shape, dtype and size of an array used by the stage.  Returns the array."
+        if array is not None:
+            self.arrays[name] = dict(
+                shape=list(getattr(array, "shape", ())),
+                dtype=str(getattr(array, "dtype", type(array).__name__)),
+                nbytes=int(getattr(array, "nbytes", 0)),
+            )
+        return array
+
+    def note(self, name, value):
+        "Record another value for the stage (for example the number of bytes sent)."
+        self.notes[name] = value
+
+    def __enter__(self):
+        recorder = self.recorder
+        stack = recorder.thread_stack()
+        if stack:
+            self.parent = stack[-1]
+            self.depth = len(stack)
+        stack.append(self)
+        if recorder.memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                self.overlaps = recorder.enter_thread()
+                (current, peak) = tracemalloc.get_traced_memory()
+                if self.parent is not None:
+                    # keep the peak of the enclosing stage before resetting it.
+                    self.parent.child_peak = max(self.parent.child_peak, peak)
+                if not recorder.concurrent(self.overlaps):
+                    # the peak is process wide: only reset it while no other thread is measuring.
+                    tracemalloc.reset_peak()
+                self.start_bytes = current
+        self.interaction = recorder.interaction
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        recorder = self.recorder
+        stack = recorder.thread_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        record = dict(
+            name=self.name,
+            category=self.category,
+            interaction=self.interaction,
+            thread=threading.get_ident(),
+            depth=self.depth,
+            start=self.start - recorder.origin,
+            seconds=end - self.start,
+        )
+        if self.start_bytes is not None:
+            import tracemalloc
+            concurrent = recorder.exit_thread(self.overlaps)
+            if tracemalloc.is_tracing():
+                (current, peak) = tracemalloc.get_traced_memory()
+                peak = max(peak, self.child_peak)
+                record["allocated_bytes"] = current - self.start_bytes
+                if not concurrent:
+                    record["peak_bytes"] = peak - self.start_bytes
+                if self.parent is not None:
+                    self.parent.child_peak = max(self.parent.child_peak, peak)
+        if self.arrays:
+            record["arrays"] = self.arrays
+        if self.notes:
+            record["notes"] = self.notes
+        recorder.add(record)
+        return False
+
+class Recorder:
+
+    "Collects stage records, grouped by interaction."
+
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS):
+        self.enabled = False
+        self.memory = False
+        self.started_tracing = False
+        self.records = collections.deque(maxlen=max_records)
+        # the current interaction (None between interactions) and the last interaction number
+        self.interaction = None
+        self.interactions = 0
+        self.interaction_names = {}
+        # memory measuring stages active in each thread, and a count of the times
+        # a stage started while another thread had one active.
+        self.thread_stages = collections.Counter()
+        self.overlaps = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def enable(self, memory=False):
+        "Start recording; with memory=True also record allocated bytes (slows the viewer down)."
+        self.enabled = True
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+        self.memory = memory
+
+    def disable(self):
+        self.enabled = False
+        self.memory = False
+        if self.started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.interaction_names = {}
+
+    def thread_stack(self):
+        local = self.local
+        stack = getattr(local, "stack", None)
+        if stack is None:
+            stack = local.stack = []
+        return stack
+
+    def enter_thread(self):
+        "Note a memory measuring stage starting in this thread.  Returns the overlap count to pass to concurrent."
+        with self.lock:
+            stages = self.thread_stages
+            stages[threading.get_ident()] += 1
+            if len(stages) > 1:
+                self.overlaps += 1
+                # the stage itself overlaps.
+                return self.overlaps - 1
+            return self.overlaps
+
+    def concurrent(self, overlaps):
+        "Whether a stage started when the overlap count was overlaps has run alongside another thread's stages."
+        with self.lock:
+            return self.overlaps != overlaps
+
+    def exit_thread(self, overlaps):
+        "Note a stage from enter_thread ending.  Returns whether it ran alongside another thread's stages."
+        with self.lock:
+            stages = self.thread_stages
+            ident = threading.get_ident()
+            stages[ident] -= 1
+            if stages[ident] <= 0:
+                del stages[ident]
+            return self.overlaps != overlaps
+
+    def begin_interaction(self, name):
+        "Attribute the following stages to a new interaction (until end_interaction).  Returns its number."
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.interactions += 1
+            self.interaction = self.interactions
+            self.interaction_names[self.interaction] = name
+            return self.interaction
+
+    def end_interaction(self, interaction=None):
+        "Attribute the following stages to no interaction, if interaction (default any) is still current."
+        with self.lock:
+            if interaction is None or interaction == self.interaction:
+                self.interaction = None
+
+    def stage(self, name, category="viewer"):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, category)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def interaction_records(self, interaction=None):
+        "Records for the interaction (default the latest one with records)."
+        with self.lock:
+            records = list(self.records)
+        if interaction is None:
+            numbers = [record["interaction"] for record in records if record["interaction"] is not None]
+            if not numbers:
+                return []
+            interaction = max(numbers)
+        return [record for record in records if record["interaction"] == interaction]
+
+    def summary(self, interaction=None):
+        """
+        Per stage totals for the interaction (default the latest): a dictionary with the
+        interaction number and name, the total seconds of its outermost stages and
+        a list of stage totals, slowest first.
+        """
+        records = self.interaction_records(interaction)
+        if not records:
+            return None
+        interaction = records[0]["interaction"]
+        name_to_total = {}
+        for record in records:
+            name = record["name"]
+            total = name_to_total.get(name)
+            if total is None:
+                total = name_to_total[name] = dict(
+                    name=name, category=record["category"], calls=0, seconds=0.0, array_bytes=0)
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            for description in record.get("arrays", {}).values():
+                total["array_bytes"] += description["nbytes"]
+            if "peak_bytes" in record:
+                total["peak_bytes"] = max(total.get("peak_bytes", 0), record["peak_bytes"])
+        stages = sorted(name_to_total.values(), key=lambda total: -total["seconds"])
+        return dict(
+            interaction=interaction,
+            name=self.interaction_names.get(interaction),
+            seconds=sum(record["seconds"] for record in records if record["depth"] == 0),
+            stages=stages,
+        )
+
+    def summary_text(self, interaction=None, limit=6):
+        "One line summary of the slowest stages of the interaction."
+        summary = self.summary(interaction)
+        if summary is None:
+            return "No instrumented stages recorded."
+        parts = []
+        for total in summary["stages"][:limit]:
+            part = "%s %.3fs" % (total["name"], total["seconds"])
+            if total["calls"] > 1:
+                part += " (%sx)" % total["calls"]
+            if "peak_bytes" in total:
+                part += " %s" % format_bytes(total["peak_bytes"])
+            parts.append(part)
+        name = summary["name"] or "interaction"
+        return "%s #%s %.3fs: %s" % (name, summary["interaction"], summary["seconds"], ", ".join(parts))
+
+    def chrome_trace(self):
+        "The records as a Chrome trace event object."
+        with self.lock:
+            records = list(self.records)
+            names = dict(self.interaction_names)
+        pid = os.getpid()
+        events = []
+        for record in records:
+            args = dict(interaction=record["interaction"])
+            interaction_name = names.get(record["interaction"])
+            if interaction_name is not None:
+                args["interaction_name"] = interaction_name
+            for key in ("allocated_bytes", "peak_bytes", "arrays", "notes"):
+                if key in record:
+                    args[key] = record[key]
+            events.append(dict(
+                name=record["name"],
+                cat=record["category"],
+                ph="X",
+                ts=record["start"] * 1e6,
+                dur=record["seconds"] * 1e6,
+                pid=pid,
+                tid=record["thread"],
+                args=args,
+            ))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def export_chrome_trace(self, path):
+        "Write the records as a Chrome trace JSON file."
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def export_json(self, path):
+        "Write the records and the summaries of all interactions as JSON."
+        with self.lock:
+            records = list(self.records)
+        interactions = sorted(set(record["interaction"] for record in records if record["interaction"] is not None))
+        ob = dict(
+            records=records,
+            summaries=[self.summary(interaction) for interaction in interactions],
+        )
+        with open(path, "w") as f:
+            json.dump(ob, f, indent=1)
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB"):
+        if abs(nbytes) < 1024:
+            return "%.0f%s" % (nbytes, unit)
+        nbytes /= 1024.0
+    return "%.1fGB" % nbytes
+
+# the recorder used by the viewer.
+recorder = Recorder()
+
+def enable(memory=False):
+    recorder.enable(memory)
+
+def disable():
+    recorder.disable()
+
+def enabled():
+    return recorder.enabled
+
+def clear():
+    recorder.clear()
+
+def begin_interaction(name):
+    return recorder.begin_interaction(name)
+
+def end_interaction(interaction=None):
+    recorder.end_interaction(interaction)
+
+def stage(name, category="viewer"):
+    "Context manager timing a stage of the current interaction (does nothing when disabled)."
+    return recorder.stage(name, category)
+
+def timed(name=None, category="viewer"):
+    "Decorator recording each call of the function as a stage."
+    def decorate(function):
+        stage_name = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not recorder.enabled:
+                return function(*args, **kwargs)
+            with recorder.stage(stage_name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def summary(interaction=None):
+    return recorder.summary(interaction)
+
+def summary_text(interaction=None, limit=6):
+    return recorder.summary_text(interaction, limit)
+
+def export_chrome_trace(path):
+    recorder.export_chrome_trace(path)
+
+def export_json(path):
+    recorder.export_json(path)
@@ -0,0 +1,198 @@
+
+"""
+Per-timestamp label statistics (label set, voxel counts, centroids and bounding boxes) for label volumes.
+
+Counts and centroids are computed plane by plane with numpy.bincount over the label range instead of
+numpy.unique over the whole volume, bounding boxes with one scipy.ndimage.find_objects pass,
+and many timestamps can be scanned in a process pool.
+The results may be kept in a JSON sidecar index so later runs can skip the scan.
+"""
+
+import os
+import json
+import multiprocessing
+import numpy as np
+from scipy import ndimage
+
+INDEX_FILENAME = "label_index.json"
+STATISTICS_KEYS = ("labels", "counts", "centroids", "boxes")
+
+def check_label_volume(volume):
+    assert volume.ndim == 3, "label volumes should be 3 dimensional: " + repr(volume.shape)
+    assert not np.issubdtype(volume.dtype, np.floating), "label volumes should hold integers."
+
+def positive_labels(label_volume):
+    "Sorted array of the positive labels in the volume (a cheaper numpy.unique)."
+    volume = np.asarray(label_volume)
+    check_label_volume(volume)
+    if volume.size == 0:
+        return np.zeros((0,), dtype=np.int64)
+    present = np.zeros((int(volume.max()) + 1,), dtype=bool)
+    for plane in volume:
+        present[np.asarray(plane, dtype=np.int64).ravel()] = True
+    present[0] = False
+    return np.nonzero(present)[0]
+
+def label_boxes(label_array, labels=None):
+    """
+    Dictionary mapping positive labels to bounding boxes as (ndim, 2) [start, end) arrays,
+    for all labels or only the given labels, from one scipy.ndimage.find_objects pass.
+    """
+    array = np.asarray(label_array)
+    max_label = 0
+    if labels is not None:
+        labels = [label for label in labels if label > 0]
+        if not labels:
+            return {}
+        max_label = max(labels)
+    slices = ndimage.find_objects(array, max_label=max_label)
+    if labels is None:
+        labels = range(1, len(slices) + 1)
+    result = {}
+    for label in labels:
+        if label <= len(slices):
+            found = slices[label - 1]
+            if found is not None:
+                result[label] = np.array([[s.start, s.stop] for s in found], dtype=int)
+    return result
+
+def union_box(boxes):
+    "Smallest box containing all the boxes (or None if there are none)."
+    boxes = [np.asarray(box) for box in boxes]
+    if not boxes:
+        return None
+    stacked = np.array(boxes)
+    return np.stack([stacked[:, :, 0].min(axis=0), stacked[:, :, 1].max(axis=0)], axis=1)
+
+def box_slices(box):
+    return tuple(slice(start, end) for (start, end) in box)
+
+def label_statistics(label_volume):
+    """
+    Positive labels in the volume with their voxel counts, (z, y, x) centroids
+    and [start, end) bounding boxes.
+    Returns a dictionary of lists suitable for JSON.
+    """
+    volume = np.asarray(label_volume)
+    check_label_volume(volume)
+    (depth, height, width) = volume.shape
+    nlabels = int(volume.max()) + 1 if volume.size else 1
+    counts = np.zeros((nlabels,), dtype=np.int64)
+    sums = np.zeros((3, nlabels), dtype=np.float64)
+    rows = np.repeat(np.arange(height, dtype=np.float64), width)
+    columns = np.tile(np.arange(width, dtype=np.float64), height)
+    # one plane at a time keeps temporary arrays small for memory mapped volumes.
+    for z in range(depth):
+        plane = np.asarray(volume[z], dtype=np.int64).ravel()
+        plane_counts = np.bincount(plane, minlength=nlabels)
+        counts += plane_counts
+        sums[0] += z * plane_counts
+        sums[1] += np.bincount(plane, weights=rows, minlength=nlabels)
+        sums[2] += np.bincount(plane, weights=columns, minlength=nlabels)
+    labels = np.nonzero(counts)[0]
+    labels = labels[labels > 0]
+    centroids = (sums[:, labels] / counts[labels]).T
+    boxes = label_boxes(volume)
+    return dict(
+        labels=labels.tolist(),
+        counts=counts[labels].tolist(),
+        centroids=centroids.tolist(),
+        boxes=[boxes[label].tolist() for label in labels.tolist()],
+    )
+
+def statistics_boxes(stats):
+    "Dictionary mapping labels to bounding box arrays from label_statistics."
+    return {label: np.array(box, dtype=int) for (label, box) in zip(stats["labels"], stats["boxes"])}
+
+def statistics_positive_slicing(stats):
+    """
+    The slicing operations3d.positive_slicing would compute for the volume,
+    derived from label_statistics without reading the volume (None if there are no labels).
+    """
+    box = union_box(stats["boxes"])
+    if box is None:
+        return None
+    # positive_slicing starts one before the first positive index.
+    box[:, 0] = np.maximum(box[:, 0] - 1, 0)
+    return box
+
+# loader used by scan worker processes (inherited when the pool is forked).
+worker_loader = None
+
+def scan_ordinal(ordinal):
+    volume = worker_loader(ordinal)
+    if volume is None:
+        return (ordinal, None)
+    return (ordinal, label_statistics(volume))
+
+def scan_label_volumes(loader, ordinals, processes=None, verbose=False):
+    """
+    Compute label_statistics for the volumes produced by loader(ordinal) for each ordinal.
+    Returns a dictionary mapping ordinals to statistics (None for missing volumes).
+    Uses a pool of forked processes where available, otherwise scans serially.
+    """
+    global worker_loader
+    ordinals = list(ordinals)
+    result = {}
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(ordinals))
+    use_pool = processes > 1 and "fork" in multiprocessing.get_all_start_methods()
+    worker_loader = loader
+    try:
+        if use_pool:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(processes) as pool:
+                for (ordinal, stats) in pool.imap_unordered(scan_ordinal, ordinals):
+                    result[ordinal] = stats
+                    if verbose:
+                        print("scanned labels for ordinal", ordinal)
+        else:
+            for ordinal in ordinals:
+                (ordinal, stats) = scan_ordinal(ordinal)
+                result[ordinal] = stats
+                if verbose:
+                    print("scanned labels for ordinal", ordinal)
+    finally:
+        worker_loader = None
+    return result
+
+class LabelIndex:
+
+    "Sidecar JSON file recording label_statistics by timestamp ordinal."
+
+    def __init__(self, path):
+        self.path = path
+        self.ordinal_to_stats = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                json_ob = json.load(f)
+            self.ordinal_to_stats = {int(ordinal): stats for (ordinal, stats) in json_ob.items()}
+
+    def __contains__(self, ordinal):
+        return ordinal in self.ordinal_to_stats
+
+    def get(self, ordinal):
+        return self.ordinal_to_stats.get(ordinal)
+
+    def missing_ordinals(self, ordinals):
+        "Ordinals with no recorded statistics (or statistics from an older index lacking some keys)."
+        result = []
+        for ordinal in ordinals:
+            stats = self.ordinal_to_stats.get(ordinal)
+            if stats is None or any(key not in stats for key in STATISTICS_KEYS):
+                result.append(ordinal)
+        return result
+
+    def update(self, ordinal_to_stats):
+        "Record statistics (missing volumes, with None statistics, are not recorded)."
+        for (ordinal, stats) in ordinal_to_stats.items():
+            if stats is not None:
+                self.ordinal_to_stats[ordinal] = stats
+
+    def save(self):
+        json_ob = {str(ordinal): stats for (ordinal, stats) in sorted(self.ordinal_to_stats.items())}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(json_ob, f)
+        os.replace(tmp_path, self.path)
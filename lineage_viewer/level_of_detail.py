@@ -0,0 +1,68 @@
+
+"""
+Adaptive level of detail for interactive rotation.
+
+While the view is changing the displays are rendered at the finest stride predicted
+to fit a frame time budget, using rotation costs measured as the viewer runs.
+Full resolution is restored once the input is idle.
+"""
+
+FRAME_BUDGET_SECONDS = 0.1
+REFINE_DELAY_SECONDS = 0.4
+
+class StrideCostModel:
+
+    "Learned rotation cost (seconds per rotated voxel) for each stride."
+
+    def __init__(self, strides, smoothing=0.3):
+        self.strides = sorted(strides)
+        self.smoothing = smoothing
+        self.stride_to_rate = {}
+
+    def record(self, stride, voxels, seconds):
+        "Update the estimate from one observed rotation of voxels voxels taking seconds."
+        if voxels <= 0:
+            return
+        rate = seconds / voxels
+        old = self.stride_to_rate.get(stride)
+        if old is not None:
+            rate = old + self.smoothing * (rate - old)
+        self.stride_to_rate[stride] = rate
+
+    def rate(self, stride):
+        "Seconds per voxel for the stride, borrowed from the nearest measured stride if needed (or None)."
+        s2r = self.stride_to_rate
+        if stride in s2r:
+            return s2r[stride]
+        if not s2r:
+            return None
+        nearest = min(s2r.keys(), key=lambda s: abs(s - stride))
+        return s2r[nearest]
+
+    def predict(self, stride, voxels):
+        rate = self.rate(stride)
+        if rate is None:
+            return None
+        return rate * voxels
+
+    def choose_stride(self, voxels_for_stride, budget=FRAME_BUDGET_SECONDS, minimum_stride=1):
+        """
+        Finest stride (not finer than minimum_stride) predicted to rotate voxels_for_stride(stride)
+        voxels within budget seconds, or the coarsest stride if none fits.
+        Before any measurements the minimum stride is used.
+        """
+        candidates = [s for s in self.strides if s >= minimum_stride]
+        if not candidates:
+            return minimum_stride
+        for stride in candidates:
+            predicted = self.predict(stride, voxels_for_stride(stride))
+            if predicted is None or predicted <= budget:
+                return stride
+        return candidates[-1]
+
+def strided_voxels(shape, stride):
+    "Number of voxels in volume[::stride, ::stride, ::stride] for a volume of the shape."
+    result = 1
+    for n in shape:
+        result *= -(-int(n) // stride)
+    return result
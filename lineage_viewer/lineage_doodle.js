@@ -222,6 +222,20 @@ class LineageDisplay {
         var event_click = function(event) { that.event_click(event); };
         this.event_rect.on("click", event_click);
     };
+    update_nodes(delta) {
+        // apply changed nodes from an incremental edit and redraw.
+        var json_ob = this.json_ob;
+        var i2n = json_ob.id_to_node;
+        for (var i=0; i<delta.removed_ids.length; i++) {
+            delete i2n[delta.removed_ids[i]];
+        }
+        for (var id in delta.id_to_node) {
+            i2n[id] = delta.id_to_node[id];
+        }
+        json_ob.width = delta.width;
+        json_ob.height = delta.height;
+        this.load_json(json_ob);
+    };
     update_hover(event) {
         var loc = event.model_location;
         var nearest = this.nearest_ts(loc);
@@ -0,0 +1,222 @@
+
+"""
+Compact columnar lineage files.
+
+A ".npz" lineage file holds one row per node in four numpy columns:
+
+- node_id: fixed width unicode node identity,
+- ordinal: int32 timestamp ordinal,
+- label: int32 label (-1 for no label),
+- parent: int32 row index of the parent node (-1 for no parent).
+
+Columns are written and read in chunks of rows so large lineages never need a dictionary per node.
+The files can be read with numpy.load.
+
+Convert between formats using the command line, for example:
+
+    python -m lineage_viewer.lineage_files LineageGraph.json LineageGraph.npz --haydens
+    python -m lineage_viewer.lineage_files lineage.npz lineage.json
+    python -m lineage_viewer.lineage_files lineage.npz LineageGraph.json --haydens
+"""
+
+import json
+import zipfile
+import numpy as np
+from . import lineage_forest
+from . import graph_stream
+
+COMPACT_EXTENSION = ".npz"
+CHUNK_ROWS = 2 ** 16
+COLUMNS = ("node_id", "ordinal", "label", "parent")
+INDEX_DTYPE = np.int32
+NO_PARENT = -1
+NO_LABEL = -1
+
+class ForestArrays:
+
+    "Node columns for a forest: ids, ordinals, labels and parent indices."
+
+    def __init__(self, node_ids, ordinals, labels, parents):
+        self.node_ids = list(node_ids)
+        self.ordinals = np.asarray(ordinals, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.size = len(self.node_ids)
+
+    @classmethod
+    def from_forest(cls, forest):
+        "Extract the columns from the Node objects of a forest (using the node parent pointers)."
+        nodes = list(forest.id_to_node.values())
+        node_to_index = {id(node): index for (index, node) in enumerate(nodes)}
+        n = len(nodes)
+        ordinals = np.zeros((n,), dtype=np.int64)
+        labels = np.zeros((n,), dtype=np.int64)
+        parents = np.zeros((n,), dtype=np.int64)
+        for (index, node) in enumerate(nodes):
+            ordinals[index] = node.timestamp_ordinal
+            label = node.label
+            labels[index] = NO_LABEL if label is None else label
+            parent = node.parent
+            parents[index] = NO_PARENT if parent is None else node_to_index[id(parent)]
+        node_ids = [node.node_id for node in nodes]
+        return cls(node_ids, ordinals, labels, parents)
+
+    def label_list(self):
+        "Labels as a list with None for missing labels."
+        return [None if label == NO_LABEL else label for label in self.labels.tolist()]
+
+    def populate(self, forest):
+        "Add the nodes and parent relationships to the (empty) forest and return it."
+        add_node = forest.add_node
+        nodes = [
+            add_node(node_id, ordinal, label)
+            for (node_id, ordinal, label) in zip(self.node_ids, self.ordinals.tolist(), self.label_list())
+        ]
+        for (node, parent) in zip(nodes, self.parents.tolist()):
+            if parent != NO_PARENT:
+                nodes[parent].set_child(node)
+        return forest
+
+def is_compact_filename(filename):
+    return filename.lower().endswith(COMPACT_EXTENSION)
+
+def write_column(archive, name, dtype, length, chunks):
+    "Write a 1d .npy member to the zip archive from an iterable of array chunks."
+    dtype = np.dtype(dtype)
+    header = dict(
+        descr=np.lib.format.dtype_to_descr(dtype),
+        fortran_order=False,
+        shape=(length,),
+    )
+    written = 0
+    with archive.open(name + ".npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array_header_2_0(member, header)
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype=dtype)
+            member.write(chunk.tobytes())
+            written += len(chunk)
+    assert written == length, "column length mismatch: " + repr((name, written, length))
+
+def chunked(sequence, chunk_rows):
+    for start in range(0, len(sequence), chunk_rows):
+        yield sequence[start: start + chunk_rows]
+
+def write_arrays(path, arrays, chunk_rows=CHUNK_ROWS):
+    "Write ForestArrays columns to a compact lineage file."
+    node_ids = [str(node_id) for node_id in arrays.node_ids]
+    n = len(node_ids)
+    width = max([len(node_id) for node_id in node_ids] + [1])
+    id_chunks = (np.array(chunk, dtype="U%d" % width) for chunk in chunked(node_ids, chunk_rows))
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        write_column(archive, "node_id", "U%d" % width, n, id_chunks)
+        write_column(archive, "ordinal", INDEX_DTYPE, n, chunked(arrays.ordinals, chunk_rows))
+        write_column(archive, "label", INDEX_DTYPE, n, chunked(arrays.labels, chunk_rows))
+        write_column(archive, "parent", INDEX_DTYPE, n, chunked(arrays.parents, chunk_rows))
+
+def save_forest(forest, path, chunk_rows=CHUNK_ROWS):
+    "Store the nodes and parent relationships of the forest in a compact lineage file."
+    write_arrays(path, ForestArrays.from_forest(forest), chunk_rows)
+
+def read_column_chunks(member, chunk_rows):
+    "Iterate over chunks of a 1d .npy zip member without reading it all at once."
+    version = np.lib.format.read_magic(member)
+    if version == (1, 0):
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(member)
+    else:
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(member)
+    assert len(shape) == 1, "lineage columns should be 1 dimensional: " + repr(shape)
+    remaining = shape[0]
+    while remaining > 0:
+        rows = min(remaining, chunk_rows)
+        data = member.read(rows * dtype.itemsize)
+        yield np.frombuffer(data, dtype=dtype)
+        remaining -= rows
+
+def iter_chunks(path, chunk_rows=CHUNK_ROWS):
+    "Iterate over dictionaries of aligned column chunks from a compact lineage file."
+    with zipfile.ZipFile(path) as archive:
+        members = [archive.open(name + ".npy") for name in COLUMNS]
+        try:
+            iterators = [read_column_chunks(member, chunk_rows) for member in members]
+            for chunks in zip(*iterators):
+                yield dict(zip(COLUMNS, chunks))
+        finally:
+            for member in members:
+                member.close()
+
+def read_arrays(path, chunk_rows=CHUNK_ROWS):
+    "Read a compact lineage file into ForestArrays columns."
+    node_ids = []
+    ordinals = []
+    labels = []
+    parents = []
+    for chunk in iter_chunks(path, chunk_rows):
+        node_ids.extend(chunk["node_id"].tolist())
+        ordinals.append(chunk["ordinal"])
+        labels.append(chunk["label"])
+        parents.append(chunk["parent"])
+    def join(columns):
+        if columns:
+            return np.concatenate(columns)
+        return np.zeros((0,), dtype=INDEX_DTYPE)
+    return ForestArrays(node_ids, join(ordinals), join(labels), join(parents))
+
+def load_forest(path, forest=None, chunk_rows=CHUNK_ROWS):
+    "Populate forest (or a new Forest) from a compact lineage file."
+    if forest is None:
+        forest = lineage_forest.Forest()
+    arrays = read_arrays(path, chunk_rows)
+    return arrays.populate(forest)
+
+def compute_layout(forest):
+    "Tracks, lineages and offsets are needed to dump forest JSON."
+    forest.find_tracks_and_lineages()
+    forest.assign_offsets()
+    return forest
+
+def compact_to_json(npz_path, json_path):
+    forest = compute_layout(load_forest(npz_path))
+    with open(json_path, "w") as f:
+        json.dump(forest.json_ob(exclude_isolated=False), f)
+
+def json_to_compact(json_path, npz_path):
+    forest = lineage_forest.Forest()
+    with open(json_path) as f:
+        forest.load_json(json.load(f))
+    save_forest(forest, npz_path)
+
+def haydens_json_to_compact(json_path, npz_path, label_assignment=None):
+    "Convert a MATLAB graph JSON dump (like examples/Combined.json) to a compact lineage file."
+    scanner = graph_stream.GraphScanner().scan_file(json_path)
+    arrays = graph_stream.graph_arrays(scanner, label_assignment)
+    write_arrays(npz_path, arrays)
+
+def compact_to_haydens_json(npz_path, json_path):
+    "Convert a compact lineage file to a MATLAB graph JSON dump (like examples/Combined.json)."
+    graph_stream.write_haydens_json_file(json_path, read_arrays(npz_path))
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert lineage files between JSON and compact .npz formats.")
+    parser.add_argument("source", help="input lineage file (.json or .npz)")
+    parser.add_argument("destination", help="output lineage file (.json or .npz)")
+    parser.add_argument("--haydens", action="store_true", help="the JSON source or destination is a MATLAB graph dump")
+    args = parser.parse_args(argv)
+    source = args.source
+    destination = args.destination
+    if args.haydens:
+        if is_compact_filename(source):
+            assert not is_compact_filename(destination), "source and destination are both .npz files."
+            compact_to_haydens_json(source, destination)
+        else:
+            assert is_compact_filename(destination), "MATLAB graphs can only be converted to and from .npz files."
+            haydens_json_to_compact(source, destination)
+    elif is_compact_filename(source):
+        assert not is_compact_filename(destination), "source and destination are both .npz files."
+        compact_to_json(source, destination)
+    else:
+        assert is_compact_filename(destination), "source and destination are both JSON files."
+        json_to_compact(source, destination)
+
+if __name__ == "__main__":
+    main()
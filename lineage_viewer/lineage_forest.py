@@ -6,8 +6,14 @@ OO structure for cell lineage tracking.
 
 from array_gizmos import color_list
 import os
+import bisect
+import itertools
 import numpy as np
 import H5Gizmos as gz
+from . import volume_cache
+from . import volume_store
+from . import label_index
+from . import instrumentation
 
 class Node:
 
@@ -57,26 +63,40 @@ class Node:
         )
 
     def track_ancestor(self):
-        if self._track is not None:
-            return self._track
-        parent = self.parent
-        if parent is None:
-            result = self
-        elif len(parent.id_to_child) > 1:
-            result = self
-        else:
-            result = self.parent.track_ancestor()
-        self._track = result
+        "First node of the track containing this node (found without recursion: tracks may be very long)."
+        path = []
+        seen = set()
+        node = self
+        while node._track is None:
+            parent = node.parent
+            if parent is None or len(parent.id_to_child) > 1:
+                node._track = node
+                break
+            assert node.node_id not in seen, "cycle in parent links at: " + repr(node.node_id)
+            seen.add(node.node_id)
+            path.append(node)
+            node = parent
+        result = node._track
+        for node in path:
+            node._track = result
         return result
 
     def lineage_ancestor(self):
-        if self._lineage_root is not None:
-            return self._lineage_root
-        if self.parent is not None:
-            result = self.parent.track_ancestor().lineage_ancestor()
-        else:
-            result = self
-        self._lineage_root = result
+        "Root of the lineage containing this node, following track ancestors without recursion."
+        path = []
+        seen = set()
+        node = self
+        while node._lineage_root is None:
+            if node.parent is None:
+                node._lineage_root = node
+                break
+            assert node.node_id not in seen, "cycle in parent links at: " + repr(node.node_id)
+            seen.add(node.node_id)
+            path.append(node)
+            node = node.parent.track_ancestor()
+        result = node._lineage_root
+        for node in path:
+            node._lineage_root = result
         return result
 
     def __repr__(self):
@@ -129,33 +149,40 @@ class Node:
         return result'''
 
     def assign_offsets(self, starting_from=0, cursor_ref=None):
+        """
+        Lay out the subtree at this node: leaves take successive cursor positions (the first child
+        subtree is separated from its siblings) and parents are centered over their first and last child.
+        Uses an explicit stack so deep lineages do not exceed the recursion limit.
+        Returns the cursor after the subtree.
+        """
         assert starting_from is not None
         if cursor_ref is None:
             cursor_ref = [starting_from]
-        child_ids = self.children_ids()
-        i2c = self.id_to_child
-        nc = len(child_ids)
-        if nc < 1:
-            #result = starting_from # + 1
-            self._offset = cursor_ref[0]
-            # no increment
-        else:
-            first_id = child_ids[0]
-            first = i2c[first_id]
-            remainder = child_ids[1:]
-            if nc == 1:
-                first.assign_offsets(cursor_ref=cursor_ref)
-                self._offset = first._offset
+        # frames of [node, sorted child ids, number of children visited]
+        stack = [[self, self.children_ids(), 0]]
+        while stack:
+            frame = stack[-1]
+            (node, child_ids, visited) = frame
+            nc = len(child_ids)
+            if nc < 1:
+                node._offset = cursor_ref[0]
+                # no increment
+                stack.pop()
+            elif visited < nc:
+                if visited == 1:
+                    cursor_ref[0] += 1
+                frame[2] = visited + 1
+                child = node.id_to_child[child_ids[visited]]
+                stack.append([child, child.children_ids(), 0])
             else:
-                assert nc > 1
-                first.assign_offsets(cursor_ref=cursor_ref)
-                cursor_ref[0] += 1
-                #self._offset = cursor_ref[0]
-                #cursor_ref[0] += 1
-                for r_id in remainder:
-                    r = i2c[r_id]
-                    result = r.assign_offsets(cursor_ref=cursor_ref)
-                self._offset = 0.5 * (first._offset + r._offset)
+                i2c = node.id_to_child
+                first = i2c[child_ids[0]]
+                if nc == 1:
+                    node._offset = first._offset
+                else:
+                    last = i2c[child_ids[-1]]
+                    node._offset = 0.5 * (first._offset + last._offset)
+                stack.pop()
         return cursor_ref[0]
 
 class NodeGroup:
@@ -237,6 +264,8 @@ class Lineage(NodeGroup):
     def __init__(self, root):
         self.root = root
         self.index = None
+        # (first, next free) layout cursor positions assigned to this group
+        self.cursor_range = None
 
     def check_node(self, node):
         node_root = node.lineage_ancestor()
@@ -255,6 +284,9 @@ class Track(Lineage):
         node_root = node.track_ancestor()
         assert node_root is self.root, "wrong track: " + repr([node, node_root, self.root])
 
+# distinguishes volume sources in derived volume cache keys (see Forest.volumes_changed).
+volume_generations = itertools.count()
+
 class Forest:
 
     "A collection of lineages"
@@ -262,12 +294,30 @@ class Forest:
     def __init__(self):
         self.id_to_node = {}
         self.ordinal_to_timestamp = {}
+        # sorted timestamp ordinals, maintained as timestamps are added
+        self.sorted_ordinals = []
         self.label_volume_loader = None
         self.image_volume_loader = None
+        self.volume_cache = None
+        self.volume_store = None
+        # file name patterns of load_klb_using_file_patterns
+        self.image_pattern = None
+        self.label_pattern = None
+        self.volume_generation = next(volume_generations)
+        self.label_index = None
+        # positive label bounding box of all timestamps (see unify_slicing)
+        self.unified_slicing = None
+        self.unified_ordinals = None
+        # number of timestamps when some box was found to be unknown (see experiment_slicing)
+        self.unknown_slicing_count = None
         self.reset()
 
+    def empty_clone(self):
+        "New empty forest of the same type using the same volume loaders."
+        return self.use_same_loaders(self.__class__())
+
     def clean_clone(self):
-        result = Forest()
+        result = self.__class__()
         node_map = {}
         for node in self.id_to_node.values():
             node_id = node.node_id
@@ -279,13 +329,18 @@ class Forest:
                 new_node = node_map[node.node_id]
                 new_parent = node_map[pid]
                 new_parent.set_child(new_node)
-        result.label_volume_loader = self.label_volume_loader
-        result.image_volume_loader = self.image_volume_loader
-        return result
+        return self.use_same_loaders(result)
 
     def use_same_loaders(self, result):
         result.label_volume_loader = self.label_volume_loader
         result.image_volume_loader = self.image_volume_loader
+        result.volume_cache = self.volume_cache
+        result.volume_store = self.volume_store
+        result.volume_generation = self.volume_generation
+        result.label_index = self.label_index
+        result.unified_slicing = self.unified_slicing
+        result.unified_ordinals = self.unified_ordinals
+        result.unknown_slicing_count = self.unknown_slicing_count
         return result
 
     def reset(self):
@@ -295,28 +350,133 @@ class Forest:
             ts.reset()
         self.id_to_lineage = None
         self.id_to_track = {}
+        # cached detail layouts by timestamp ordinal (see region_layout)
+        self.ordinal_to_region_layout = {}
         self.track_order = None
 
     def load_image_for_timestamp(self, ts_ordinal):
         loader = self.image_volume_loader
         assert loader is not None, "No loader for images defined."
+        cache = self.volume_cache
+        if cache is not None:
+            return cache.get("image", ts_ordinal, loader)
         return loader(ts_ordinal)
 
     def load_labels_for_timestamp(self, ts_ordinal):
         loader = self.label_volume_loader
         assert loader is not None, "No loader for labels defined."
+        cache = self.volume_cache
+        if cache is not None:
+            return cache.get("labels", ts_ordinal, loader)
         return loader(ts_ordinal)
 
+    def use_volume_cache(
+        self,
+        max_bytes=volume_cache.DEFAULT_CACHE_BYTES,
+        prefetch_radius=volume_cache.DEFAULT_PREFETCH_RADIUS,
+        workers=volume_cache.DEFAULT_PREFETCH_WORKERS,
+    ):
+        """
+        Keep recently used volumes in a shared LRU cache limited to max_bytes
+        and prefetch volumes within prefetch_radius of a selected timestamp.
+        """
+        self.volume_cache = volume_cache.VolumeCache(max_bytes, prefetch_radius, workers)
+        return self.volume_cache
+
+    def prefetch_volumes(self, ts_ordinal):
+        "Start loading volumes for timestamps neighbouring ts_ordinal in the background."
+        cache = self.volume_cache
+        if cache is None:
+            return
+        label_loader = self.label_volume_loader
+        image_loader = self.image_volume_loader
+        for ordinal in cache.neighbour_ordinals(ts_ordinal, self.ordinal_to_timestamp):
+            if label_loader is not None:
+                cache.prefetch("labels", ordinal, label_loader)
+            if image_loader is not None:
+                cache.prefetch("image", ordinal, image_loader)
+
     def create_nodes_for_labels_in_timestamp(self, ts_ordinal):
         labels = self.load_labels_for_timestamp(ts_ordinal)
         if labels is None:
             print("WARNING: NO LABELS FOUND FOR ORDINAL", ts_ordinal)
         else:
-            unique_labels = np.unique(labels)
-            for label in unique_labels:
-                if label > 0:
-                    node_name = "%03d_%03d" % (ts_ordinal, label)
-                    self.add_node(node_name, ts_ordinal, label)
+            for label in label_index.positive_labels(labels).tolist():
+                self.add_node(self.label_node_name(ts_ordinal, label), ts_ordinal, label)
+
+    def label_node_name(self, ts_ordinal, label):
+        return "%03d_%03d" % (ts_ordinal, label)
+
+    def default_label_index_path(self):
+        """
+        Label index sidecar in the volume store folder, or else in the folder of the label files
+        of load_klb_using_file_patterns (None if there is neither).
+        """
+        store = self.volume_store
+        if store is not None:
+            return os.path.join(store.folder, label_index.INDEX_FILENAME)
+        if self.label_pattern is not None:
+            folder = os.path.dirname(os.path.abspath(self.label_pattern))
+            return os.path.join(folder, label_index.INDEX_FILENAME)
+        return None
+
+    def use_default_label_index(self):
+        "Use the default label index sidecar if one was saved (for example by unify_slicing)."
+        path = self.default_label_index_path()
+        if path is not None and os.path.exists(path):
+            self.use_label_index(path)
+
+    def scan_labels(self, ordinals=None, processes=None, index_path=None, verbose=True):
+        """
+        Label sets, voxel counts and centroids for the label volumes of the ordinals
+        (by default the forest timestamps or else the volume store ordinals).
+        Volumes are scanned in a process pool.  If index_path is given (or there is an index from use_label_index,
+        or a default in the volume store folder) results are read from and saved to that sidecar index
+        so later runs skip the scan.
+        Returns a dictionary mapping ordinals to label_index.label_statistics (None for missing volumes).
+        """
+        loader = self.label_volume_loader
+        assert loader is not None, "No loader for labels defined."
+        if ordinals is None:
+            ordinals = sorted(self.ordinal_to_timestamp.keys())
+            if not ordinals and self.volume_store is not None:
+                ordinals = self.volume_store.ordinals("labels")
+        ordinals = list(ordinals)
+        index = self.label_index
+        if index_path is None and index is None:
+            index_path = self.default_label_index_path()
+        if index_path is not None:
+            index = label_index.LabelIndex(index_path)
+        to_scan = ordinals
+        if index is not None:
+            to_scan = index.missing_ordinals(ordinals)
+        scanned = {}
+        if to_scan:
+            scanned = label_index.scan_label_volumes(loader, to_scan, processes, verbose=verbose)
+        if index is not None:
+            if scanned:
+                index.update(scanned)
+                index.save()
+                # boxes unknown before may be in the index now.
+                self.unknown_slicing_count = None
+            for ordinal in ordinals:
+                if ordinal not in scanned:
+                    scanned[ordinal] = index.get(ordinal)
+        return {ordinal: scanned[ordinal] for ordinal in ordinals}
+
+    def create_nodes_for_labels(self, ordinals, processes=None, index_path=None, verbose=True):
+        """
+        Bulk version of create_nodes_for_labels_in_timestamp for many ordinals using scan_labels.
+        Returns the scan_labels statistics.
+        """
+        ordinal_to_stats = self.scan_labels(ordinals, processes, index_path, verbose)
+        for (ordinal, stats) in ordinal_to_stats.items():
+            if stats is None:
+                print("WARNING: NO LABELS FOUND FOR ORDINAL", ordinal)
+                continue
+            for label in stats["labels"]:
+                self.add_node(self.label_node_name(ordinal, label), ordinal, label)
+        return ordinal_to_stats
 
     def load_klb_using_file_patterns(
         self,
@@ -338,13 +498,149 @@ class Forest:
         self.label_volume_loader = label_loader
         self.image_pattern = image_pattern
         self.label_pattern = label_pattern
+        self.volumes_changed()
+        self.use_default_label_index()
+
+    def load_volume_store(self, folder):
+        """
+        Load memory mapped volumes from a store folder created by volume_store.convert_volumes
+        (or the volume_store command line).
+        """
+        store = self.volume_store = volume_store.VolumeStore(folder)
+        self.label_volume_loader = store.load_labels
+        self.image_volume_loader = store.load_image
+        self.volumes_changed()
+        self.use_default_label_index()
+        return store
+
+    def use_label_index(self, index_path=None, scan=False, processes=None):
+        """
+        Use per-label statistics (including bounding boxes) from a label index sidecar
+        (by default in the volume store folder).  If scan is set, scan any timestamps missing from the index.
+        """
+        if index_path is None:
+            index_path = self.default_label_index_path()
+        assert index_path is not None, "No label index path given and no default (volume store or file patterns)."
+        self.label_index = label_index.LabelIndex(index_path)
+        self.forget_experiment_slicing()
+        if scan:
+            self.scan_labels(processes=processes)
+        return self.label_index
+
+    def label_statistics_for_timestamp(self, ts_ordinal):
+        "label_index.label_statistics for the timestamp from the label index, if known (else None)."
+        index = self.label_index
+        if index is None or index.missing_ordinals([ts_ordinal]):
+            return None
+        return index.get(ts_ordinal)
+
+    def label_slicing_for_timestamp(self, ts_ordinal, unified=True):
+        """
+        Precomputed positive label bounding box for the timestamp, if known (else None).
+        If unified is set and the boxes of all timestamps are known use the box containing them all,
+        so all timestamps are cropped the same way.
+        """
+        if unified:
+            slicing = self.experiment_slicing()
+            if slicing is not None:
+                return slicing
+        store = self.volume_store
+        if store is not None:
+            slicing = store.positive_slicing(ts_ordinal)
+            if slicing is not None:
+                return slicing
+        stats = self.label_statistics_for_timestamp(ts_ordinal)
+        if stats is not None:
+            return label_index.statistics_positive_slicing(stats)
+        return None
+
+    def ordinal_slicings(self, ordinals=None, scan=False, processes=None, index_path=None, verbose=True):
+        """
+        Dictionary mapping the ordinals (by default the forest timestamps) to precomputed positive label
+        bounding boxes from the volume store or label index (None for missing volumes).
+        If scan is set the other label volumes are scanned with scan_labels (saving the statistics
+        in the label index if there is one), otherwise returns None if some box is not known.
+        """
+        if ordinals is None:
+            ordinals = self.ordinal_index()
+        result = {}
+        unknown = []
+        for ordinal in ordinals:
+            slicing = self.label_slicing_for_timestamp(ordinal, unified=False)
+            if slicing is None:
+                if not scan:
+                    return None
+                unknown.append(ordinal)
+            result[ordinal] = slicing
+        if unknown:
+            scanned = self.scan_labels(unknown, processes, index_path, verbose)
+            for (ordinal, stats) in scanned.items():
+                if stats is not None:
+                    result[ordinal] = label_index.statistics_positive_slicing(stats)
+        return result
+
+    def unify_slicing(self, ordinals=None, processes=None, index_path=None, verbose=True):
+        """
+        Compute the positive label bounding box containing the boxes of all the ordinals
+        (by default the forest timestamps), scanning label volumes with no precomputed box
+        (see ordinal_slicings), and use it to crop every timestamp in the viewer.
+        The scanned boxes are saved in the label index (index_path, else the index in use, else the
+        default sidecar), so later sessions find them with use_label_index without scanning.
+        Run this before starting the viewer: the viewer never scans all the volumes itself.
+        Returns the box (None if there are no labels).
+        """
+        if index_path is None and self.label_index is None:
+            index_path = self.default_label_index_path()
+            assert index_path is not None, "No label index path given and no default (volume store or file patterns)."
+        if index_path is not None:
+            self.use_label_index(index_path)
+        ordinal_to_slicing = self.ordinal_slicings(ordinals, True, processes, None, verbose)
+        boxes = [slicing for slicing in ordinal_to_slicing.values() if slicing is not None]
+        self.unified_slicing = label_index.union_box(boxes)
+        self.unified_ordinals = set(ordinal_to_slicing)
+        return self.unified_slicing
+
+    def experiment_slicing(self):
+        """
+        Bounding box of the positive labels of all the timestamps,
+        computed without scanning if all their boxes are precomputed (else None).
+        """
+        ordinals = self.unified_ordinals
+        all_ordinals = self.ordinal_index()
+        if ordinals is None or not ordinals.issuperset(all_ordinals):
+            if self.unknown_slicing_count == len(all_ordinals):
+                # checked before: some box is still unknown.
+                return None
+            ordinal_to_slicing = self.ordinal_slicings()
+            if ordinal_to_slicing is None:
+                self.unknown_slicing_count = len(all_ordinals)
+                return None
+            boxes = [slicing for slicing in ordinal_to_slicing.values() if slicing is not None]
+            self.unified_slicing = label_index.union_box(boxes)
+            self.unified_ordinals = set(ordinal_to_slicing)
+        return self.unified_slicing
+
+    def forget_experiment_slicing(self):
+        "Forget the experiment bounding box after the volumes or the label index change."
+        self.unified_slicing = self.unified_ordinals = self.unknown_slicing_count = None
 
     def use_trivial_null_loaders(self):
         def null_loader(ordinal):
             return None
         self.image_volume_loader = null_loader
         self.label_volume_loader = null_loader
-        
+        self.volumes_changed()
+
+    def volumes_changed(self):
+        """
+        Forget cached volumes and bounding boxes after the volume loaders change.
+        Caches of data derived from the volumes key it by (volume_generation, ordinal).
+        """
+        self.volume_generation = next(volume_generations)
+        self.forget_experiment_slicing()
+        if self.volume_cache is not None:
+            self.volume_cache.discard()
+
 
     def check_labels(self, trivial=True):
         """
@@ -352,14 +648,24 @@ class Forest:
         and whether the labels for the timestamps match the labels in the label volume.
         """
         o2t = self.ordinal_to_timestamp
-        for ordinal in sorted(o2t.keys()):
-            volume = self.load_labels_for_timestamp(ordinal)
-            if volume is None:
+        ordinals = sorted(o2t.keys())
+        ordinal_to_stats = {}
+        if not trivial:
+            # label sets from the label index (scanning volumes not yet indexed).
+            ordinal_to_stats = self.scan_labels(ordinals, verbose=False)
+        for ordinal in ordinals:
+            if trivial:
+                volume = self.load_labels_for_timestamp(ordinal)
+                if volume is None:
+                    print("No volume file for", ordinal)
+                continue
+            stats = ordinal_to_stats[ordinal]
+            if stats is None:
                 print("No volume file for", ordinal)
-            elif not trivial:
+            else:
                 ts = o2t[ordinal]
                 ts_labels = set(ts.label_to_node.keys())
-                volume_labels = set(np.unique(volume)) - set([0])
+                volume_labels = set(stats["labels"])
                 volume_missing = sorted(ts_labels - volume_labels)
                 ts_missing = sorted(volume_labels - ts_labels)
                 if volume_missing or ts_missing:
@@ -373,10 +679,22 @@ class Forest:
     def assign_colors_to_lineages(self):
         return self.assign_colors_to_tracks(id_to_collection=self.id_to_lineage)
 
-    def assign_colors_to_tracks(self, id_to_collection=None):
+    def assign_colors_to_tracks(self, id_to_collection=None, identifiers=None):
+        """
+        Color nodes by collection (tracks by default).
+        Colors follow the position of each collection in the sorted identifiers.
+        If identifiers are given only color those collections, with the colors a full assignment gives them,
+        so they must include every collection whose position changed (see update_lineages).
+        """
         if id_to_collection is None:
             id_to_collection = self.id_to_track
-        for (index, identifier) in enumerate(sorted(id_to_collection.keys())):
+        sorted_identifiers = sorted(id_to_collection.keys())
+        if identifiers is None:
+            indexed = enumerate(sorted_identifiers)
+        else:
+            identifier_to_index = {identifier: index for (index, identifier) in enumerate(sorted_identifiers)}
+            indexed = [(identifier_to_index[identifier], identifier) for identifier in identifiers]
+        for (index, identifier) in indexed:
             collection = id_to_collection[identifier]
             color_array = color_list.indexed_color(index + 1)
             color = color_list.rgbhtml(color_array)
@@ -384,6 +702,7 @@ class Forest:
                 node.color = color
                 node.color_array = color_array
 
+    @instrumentation.timed(category="forest")
     def find_tracks_and_lineages(self):
         self.reset()
         i2l = {}
@@ -408,26 +727,189 @@ class Forest:
             tr.set_index(i)
         self.track_order = [i2t[tid] for tid in s_ids]
 
+    @instrumentation.timed(category="forest")
     def assign_offsets(self, start_at=0):
+        """
+        Lay out all lineages side by side starting at start_at.
+        Lineages which already have a layout (cursor_range) are only shifted into place;
+        find_tracks_and_lineages and update_lineages create new lineages which are laid out.
+        """
         i2l = self.id_to_lineage
         assert i2l is not None, "lineages must be assigned first."
-        cursor = start_at
-        # assign isolated lineages after all non-isolated
         for rootid in i2l.keys():
             # mark isolated nodes for downstream testing
             lineage = i2l[rootid]
             lineage.mark_isolated()
+        self.relayout(set(), start_at)
+
+    def lineage_layout_order(self):
+        "Lineage root ids in layout order: sorted, with isolated lineages after all non-isolated."
+        i2l = self.id_to_lineage
+        connected_roots = []
         isolated_roots = []
         for rootid in sorted(i2l.keys()):
-            lineage = i2l[rootid]
-            if lineage.isolated():
+            if i2l[rootid].isolated():
                 isolated_roots.append(rootid)
             else:
-                cursor = lineage.root.assign_offsets(cursor) + 1
-        # set isolated offsets higher...
-        for rootid in isolated_roots:
+                connected_roots.append(rootid)
+        return connected_roots + isolated_roots
+
+    def layout_lineage(self, lineage, cursor):
+        "Assign offsets to the lineage nodes starting at cursor.  Return the next free cursor."
+        return lineage.root.assign_offsets(cursor) + 1
+
+    def lineage_roots_of(self, nodes):
+        "Current lineage root ids for nodes (None if lineages have not been computed)."
+        if self.id_to_lineage is None:
+            return None
+        result = set()
+        for node in nodes:
+            root = node._lineage_root
+            if root is None:
+                return None
+            result.add(root.node_id)
+        return result
+
+    def remove_parent(self, child):
+        parent = child.parent
+        if parent is not None:
+            parent.id_to_child.pop(child.node_id, None)
+            child.parent = None
+            self.invalidate_region_layouts([child.timestamp_ordinal, parent.timestamp_ordinal])
+
+    def reparent_problem(self, child, parent):
+        "Reason why parent cannot become the parent of child, or None if the edit is allowed."
+        if parent.timestamp_ordinal >= child.timestamp_ordinal:
+            return "parent %s is not older than child %s" % (parent.node_id, child.node_id)
+        # the parent must not be in the child's subtree: walk up from the parent
+        seen = set()
+        node = parent
+        while node is not None and node.node_id not in seen:
+            if node is child:
+                return "parent %s is in the subtree of child %s" % (parent.node_id, child.node_id)
+            seen.add(node.node_id)
+            node = node.parent
+        return None
+
+    def reparent(self, child, parent):
+        """
+        Make parent the parent of child and update lineages incrementally.
+        Return the changes (see update_lineages) or None if a full recalculation is needed.
+        """
+        problem = self.reparent_problem(child, parent)
+        assert problem is None, "cannot reparent: " + problem
+        root_ids = self.lineage_roots_of([child, parent])
+        self.remove_parent(child)
+        parent.set_child(child)
+        self.invalidate_region_layouts([child.timestamp_ordinal, parent.timestamp_ordinal])
+        if root_ids is None:
+            return None
+        return self.update_lineages(root_ids)
+
+    def disconnect(self, child):
+        "Remove the parent of child and update lineages incrementally, like reparent."
+        root_ids = self.lineage_roots_of([child])
+        self.remove_parent(child)
+        if root_ids is None:
+            return None
+        return self.update_lineages(root_ids)
+
+    @instrumentation.timed(category="forest")
+    def update_lineages(self, old_root_ids):
+        """
+        Recompute tracks and lineages for the nodes of the lineages with old_root_ids after an edit,
+        then adjust the layout.  Other lineages keep their tracks and are only shifted if needed.
+        Return a dict with the changed nodes, the new track and lineage ids and the ids of the
+        tracks and lineages to recolor (the new ones and those whose sorted position, and so color, changed).
+        """
+        i2l = self.id_to_lineage
+        i2t = self.id_to_track
+        old_lineage_positions = {rootid: index for (index, rootid) in enumerate(sorted(i2l.keys()))}
+        affected = []
+        for rootid in old_root_ids:
+            lineage = i2l.pop(rootid)
+            affected.extend(lineage.id_to_node.values())
+        for node in affected:
+            i2t.pop(node._track.node_id, None)
+        for node in affected:
+            node.reset()
+        new_roots = sorted((node for node in affected if node.parent is None), key=lambda n: n.node_id)
+        new_track_ids = set()
+        for root in new_roots:
+            lineage = i2l[root.node_id] = Lineage(root)
+            root._track = root
+            stack = [root]
+            # top down walk: no recursion
+            while stack:
+                node = stack.pop()
+                node._lineage_root = root
+                track_root = node._track
+                track = i2t.get(track_root.node_id)
+                if track is None:
+                    track = i2t[track_root.node_id] = Track(track_root)
+                    new_track_ids.add(track_root.node_id)
+                track.add_node(node)
+                lineage.add_node(node)
+                split = len(node.id_to_child) > 1
+                for child in node.id_to_child.values():
+                    child._track = child if split else track_root
+                    stack.append(child)
+        s_ids = sorted(i2t.keys())
+        recolor_track_ids = set(new_track_ids)
+        for (i, tid) in enumerate(s_ids):
+            track = i2t[tid]
+            if track.index != i:
+                track.set_index(i)
+                recolor_track_ids.add(tid)
+        self.track_order = [i2t[tid] for tid in s_ids]
+        new_lineage_ids = set(root.node_id for root in new_roots)
+        recolor_lineage_ids = set(new_lineage_ids)
+        for (i, rootid) in enumerate(sorted(i2l.keys())):
+            if old_lineage_positions.get(rootid) != i:
+                recolor_lineage_ids.add(rootid)
+        shifted = self.relayout(new_lineage_ids)
+        changed = {node.node_id: node for node in affected}
+        for node in shifted:
+            changed[node.node_id] = node
+        for (i2c, ids) in ((i2t, recolor_track_ids), (i2l, recolor_lineage_ids)):
+            for identifier in ids:
+                changed.update(i2c[identifier].id_to_node)
+        return dict(
+            nodes=list(changed.values()),
+            track_ids=sorted(new_track_ids),
+            lineage_ids=sorted(new_lineage_ids),
+            recolor_track_ids=sorted(recolor_track_ids),
+            recolor_lineage_ids=sorted(recolor_lineage_ids),
+        )
+
+    @instrumentation.timed(category="forest")
+    def relayout(self, dirty_root_ids, start_at=0):
+        """
+        Lay out the dirty lineages and shift the offsets of other lineages whose position changed.
+        Return the list of nodes with changed offsets.
+        """
+        i2l = self.id_to_lineage
+        changed = []
+        cursor = start_at
+        for rootid in dirty_root_ids:
+            i2l[rootid].mark_isolated()
+        for rootid in self.lineage_layout_order():
             lineage = i2l[rootid]
-            cursor = lineage.root.assign_offsets(cursor) + 1
+            cursor_range = lineage.cursor_range
+            if rootid in dirty_root_ids or cursor_range is None:
+                next_cursor = self.layout_lineage(lineage, cursor)
+                changed.extend(lineage.id_to_node.values())
+            else:
+                (start, stop) = cursor_range
+                shift = cursor - start
+                if shift:
+                    for node in lineage.id_to_node.values():
+                        node._offset += shift
+                    changed.extend(lineage.id_to_node.values())
+                next_cursor = stop + shift
+            lineage.cursor_range = (cursor, next_cursor)
+            cursor = next_cursor
+        return changed
 
     def add_node(self, node_id, ordinal, label=None):
         i2n = self.id_to_node
@@ -436,6 +918,7 @@ class Forest:
         n = Node(node_id, ordinal, label)
         i2n[node_id] = n 
         ts.add_node(n)
+        self.invalidate_region_layouts([ordinal])
         return n
 
     def get_or_add_timestamp(self, ordinal):
@@ -444,8 +927,47 @@ class Forest:
             result = i2t[ordinal]
         else:
             result = i2t[ordinal] = TimeStamp(ordinal)
+            self.ordinal_index()
+            bisect.insort(self.sorted_ordinals, ordinal)
+            # predecessor timestamps may have changed.
+            self.ordinal_to_region_layout = {}
         return result
 
+    def ordinal_index(self):
+        "Sorted list of the timestamp ordinals."
+        if len(self.sorted_ordinals) != len(self.ordinal_to_timestamp):
+            # timestamps were added without get_or_add_timestamp.
+            self.sorted_ordinals = sorted(self.ordinal_to_timestamp.keys())
+        return self.sorted_ordinals
+
+    def invalidate_region_layouts(self, ordinals):
+        "Forget cached region layouts for windows including any of the ordinals (after an edit)."
+        o2l = self.ordinal_to_region_layout
+        if not o2l:
+            return
+        ordinals = set(ordinals)
+        for (ordinal, layout) in list(o2l.items()):
+            if not ordinals.isdisjoint(layout["ordinals"]):
+                del o2l[ordinal]
+
+    def json_delta(self, changed_nodes):
+        "JSON updates for changed nodes: isolated nodes are removed as in json_ob."
+        (width, height) = self.dimensions()
+        id_to_node_json = {}
+        removed_ids = []
+        for node in changed_nodes:
+            if node._is_isolated:
+                removed_ids.append(node.node_id)
+            else:
+                id_to_node_json[node.node_id] = node.json_object()
+        return dict(
+            width=width,
+            height=height,
+            id_to_node=id_to_node_json,
+            removed_ids=removed_ids,
+        )
+
+    @instrumentation.timed(category="forest")
     def json_ob(self, exclude_isolated=True):
         (width, height) = self.dimensions()
         id_to_node = self.id_to_node
@@ -473,15 +995,13 @@ class Forest:
                 parent = self.id_to_node[parent_id]
                 parent.set_child(node)
 
+    @instrumentation.timed(category="forest")
     def timestamp_region_json(self, ordinal):
         """
         Node info for nodes in timestamp, its predecessor and all directly connected ancestor timestamps.
         """
-        # always include isolated nodes (?)
-        o2t = self.ordinal_to_timestamp
-        ordinals = set([ordinal])
-        all_ordinals = sorted(o2t.keys())
-        if ordinal not in all_ordinals:
+        layout = self.region_layout(ordinal)
+        if layout is None:
             # hack boundary case
             return dict(
                 id_to_node={},
@@ -489,7 +1009,44 @@ class Forest:
                 height=1,
                 ordinals=[],
             )
-        index = all_ordinals.index(ordinal)
+        id_to_node = self.id_to_node
+        id_to_node_json = {}
+        for (id, x, y) in layout["positions"]:
+            node = id_to_node[id]
+            json_ob = node.json_object()
+            # patch in relative geometry
+            json_ob["x"] = x
+            json_ob["y"] = y
+            # child marker
+            json_ob["is_child"] = (json_ob["timestamp_ordinal"] == ordinal)
+            id_to_node_json[id] = json_ob
+        return dict(
+            id_to_node=id_to_node_json,
+            width=layout["width"],
+            height=layout["height"],
+            ordinals=list(layout["ordinals"]),
+        )
+
+    def region_layout(self, ordinal):
+        """
+        Relative positions of the nodes shown by timestamp_region_json (None if there is no such timestamp).
+        Layouts are cached until an edit touches one of the ordinals in the window.
+        """
+        o2l = self.ordinal_to_region_layout
+        layout = o2l.get(ordinal)
+        if layout is None:
+            layout = self.compute_region_layout(ordinal)
+            if layout is not None:
+                o2l[ordinal] = layout
+        return layout
+
+    def compute_region_layout(self, ordinal):
+        o2t = self.ordinal_to_timestamp
+        if ordinal not in o2t:
+            return None
+        all_ordinals = self.ordinal_index()
+        index = bisect.bisect_left(all_ordinals, ordinal)
+        ordinals = set([ordinal])
         if index > 0:
             pred = all_ordinals[index - 1]
             # always add any pred timestamp
@@ -497,59 +1054,56 @@ class Forest:
         ts = o2t[ordinal]
         farthest = ts.farthest_parent_ordinal()
         # also add directly connected older timestamps
-        for ord in all_ordinals:
-            if (ord <= ordinal) and (ord >= farthest):
-                ordinals.add(ord)
-        # dump nodes and adjust geometry
+        ordinals.update(all_ordinals[bisect.bisect_left(all_ordinals, farthest): index + 1])
         id_to_node = {}
         for ord in ordinals:
             this_ts = o2t[ord]
-            #print("updating", list(this_ts.id_to_node.keys()))
             id_to_node.update(this_ts.id_to_node)
-        id_to_node_json = {}
-        #offsets = sorted(set(node._offset for node in id_to_node.values()))
         # for each node determine the relative right to left position, parents by label, child beneath parent
         # parents first
         ordinalm1 = ordinal - 1
+        detail_offset = {}
+        child_offset = {}
         default_offset = -1
         for (id, node) in id_to_node.items():
-            node._detail_offset = default_offset
-            default_offset -= 1  # default offset
+            # distinct default offsets for nodes placed later
+            detail_offset[id] = default_offset
+            default_offset -= 1
             if node.timestamp_ordinal == ordinalm1:
                 # parent node, put it at the leftmost position
                 label = node.label or -1
-                #gz.force_print("parent node", node.node_id, "label", label)
-                node._detail_offset = label
-                node._child_offset = label - 0.1
-        # assign child offsets
+                detail_offset[id] = label
+                child_offset[id] = label - 0.1
+        # assign child offsets in region order: the order decides which sibling goes left of which.
         for (id, node) in id_to_node.items():
-            if node.timestamp_ordinal != ordinalm1:
-                node._detail_offset = -1  # default
-                parent_id = node.parent.node_id
-                if parent_id in id_to_node:
-                    parent = id_to_node[parent_id]
-                    if len(parent.id_to_child) < 2:
-                        node._detail_offset = parent._detail_offset
-                    else:
-                        node._detail_offset = parent._child_offset
-                        parent._child_offset += 0.2
-            offsets = sorted(set(node._detail_offset for node in id_to_node.values()))
-        #gz.force_print("offsets", offsets)
+            if node.timestamp_ordinal == ordinalm1:
+                continue
+            offset = -1  # default (also for nodes with no parent)
+            parent = node.parent
+            if parent is not None and parent.node_id in id_to_node:
+                parent_id = parent.node_id
+                if len(parent.id_to_child) < 2:
+                    offset = detail_offset[parent_id]
+                else:
+                    if parent_id not in child_offset:
+                        child_offset[parent_id] = detail_offset[parent_id] - 0.1
+                    offset = child_offset[parent_id]
+                    child_offset[parent_id] += 0.2
+            detail_offset[id] = offset
+        offsets = sorted(set(detail_offset.values()))
+        offset_to_x = {offset: x for (x, offset) in enumerate(offsets)}
         sordinals = sorted(ordinals)
         height = len(sordinals)
-        for (id, node) in id_to_node.items():
-            json_ob = node.json_object()
-            # patch in relative geometry
-            json_ob["x"] = offsets.index(node._detail_offset)
-            json_ob["y"] = height - sordinals.index(node.timestamp_ordinal) - 1
-            # child marker
-            json_ob["is_child"] = (json_ob["timestamp_ordinal"] == ordinal)
-            id_to_node_json[id] = json_ob
+        ordinal_to_y = {ord: height - position - 1 for (position, ord) in enumerate(sordinals)}
+        positions = [
+            (id, offset_to_x[detail_offset[id]], ordinal_to_y[node.timestamp_ordinal])
+            for (id, node) in id_to_node.items()
+        ]
         return dict(
-            id_to_node=id_to_node_json,
+            positions=positions,
             width=len(offsets),
             height=height,
-            ordinals=sordinals,
+            ordinals=tuple(sordinals),
         )
 
     def dimensions(self):
@@ -561,10 +1115,12 @@ class Forest:
             width = max(n._offset for n in non_isolated) + 1
         return (width, height)
 
-def make_forest_from_haydens_json_graph(json_graph, label_assignment=None, add_parents=True, verbose=False):
+@instrumentation.timed(category="forest")
+def make_forest_from_haydens_json_graph(json_graph, label_assignment=None, add_parents=True, verbose=False, forest=None):
     """
     Read a JSON dump of matlab graph similar to "Gata6Nanog1.json".
     Return a forest.
+    Provide an empty forest (for example of a Forest subclass) to populate it instead of a new Forest.
     """
     #edges = json_graph['G_based_on_nn_combined']['Edges']
     nodes = edges = None
@@ -577,7 +1133,9 @@ def make_forest_from_haydens_json_graph(json_graph, label_assignment=None, add_p
             edges = graph["Edges"]
             nodes = graph["Nodes"]
     assert edges is not None, "Could not find edges: " + repr(list(json_graph.keys()))
-    result = Forest()
+    result = forest
+    if result is None:
+        result = Forest()
     all_ids = set()
     parent_map = {}
     for thing in nodes:
@@ -591,7 +1149,8 @@ def make_forest_from_haydens_json_graph(json_graph, label_assignment=None, add_p
     #parsed_strings = {}
     timestamps = set()
     node_map = {}
-    for s in all_ids:
+    # sorted, not set order: node order decides sibling placement in the region layout
+    for s in sorted(all_ids):
         [ts_string, label_string] = s.split("_")
         parsed = (ts, label) = (int(ts_string), int(label_string))
         timestamps.add(ts)
@@ -608,7 +1167,7 @@ def make_forest_from_haydens_json_graph(json_graph, label_assignment=None, add_p
         n = result.add_node(s, ts, label)
         node_map[s] = n
     if add_parents:
-        for (child_id, parent_id) in parent_map.items():
+        for (child_id, parent_id) in sorted(parent_map.items()):
             child = node_map[child_id]
             parent = node_map[parent_id]
             parent.set_child(child)
@@ -63,6 +63,16 @@ class LineageDisplay(TimeSliceDetail):
         fjson = F.json_ob()
         self.load_json(fjson)
 
+    def update_forest(self, forest, changes):
+        "Send only the nodes changed by an incremental edit (see Forest.update_lineages)."
+        F = forest
+        if self.colorize == "tracks":
+            F.assign_colors_to_tracks(identifiers=changes["recolor_track_ids"])
+        else:
+            F.assign_colors_to_tracks(id_to_collection=F.id_to_lineage, identifiers=changes["recolor_lineage_ids"])
+        delta = F.json_delta(changes["nodes"])
+        do(self.detail_link.update_nodes(delta))
+
     def focus_ts(self, ordinal):
         "Set the timestamp focus in the view (with no callback)."
         do(self.detail_link.focus_ts(ordinal, True))
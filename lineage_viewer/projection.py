@@ -0,0 +1,552 @@
+
+"""
+Fused rotate and project rendering.
+
+operations3d.rotate3d rotates a volume embedded in a rotation_buffer by composing axis swaps,
+flips and integer shears, so every voxel of the rotated buffer is a copy of one source voxel (or zero).
+Here the same sequence of operations is replayed on index coordinates only, which maps each
+rotated voxel back to its source voxel.  Projections along the first axis of the rotated volume
+are then accumulated a few rotated planes at a time directly from the unrotated volumes,
+so neither the rotation buffer nor the rotated volumes are ever allocated.
+
+The results match rotating with rotate3d, trimming black borders and projecting
+(for non negative image intensities), except that labels in rotated planes where the image
+is entirely zero are not trimmed away.
+"""
+
+import os
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from . import label_outlines
+
+# rotated planes processed together; memory use is proportional to planes * (rotated side)**2.
+SLAB_PLANES = 4
+# largest rotation grid whose source indices are kept (larger grids are recomputed slab by slab).
+GRID_BYTES = 2 ** 29
+# default threads computing and gathering rotation grid slabs (numpy releases the GIL in these).
+WORKERS = min(32, os.cpu_count() or 1)
+
+# rotation angles this small are skipped, as in operations3d.
+EPSILON = 0.01
+PI4 = np.pi / 4
+PI34 = 3 * np.pi / 4
+PI2 = np.pi / 2
+
+class IndexVolume:
+
+    """
+    Stand in for a volume passed through the rotation operations, recording the
+    operations so rotated index coordinates can be mapped back to source coordinates.
+    """
+
+    def __init__(self, shape, steps=()):
+        self.shape = tuple(shape)
+        self.steps = tuple(steps)
+
+    def then(self, shape, step):
+        return IndexVolume(shape, self.steps + (step,))
+
+    def swapaxes(self, a, b):
+        shape = list(self.shape)
+        (shape[a], shape[b]) = (shape[b], shape[a])
+        return self.then(shape, ("swap", a, b))
+
+    def flip(self, axis):
+        return self.then(self.shape, ("flip", axis, self.shape[axis]))
+
+    def shear(self, radians):
+        "Record operations3d.shearKJ."
+        (I, J, K) = self.shape
+        Jmid = J / 2
+        shifter = np.tan(radians)
+        shifts = np.array([int((j - Jmid) * shifter) for j in range(J)], dtype=np.int32)
+        return self.then(self.shape, ("shear", shifts, K))
+
+    def source_coordinates(self, coordinates):
+        """
+        Map arrays of (i, j, k) coordinates in this volume back to the original volume.
+        The arrays may have different shapes which broadcast together.
+        Returns the source coordinate arrays and a mask of coordinates inside the original volume.
+        """
+        coordinates = list(coordinates)
+        valid = np.ones(np.broadcast_shapes(*(c.shape for c in coordinates)), dtype=bool)
+        for step in reversed(self.steps):
+            kind = step[0]
+            if kind == "swap":
+                (a, b) = step[1:]
+                (coordinates[a], coordinates[b]) = (coordinates[b], coordinates[a])
+            elif kind == "flip":
+                (axis, n) = step[1:]
+                coordinates[axis] = (n - 1) - coordinates[axis]
+            else:
+                (shifts, K) = step[1:]
+                # j may be out of range where k already left the volume; those are invalid anyway.
+                k = coordinates[2] + shifts.take(coordinates[1], mode="clip")
+                valid &= (k >= 0) & (k < K)
+                coordinates[2] = k
+        return (coordinates, valid)
+
+    def rotated_coordinates(self, coordinates):
+        """
+        Map arrays of (i, j, k) coordinates in the original volume forward to this volume
+        (the inverse of source_coordinates).  Returns the coordinate arrays and a mask of
+        coordinates which are not sheared out of the volume.
+        """
+        coordinates = list(coordinates)
+        valid = np.ones(coordinates[0].shape, dtype=bool)
+        for step in self.steps:
+            kind = step[0]
+            if kind == "swap":
+                (a, b) = step[1:]
+                (coordinates[a], coordinates[b]) = (coordinates[b], coordinates[a])
+            elif kind == "flip":
+                (axis, n) = step[1:]
+                coordinates[axis] = (n - 1) - coordinates[axis]
+            else:
+                (shifts, K) = step[1:]
+                k = coordinates[2] - shifts.take(coordinates[1], mode="clip")
+                valid &= (k >= 0) & (k < K)
+                coordinates[2] = k
+        return (coordinates, valid)
+
+# The functions below mirror the operations3d rotation functions step for step on IndexVolumes.
+
+def is_tiny(number):
+    return abs(number) < EPSILON
+
+def rot90JK(volume):
+    return volume.swapaxes(1, 2).flip(1)
+
+def swapABC(volume, A=0, B=1, C=2):
+    order = [A, B, C]
+    for (p0, p1) in [(0, 1), (1, 2), (0, 1)]:
+        if order[p0] > order[p1]:
+            volume = volume.swapaxes(p0, p1)
+            (order[p0], order[p1]) = (order[p1], order[p0])
+    return volume
+
+def invertABC(A=0, B=1, C=2):
+    map = {A: 0, B: 1, C: 2}
+    return [map[i] for i in range(3)]
+
+def shearABC(volume, radians, A=0, B=1, C=2):
+    swap = swapABC(volume, A, B, C)
+    shear = swap.shear(radians)
+    [iA, iB, iC] = invertABC(A, B, C)
+    return swapABC(shear, iA, iB, iC)
+
+def rotateKJ45(volume, theta):
+    if is_tiny(theta):
+        return volume
+    alpha = - np.tan(0.5 * theta)
+    beta = np.sin(theta)
+    sA = volume.shear(alpha)
+    sB = shearABC(sA, beta, 0, 2, 1)
+    return sB.shear(alpha)
+
+def rotateKJ(volume, theta):
+    if is_tiny(theta):
+        return volume
+    assert -np.pi - 1 <= theta <= np.pi + 1, "theta not in range -pi..pi." + repr(theta)
+    buffer = volume
+    theta0 = theta
+    if theta > PI4:
+        if theta < PI34:
+            buffer = rot90JK(volume)
+            theta0 = theta - PI2
+        else:
+            buffer = rot90JK(rot90JK(volume))
+            theta0 = theta - np.pi
+    elif theta < -PI4:
+        if theta > -PI34:
+            buffer = rot90JK(rot90JK(rot90JK(volume)))
+            theta0 = theta + PI2
+        else:
+            buffer = rot90JK(rot90JK(volume))
+            theta0 = np.pi + theta
+    return rotateKJ45(buffer, theta0)
+
+def rotateABC(volume, radians, A=0, B=1, C=2):
+    if is_tiny(radians):
+        return volume
+    swap = swapABC(volume, A, B, C)
+    rotate = rotateKJ(swap, radians)
+    [iA, iB, iC] = invertABC(A, B, C)
+    return swapABC(rotate, iA, iB, iC)
+
+def rotate3d(volume, theta, phi, gamma=0):
+    R1 = rotateKJ(volume, theta)
+    R2 = rotateABC(R1, phi, 2, 0, 1)
+    return rotateABC(R2, gamma, 1, 2, 0)
+
+class RotationPlan:
+
+    "Index mapping of operations3d.rotate3d(operations3d.rotation_buffer(volume), theta, phi, gamma)."
+
+    def __init__(self, shape, theta, phi, gamma=0):
+        (I, J, K) = shape[:3]
+        self.volume_shape = (I, J, K)
+        N = self.side = math.ceil(np.sqrt(I*I + J*J + K*K))
+        # the volume is centered in the rotation buffer as in rotation_buffer.
+        self.offsets = (round(0.5 * (N - I)), round(0.5 * (N - J)), round(0.5 * (N - K)))
+        self.rotated = rotate3d(IndexVolume((N, N, N)), theta, phi, gamma)
+        assert self.rotated.shape == (N, N, N)
+        # axis aligned and quarter turn views only swap and flip axes.
+        self.axis_aligned = not any(step[0] == "shear" for step in self.rotated.steps)
+
+    def axis_view(self, volume):
+        """
+        For an axis aligned plan: the rotated volume without the zero padding of the rotation buffer,
+        as a transposed and flipped view of volume, and the position of its first voxel in the rotated buffer.
+        """
+        assert self.axis_aligned, "the rotation is not axis aligned"
+        view = volume
+        start = list(self.offsets)
+        for step in self.rotated.steps:
+            if step[0] == "swap":
+                (a, b) = step[1:]
+                view = view.swapaxes(a, b)
+                (start[a], start[b]) = (start[b], start[a])
+            else:
+                (axis, n) = step[1:]
+                view = np.flip(view, axis)
+                start[axis] = n - (start[axis] + view.shape[axis])
+        return (view, tuple(start))
+
+    def slab_sources(self, start, end):
+        "Source indices and validity for rotated planes start..end (each (end-start, N, N))."
+        N = self.side
+        planes = end - start
+        i = np.empty((planes, N, N), dtype=np.int32)
+        i[:] = np.arange(start, end).reshape((planes, 1, 1))
+        j = np.empty_like(i)
+        j[:] = np.arange(N).reshape((1, N, 1))
+        k = np.empty_like(i)
+        k[:] = np.arange(N).reshape((1, 1, N))
+        (coordinates, valid) = self.rotated.source_coordinates((i, j, k))
+        sources = []
+        for (c, offset, size) in zip(coordinates, self.offsets, self.volume_shape):
+            c = c - offset
+            valid &= (c >= 0) & (c < size)
+            sources.append(c)
+        sources = tuple(np.where(valid, c, 0) for c in sources)
+        return (sources, valid)
+
+    def slab_indices(self, start, end):
+        """
+        Flat indices into the volume of the sources of rotated planes start..end
+        (shape (end-start, N, N)), -1 where a rotated voxel has no source.
+        """
+        N = self.side
+        # broadcast coordinates: the early axis swaps and shears only touch one or two axes.
+        coordinates = (
+            np.arange(start, end, dtype=np.int32).reshape((end - start, 1, 1)),
+            np.arange(N, dtype=np.int32).reshape((1, N, 1)),
+            np.arange(N, dtype=np.int32).reshape((1, 1, N)),
+        )
+        (coordinates, valid) = self.rotated.source_coordinates(coordinates)
+        (I, J, K) = self.volume_shape
+        index_type = np.int32 if I * J * K < 2 ** 31 else np.int64
+        indices = np.zeros(valid.shape, dtype=index_type)
+        for (c, offset, size, step) in zip(coordinates, self.offsets, self.volume_shape, (J * K, K, 1)):
+            c = c - offset
+            valid &= (c >= 0) & (c < size)
+            indices += c.astype(index_type) * step
+        indices[~valid] = -1
+        return indices
+
+    def rotated_positions(self, coordinates):
+        "Rotated (i, j, k) positions of (i, j, k) volume coordinates, with a mask of the positions kept."
+        buffer_coordinates = [c + offset for (c, offset) in zip(coordinates, self.offsets)]
+        return self.rotated.rotated_coordinates(buffer_coordinates)
+
+# thread pools by worker count
+executors = {}
+
+def get_executor(workers):
+    executor = executors.get(workers)
+    if executor is None:
+        executor = executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rotation")
+    return executor
+
+def map_slabs(function, slabs, workers=None):
+    "[function(start, end) for (start, end) in slabs], run in a pool of workers threads if workers > 1."
+    if workers is None:
+        workers = WORKERS
+    if workers <= 1 or len(slabs) <= 1:
+        return [function(start, end) for (start, end) in slabs]
+    return list(get_executor(workers).map(lambda slab: function(*slab), slabs))
+
+class RotationGrid:
+
+    """
+    Source voxels of the rotation of volumes of one shape by one set of angles, shared by all the volumes
+    rotated the same way (the label and image volumes of a view, and of both panels when they agree).
+    operations3d.rotate3d only copies voxels, so labels and intensities are gathered with the same indices
+    and rotate(volumes) matches operations3d.rotate3d(operations3d.rotation_buffer(volume), theta, phi, gamma)
+    for each volume.  Slabs of rotated planes are computed and gathered in parallel by workers threads
+    (default WORKERS); each slab is written by one thread so the result does not depend on the worker count.
+    """
+
+    def __init__(self, shape, theta, phi, gamma=0, max_bytes=GRID_BYTES, slab_planes=SLAB_PLANES, workers=None):
+        plan = self.plan = RotationPlan(shape, theta, phi, gamma)
+        N = self.side = plan.side
+        self.slab_planes = slab_planes
+        self.workers = workers
+        self.indices = None
+        (I, J, K) = plan.volume_shape
+        itemsize = 4 if I * J * K < 2 ** 31 else 8
+        if N ** 3 * itemsize <= max_bytes and not plan.axis_aligned:
+            slabs = map_slabs(plan.slab_indices, self.slabs(), workers)
+            self.indices = np.concatenate(slabs) if slabs else np.zeros((0, N, N), dtype=np.int32)
+        # bytes held, for size limited caches.
+        self.nbytes = 0 if self.indices is None else self.indices.nbytes
+
+    def slabs(self):
+        N = self.side
+        return [(start, min(start + self.slab_planes, N)) for start in range(0, N, self.slab_planes)]
+
+    def slab_indices(self, start, end):
+        if self.indices is not None:
+            return self.indices[start:end]
+        return self.plan.slab_indices(start, end)
+
+    def rotate(self, volumes, workers=None):
+        "Rotated copies of the volumes (each of the grid shape, maybe with extra axes); None entries stay None."
+        if workers is None:
+            workers = self.workers
+        N = self.side
+        shape = self.plan.volume_shape
+        sources = []
+        results = []
+        for volume in volumes:
+            if volume is None:
+                sources.append(None)
+                results.append(None)
+                continue
+            assert volume.shape[:3] == shape, "volume shape does not match the grid: " + repr([volume.shape, shape])
+            sources.append(volume.reshape((-1,) + volume.shape[3:]))
+            results.append(np.zeros((N, N, N) + volume.shape[3:], dtype=volume.dtype))
+        if self.plan.axis_aligned:
+            # no resampling: copy the transposed and flipped volumes into place.
+            for (volume, result) in zip(volumes, results):
+                if volume is not None:
+                    (view, start) = self.plan.axis_view(volume)
+                    result[tuple(slice(s, s + n) for (s, n) in zip(start, view.shape[:3]))] = view
+            return results
+        def rotate_slab(start, end):
+            indices = self.slab_indices(start, end)
+            missing = indices < 0
+            for (source, result) in zip(sources, results):
+                if source is not None and source.size:
+                    slab = result[start:end]
+                    # clip (not raise) so take writes to the result directly; missing voxels are zeroed after.
+                    source.take(indices, axis=0, out=slab, mode="clip")
+                    slab[missing] = 0
+        map_slabs(rotate_slab, self.slabs(), workers)
+        return results
+
+def gather(volume, sources, valid):
+    "Values of volume at the source indices, zero where not valid."
+    values = volume[sources]
+    if values.ndim > valid.ndim:
+        mask = valid.reshape(valid.shape + (1,) * (values.ndim - valid.ndim))
+    else:
+        mask = valid
+    return np.where(mask, values, 0)
+
+def last_nonzero(slab, start, accumulated, depth):
+    "Update accumulated with the last (deepest) nonzero value along axis 0 of the slab, recording its plane."
+    nonzero = slab > 0
+    found = nonzero.any(axis=0)
+    planes = slab.shape[0]
+    last = planes - 1 - np.argmax(nonzero[::-1], axis=0)
+    values = np.take_along_axis(slab, last.reshape((1,) + last.shape), axis=0)[0]
+    accumulated[found] = values[found]
+    if depth is not None:
+        depth[found] = (start + last)[found]
+
+class Projection:
+
+    """
+    2d projections of a rotated label and image volume pair, cropped to the nonzero image region
+    as ImageAndLabels2d.trim_black_borders would crop the rotated volumes.
+    """
+
+    def __init__(self, image2d, labels2d, depth, restricted_labels2d, speckled_labels2d, label_bits, maxlabel, crop=None):
+        self.image2d = image2d
+        self.labels2d = labels2d
+        self.depth = depth
+        self.restricted_labels2d = restricted_labels2d
+        self.speckled_labels2d = speckled_labels2d
+        self.label_bits = label_bits
+        self.maxlabel = maxlabel
+        # (row slice, column slice) of the rotated planes kept
+        self.crop = crop
+        # bytes held, for size limited caches.
+        arrays = [image2d, labels2d, depth, restricted_labels2d, speckled_labels2d, label_bits.bits]
+        self.nbytes = sum(array.nbytes for array in arrays if array is not None)
+
+def project_volumes(
+    label_volume,
+    image_volume,
+    theta,
+    phi,
+    gamma=0,
+    selected_labels=(),
+    mask=False,
+    restricted=False,
+    speckle_ratio=None,
+    slab_planes=SLAB_PLANES,
+    ):
+    """
+    Project rotated volumes without rotating them.  Returns a Projection with
+    - image2d: the maximum value projection of the image (only where there are labels if mask is set,
+      or only where there are selected labels if restricted is set and labels are selected),
+    - labels2d: the front-most (last along the projection axis) label image, like operations3d.extrude0,
+    - depth: the rotated plane of the front-most label (-1 if none),
+    - restricted_labels2d: the front-most selected label image (if labels are selected),
+    - speckled_labels2d: front-most label of a random speckle_ratio fraction of the (restricted) labels,
+    - label_bits: per pixel bitsets of the selected labels present along each ray, for label outlines.
+    """
+    assert label_volume.shape[:3] == image_volume.shape[:3], "volume shapes differ: " + repr(
+        [label_volume.shape, image_volume.shape])
+    plan = RotationPlan(label_volume.shape, theta, phi, gamma)
+    N = plan.side
+    if plan.axis_aligned:
+        # project views of the volumes directly along their first axis, skipping the zero padding.
+        (label_view, origin) = plan.axis_view(label_volume)
+        (image_view, origin) = plan.axis_view(image_volume)
+        region = label_view.shape[1:3]
+        def slabs():
+            planes = label_view.shape[0]
+            for start in range(0, planes, slab_planes):
+                end = min(start + slab_planes, planes)
+                yield (origin[0] + start, label_view[start:end], image_view[start:end])
+    else:
+        origin = (0, 0, 0)
+        region = (N, N)
+        def slabs():
+            for start in range(0, N, slab_planes):
+                end = min(start + slab_planes, N)
+                (sources, valid) = plan.slab_sources(start, end)
+                if valid.any():
+                    yield (start, gather(label_volume, sources, valid), gather(image_volume, sources, valid))
+    maxlabel = int(label_volume.max()) if label_volume.size else 0
+    selected = label_outlines.LabelBits(selected_labels, maxlabel)
+    nontrivial = len(selected_labels) > 0
+    restrict = restricted and nontrivial
+    mapper = None
+    if nontrivial:
+        mapper = np.zeros((max(maxlabel, max(selected_labels)) + 1,), dtype=np.int64)
+        for label in selected_labels:
+            mapper[label] = label
+    channels = image_volume.shape[3:]
+    image2d = np.zeros(region + channels, dtype=image_volume.dtype)
+    image_nonzero = np.zeros(region, dtype=bool)
+    labels2d = np.zeros(region, dtype=label_volume.dtype)
+    depth = np.full(region, -1, dtype=np.int64)
+    restricted_labels2d = np.zeros(region, dtype=np.int64) if nontrivial else None
+    speckled_labels2d = np.zeros(region, dtype=np.int64) if speckle_ratio is not None else None
+    for (start, labels, image) in slabs():
+        nonzero = (image != 0)
+        if channels:
+            nonzero = nonzero.reshape(nonzero.shape[:3] + (-1,)).any(axis=3)
+        image_nonzero |= nonzero.any(axis=0)
+        restricted_labels = None
+        if nontrivial:
+            restricted_labels = mapper[labels]
+            last_nonzero(restricted_labels, start, restricted_labels2d, None)
+            selected.add_planes(labels)
+        if restrict:
+            test = restricted_labels
+        elif mask or restricted:
+            test = labels
+        else:
+            test = None
+        if test is not None:
+            if channels:
+                test = test.reshape(test.shape + (1,) * len(channels))
+            image = np.where(test > 0, image, 0)
+        np.maximum(image2d, image.max(axis=0), out=image2d)
+        last_nonzero(labels, start, labels2d, depth)
+        if speckled_labels2d is not None:
+            speckle_source = restricted_labels if restrict else labels
+            keep = np.random.random(speckle_source.shape) < speckle_ratio
+            last_nonzero(np.where(keep, speckle_source, 0), start, speckled_labels2d, None)
+    if region != (N, N):
+        # place the projected region in the rotation buffer planes.
+        window = (slice(origin[1], origin[1] + region[0]), slice(origin[2], origin[2] + region[1]))
+        def embedded(array, fill=0):
+            if array is None:
+                return None
+            result = np.full((N, N) + array.shape[2:], fill, dtype=array.dtype)
+            result[window] = array
+            return result
+        image2d = embedded(image2d)
+        image_nonzero = embedded(image_nonzero)
+        labels2d = embedded(labels2d)
+        depth = embedded(depth, -1)
+        restricted_labels2d = embedded(restricted_labels2d)
+        speckled_labels2d = embedded(speckled_labels2d)
+        if selected.bits is not None:
+            bits = np.zeros((selected.nwords, N, N), dtype=selected.bits.dtype)
+            bits[(slice(None),) + window] = selected.bits
+            selected.bits = bits
+    # crop to the nonzero image region like trim_black_borders.
+    (rows,) = np.nonzero(image_nonzero.any(axis=1))
+    (columns,) = np.nonzero(image_nonzero.any(axis=0))
+    if len(rows) == 0:
+        crop = (slice(0, 0), slice(0, 0))
+    else:
+        crop = (slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1))
+    def cropped(array):
+        if array is None:
+            return None
+        # copies, so the full size buffers are released.
+        return array[crop].copy()
+    return Projection(
+        image2d=cropped(image2d),
+        labels2d=cropped(labels2d),
+        depth=cropped(depth),
+        restricted_labels2d=cropped(restricted_labels2d),
+        speckled_labels2d=cropped(speckled_labels2d),
+        label_bits=selected.cropped(crop),
+        maxlabel=maxlabel,
+        crop=crop,
+    )
+
+def project_outlines(label_volume, theta, phi, gamma, selected_labels, crop, maxlabel=None, label_boxes=None):
+    """
+    The label_bits of project_volumes for the selected labels, without projecting the volumes,
+    where crop is the crop of a Projection of the volume at the same rotation.
+    Only the voxels of the selected labels are visited: they are mapped forward to their
+    rotated positions.  label_boxes (from label_index.label_boxes) limits the search for them.
+    """
+    if maxlabel is None:
+        maxlabel = int(label_volume.max()) if label_volume.size else 0
+    selected = label_outlines.LabelBits(selected_labels, maxlabel)
+    (rows, columns) = crop
+    (height, width) = (rows.stop - rows.start, columns.stop - columns.start)
+    if not selected.labels or height <= 0 or width <= 0:
+        return selected
+    plan = RotationPlan(label_volume.shape, theta, phi, gamma)
+    bits = np.zeros((selected.nwords, height, width), dtype=np.uint64)
+    for (position, label) in enumerate(selected.labels):
+        offset = np.zeros((3,), dtype=int)
+        region = label_volume
+        if label_boxes is not None:
+            box = label_boxes.get(label)
+            if box is None:
+                continue
+            offset = box[:, 0]
+            region = label_volume[tuple(slice(start, end) for (start, end) in box)]
+        coordinates = [c.astype(np.int32) + o for (c, o) in zip(np.nonzero(region == label), offset)]
+        ((i, j, k), valid) = plan.rotated_positions(coordinates)
+        j = j[valid] - rows.start
+        k = k[valid] - columns.start
+        inside = (j >= 0) & (j < height) & (k >= 0) & (k < width)
+        bits[position // 64, j[inside], k[inside]] |= np.uint64(1) << np.uint64(position % 64)
+    selected.bits = bits
+    return selected
@@ -0,0 +1,86 @@
+
+"""
+Rendering off the gizmo event loop.
+
+Volume loading, rotation and colorizing run in a worker thread so the controls stay responsive.
+Requests which arrive while a render is running are coalesced: only the latest one runs next,
+and the result of a render superseded by a newer request is dropped instead of being shown
+(callers carry any state the dropped result should still apply over to the next shown result).
+Gizmo updates must happen on the event loop, so results are shown there.
+"""
+
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class RenderScheduler:
+
+    "Run render jobs one at a time in a worker thread, showing only the results of the latest request."
+
+    def __init__(self):
+        self.executor = None
+        self.loop = None
+        self.generation = 0
+        self.running = False
+        self.pending = None
+        self.on_error = None
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        return self.executor
+
+    def running_loop(self):
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def submit(self, render, show):
+        """
+        Call render() in the worker thread and then show(result) on the event loop,
+        unless another request is submitted first.  Without a running event loop
+        (in scripts and tests) both run immediately.
+        """
+        loop = self.running_loop()
+        if loop is None:
+            return show(render())
+        self.loop = loop
+        self.generation += 1
+        request = (self.generation, render, show)
+        if self.running:
+            # replaces any older request still waiting.
+            self.pending = request
+        else:
+            self.start(request)
+
+    def start(self, request):
+        (generation, render, show) = request
+        self.running = True
+        future = self.loop.run_in_executor(self.get_executor(), render)
+        future.add_done_callback(lambda future: self.finished(future, generation, show))
+
+    def finished(self, future, generation, show):
+        # called on the event loop.
+        self.running = False
+        pending = self.pending
+        self.pending = None
+        if pending is not None:
+            # a newer request arrived: skip showing this result.
+            return self.start(pending)
+        if generation != self.generation or future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            traceback.print_exception(type(exception), exception, exception.__traceback__)
+            if self.on_error is not None:
+                self.on_error("render failed: " + repr(exception))
+            return
+        show(future.result())
+
+    def call_in_loop(self, function, *args):
+        "Call function(*args) now if on the event loop (or there is none), otherwise soon on the loop."
+        loop = self.loop
+        if loop is None or not loop.is_running() or self.running_loop() is loop:
+            return function(*args)
+        loop.call_soon_threadsafe(function, *args)
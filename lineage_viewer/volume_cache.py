@@ -0,0 +1,238 @@
+
+"""
+Shared, size limited caching for volumes with background prefetching.
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DEFAULT_CACHE_BYTES = 4 * 2 ** 30
+DEFAULT_PREFETCH_RADIUS = 2
+DEFAULT_PREFETCH_WORKERS = 2
+
+# marker for "not in cache" (None is a legitimate cached value meaning "no data").
+MISSING = object()
+
+def value_bytes(value):
+    "Approximate number of resident bytes held by a cached value."
+    if value is None:
+        return 0
+    if isinstance(value, (tuple, list)):
+        return sum(value_bytes(v) for v in value)
+    if isinstance(value, np.ndarray):
+        # a view keeps the whole array it was sliced from alive.
+        root = value
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if isinstance(root, np.memmap):
+            # memory mapped file pages are managed by the operating system.
+            return 0
+        return int(max(value.nbytes, root.nbytes))
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is None:
+        return 0
+    return int(nbytes)
+
+class ByteLimitedLRU:
+
+    """
+    Thread safe least recently used mapping limited by the total size of the values
+    (and optionally by the number of entries, for values which hold little memory but are many).
+    """
+
+    def __init__(self, max_bytes, sizer=value_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizer = sizer
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.key_to_size = {}
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entries = self.entries
+            if key in entries:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizer(value)
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = value
+            self.key_to_size[key] = size
+            self.total_bytes += size
+            self.evict()
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.total_bytes -= self.key_to_size.pop(key)
+
+    def evict(self):
+        "Drop least recently used entries until under budget (always keep the newest entry)."
+        max_entries = self.max_entries
+        with self.lock:
+            entries = self.entries
+            while len(entries) > 1 and (
+                self.total_bytes > self.max_bytes or (max_entries is not None and len(entries) > max_entries)):
+                (key, value) = entries.popitem(last=False)
+                self.total_bytes -= self.key_to_size.pop(key)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def summary(self):
+        return dict(
+            entries=len(self.entries),
+            total_bytes=self.total_bytes,
+            max_bytes=self.max_bytes,
+            max_entries=self.max_entries,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+class VolumeCache:
+
+    """
+    Volumes indexed by (kind, ordinal) shared by all displays of a forest.
+    Neighbouring ordinals may be loaded in background threads before they are requested.
+    """
+
+    def __init__(
+        self,
+        max_bytes=DEFAULT_CACHE_BYTES,
+        prefetch_radius=DEFAULT_PREFETCH_RADIUS,
+        workers=DEFAULT_PREFETCH_WORKERS,
+    ):
+        self.lru = ByteLimitedLRU(max_bytes)
+        self.prefetch_radius = prefetch_radius
+        self.workers = workers
+        self.lock = threading.Lock()
+        # key --> Future for loads in progress, in the foreground (get) or background (prefetch).
+        self.pending = {}
+        # bumped by discard: loads started before an invalidation are not cached.
+        self.generation = 0
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="volume_prefetch")
+        return self.executor
+
+    def start_load(self, key):
+        """
+        Register a load for key (the caller holds the lock).
+        Return (future, generation, started) where started is False if a load is already in progress.
+        """
+        future = self.pending.get(key)
+        if future is not None:
+            return (future, self.generation, False)
+        future = Future()
+        self.pending[key] = future
+        return (future, self.generation, True)
+
+    def load(self, key, loader, future, generation):
+        "Run the loader for a registered future and cache the result if nothing was invalidated meanwhile."
+        (kind, ordinal) = key
+        try:
+            value = loader(ordinal)
+        except BaseException as e:
+            with self.lock:
+                self.finish_load(key, future)
+            future.set_exception(e)
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.lru.put(key, value)
+            self.finish_load(key, future)
+        future.set_result(value)
+
+    def finish_load(self, key, future):
+        # discard may already have replaced or dropped the entry.
+        if self.pending.get(key) is future:
+            del self.pending[key]
+
+    def get(self, kind, ordinal, loader):
+        "Get the volume from cache, a load in progress, or the loader (in that order)."
+        key = (kind, ordinal)
+        result = self.lru.get(key)
+        if result is not MISSING:
+            return result
+        with self.lock:
+            # a load may have completed since the check above.
+            result = self.lru.get(key)
+            if result is not MISSING:
+                return result
+            (future, generation, started) = self.start_load(key)
+        if started:
+            # load here; prefetches and other readers of this key wait for the same future.
+            self.load(key, loader, future, generation)
+        return future.result()
+
+    def prefetch(self, kind, ordinal, loader):
+        "Start loading the volume in a background thread if it is not cached or loading."
+        key = (kind, ordinal)
+        if key in self.lru:
+            return None
+        with self.lock:
+            (future, generation, started) = self.start_load(key)
+            if started:
+                self.get_executor().submit(self.load, key, loader, future, generation)
+        return future
+
+    def neighbour_ordinals(self, ordinal, available=None):
+        "Ordinals within the prefetch radius, nearest (and later) first."
+        radius = self.prefetch_radius
+        # the parent display shows ordinal - 1, so the window extends one further back.
+        candidates = range(ordinal - radius - 1, ordinal + radius + 1)
+        result = sorted(candidates, key=lambda o: (abs(o - ordinal), -o))
+        if available is not None:
+            result = [o for o in result if o in available]
+        return result
+
+    def discard(self, kind=None, ordinal=None):
+        """
+        Drop cached entries matching kind and/or ordinal (all entries if both are None).
+        Loads in progress for matching keys are forgotten and no load started before now is cached.
+        """
+        def matches(key):
+            (k, o) = key
+            return (kind is None or kind == k) and (ordinal is None or ordinal == o)
+        with self.lock:
+            self.generation += 1
+            for key in list(self.pending.keys()):
+                if matches(key):
+                    del self.pending[key]
+            for key in self.lru.keys():
+                if matches(key):
+                    self.lru.discard(key)
+
+    def summary(self):
+        result = self.lru.summary()
+        with self.lock:
+            result["pending"] = len(self.pending)
+        return result
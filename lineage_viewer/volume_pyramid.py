@@ -0,0 +1,134 @@
+
+"""
+Multi resolution pyramids of label and image volumes for the coarse strides.
+
+Subsampling a volume with volume[::stride, ::stride, ::stride] aliases: small cells between the
+sampled planes vanish.  Here each level halves the previous level: image intensities are
+averaged over 2x2x2 blocks, so small bright cells still contribute, and each label block
+takes its most frequent label, preferring a cell over background on ties, so cells keep
+their volume without swelling and hiding their neighbours in projections.
+Level f has the shape of volume[::f, ::f, ::f] and voxel [i, j, k] covers the full
+resolution voxels [f*i: f*(i+1), f*j: f*(j+1), f*k: f*(k+1)].
+
+Levels are built in a background thread and kept with the loaded volumes.
+The pyramid holds only the coarse levels: the display holding it has the full resolution volumes.
+"""
+
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# output planes of label blocks processed together (memory is 64 bytes per block).
+CHUNK_PLANES = 8
+
+def even_padded(volume):
+    "The volume padded to even lengths along the first 3 axes by repeating the last plane."
+    padding = [(0, n % 2) for n in volume.shape[:3]]
+    if not any(after for (before, after) in padding):
+        return volume
+    padding += [(0, 0)] * (volume.ndim - 3)
+    return np.pad(volume, padding, mode="edge")
+
+def downsample_image(volume):
+    "Halve the first 3 axes of an intensity volume, averaging 2x2x2 blocks."
+    padded = even_padded(volume)
+    (I, J, K) = padded.shape[:3]
+    channels = padded.shape[3:]
+    blocks = padded.reshape((I // 2, 2, J // 2, 2, K // 2, 2) + channels)
+    mean = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    if np.issubdtype(volume.dtype, np.integer):
+        np.rint(mean, out=mean)
+    return mean.astype(volume.dtype)
+
+def block_modes(blocks):
+    "Most frequent value in each row of blocks: on ties nonzero values win, then the smallest."
+    ordered = np.sort(blocks, axis=1)
+    counts = (ordered[:, :, None] == ordered[:, None, :]).sum(axis=2)
+    score = 2 * counts + (ordered != 0)
+    best = np.argmax(score, axis=1)
+    return ordered[np.arange(len(ordered)), best]
+
+def downsample_labels(volume, chunk_planes=CHUNK_PLANES):
+    "Halve the axes of a label volume, keeping the most frequent label of each 2x2x2 block."
+    padded = even_padded(volume)
+    (I, J, K) = (n // 2 for n in padded.shape)
+    result = np.zeros((I, J, K), dtype=volume.dtype)
+    for start in range(0, I, chunk_planes):
+        end = min(start + chunk_planes, I)
+        chunk = padded[2 * start: 2 * end]
+        blocks = chunk.reshape((end - start, 2, J, 2, K, 2)).transpose((0, 2, 4, 1, 3, 5))
+        result[start:end] = block_modes(blocks.reshape((-1, 8))).reshape((end - start, J, K))
+    return result
+
+def level_slicing(slicing, factor):
+    "Full resolution (3, 2) [start, end) slicing converted to the level downsampled by factor."
+    slicing = np.asarray(slicing, dtype=np.int64)
+    result = np.zeros((3, 2), dtype=np.int64)
+    result[:, 0] = slicing[:, 0] // factor
+    result[:, 1] = -(-slicing[:, 1] // factor)
+    return result
+
+executor = None
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pyramid")
+    return executor
+
+class VolumePyramid:
+
+    "Label and image volumes downsampled by powers of 2 (the coarse levels only)."
+
+    def __init__(self, label_volume, image_volume, factors=(2, 4, 8)):
+        self.factors = sorted(f for f in factors if f > 1)
+        self.lock = threading.Lock()
+        # the full resolution volumes, only until the levels are built.
+        self.source = (label_volume, image_volume)
+        self.levels = {}
+        self.future = None
+        # bytes of the coarse levels once built, for size limited caches.
+        full_bytes = label_volume.nbytes + image_volume.nbytes
+        self.nbytes = int(sum(full_bytes / f ** 3 for f in self.factors))
+
+    def build(self):
+        "Build all levels, each from the previous one."
+        previous = 1
+        with self.lock:
+            volumes = self.source
+        for factor in self.factors:
+            with self.lock:
+                built = self.levels.get(factor)
+            if built is None:
+                assert factor % previous == 0 and factor // previous == 2, "factors must double: " + repr(self.factors)
+                (labels, image) = volumes
+                built = (downsample_labels(labels), downsample_image(image))
+                for array in built:
+                    array.flags.writeable = False
+                with self.lock:
+                    self.levels[factor] = built
+            volumes = built
+            previous = factor
+        with self.lock:
+            self.source = None
+
+    def build_in_background(self):
+        if self.future is None:
+            self.future = get_executor().submit(self.build)
+        return self.future
+
+    def level(self, stride, wait=False):
+        """
+        Factor of the coarsest built level to view at the stride (a factor dividing the stride),
+        optionally waiting for the level for the stride to be built.
+        """
+        if wait and stride in self.factors:
+            self.build_in_background().result()
+        with self.lock:
+            built = [f for f in self.levels if stride % f == 0]
+        return max(built + [1])
+
+    def volumes(self, factor):
+        "(label volume, image volume) of a built coarse level."
+        with self.lock:
+            return self.levels[factor]
@@ -0,0 +1,192 @@
+
+"""
+Memory mapped on disk storage for timestamp volumes.
+
+A store is a folder containing one raw .npy file per (kind, ordinal) and an
+index.json describing the shapes, dtypes and positive label bounding boxes.
+Arrays are opened with numpy memory mapping so slicing only reads the bytes needed.
+
+Convert a folder of KLB or TIFF volumes once using the command line, for example:
+
+    python -m lineage_viewer.volume_store \\
+        --labels "labels/klbOut_Cam_Long_%(ordinal)05d.crop_cp_masks.klb" \\
+        --images "images/klbOut_Cam_Long_%(ordinal)05d.crop.klb" \\
+        --first 0 --last 200 \\
+        volume_store_folder
+"""
+
+import os
+import json
+import numpy as np
+from array_gizmos import operations3d
+
+INDEX_FILENAME = "index.json"
+KINDS = ("labels", "image")
+
+def volume_filename(kind, ordinal):
+    return "%s_%05d.npy" % (kind, ordinal)
+
+def label_bounding_box(label_volume):
+    "Slicing of the minimal box containing all positive labels (or None if there are none)."
+    if not np.any(label_volume > 0):
+        return None
+    return operations3d.positive_slicing(label_volume)
+
+class VolumeStore:
+
+    "Read access to a converted volume store folder."
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, INDEX_FILENAME)
+        self.index = self.read_index()
+
+    def read_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+        else:
+            index = {}
+        for kind in KINDS:
+            index.setdefault(kind, {})
+        return index
+
+    def write_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def entry(self, kind, ordinal):
+        return self.index[kind].get(str(ordinal))
+
+    def ordinals(self, kind="labels"):
+        return sorted(int(o) for o in self.index[kind].keys())
+
+    def load(self, kind, ordinal):
+        "Memory mapped array for kind and ordinal, or None if not stored."
+        entry = self.entry(kind, ordinal)
+        if entry is None:
+            return None
+        path = os.path.join(self.folder, entry["file"])
+        return np.load(path, mmap_mode="r")
+
+    def load_labels(self, ordinal):
+        return self.load("labels", ordinal)
+
+    def load_image(self, ordinal):
+        return self.load("image", ordinal)
+
+    def positive_slicing(self, ordinal):
+        "Precomputed positive label bounding box for the ordinal as a (3,2) array, or None."
+        entry = self.entry("labels", ordinal)
+        if entry is None:
+            return None
+        box = entry.get("positive_slicing")
+        if box is None:
+            return None
+        return np.array(box, dtype=int)
+
+    def store(self, kind, ordinal, volume):
+        "Write the volume for kind and ordinal and record it in the (unsaved) index."
+        volume = np.ascontiguousarray(volume)
+        filename = volume_filename(kind, ordinal)
+        np.save(os.path.join(self.folder, filename), volume)
+        entry = dict(
+            file=filename,
+            shape=list(volume.shape),
+            dtype=volume.dtype.str,
+        )
+        if kind == "labels":
+            box = label_bounding_box(volume)
+            if box is not None:
+                box = box.tolist()
+            entry["positive_slicing"] = box
+        self.index[kind][str(ordinal)] = entry
+        return entry
+
+def convert_volumes(folder, ordinals, label_loader, image_loader=None, overwrite=False, verbose=True):
+    """
+    Convert volumes produced by the loader functions for the ordinals into a store in folder.
+    The index is saved after each ordinal so an interrupted conversion can be resumed.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    store = VolumeStore(folder)
+    loaders = [("labels", label_loader), ("image", image_loader)]
+    for ordinal in ordinals:
+        for (kind, loader) in loaders:
+            if loader is None:
+                continue
+            if not overwrite and store.entry(kind, ordinal) is not None:
+                continue
+            volume = loader(ordinal)
+            if volume is None:
+                if verbose:
+                    print("no %s volume for ordinal %s" % (kind, ordinal))
+                continue
+            entry = store.store(kind, ordinal, volume)
+            store.write_index()
+            if verbose:
+                print("stored", kind, ordinal, entry["shape"], entry["dtype"])
+    return store
+
+def convert_forest_volumes(forest, folder, ordinals=None, overwrite=False, verbose=True):
+    "Convert the volumes for the forest timestamps using the loaders attached to the forest."
+    if ordinals is None:
+        ordinals = sorted(forest.ordinal_to_timestamp.keys())
+    return convert_volumes(
+        folder,
+        ordinals,
+        forest.label_volume_loader,
+        forest.image_volume_loader,
+        overwrite=overwrite,
+        verbose=verbose,
+    )
+
+def read_volume_file(path):
+    "Read a KLB or TIFF volume file based on the file extension."
+    lower = path.lower()
+    if lower.endswith(".klb"):
+        import pyklb
+        return pyklb.readfull(path)
+    if lower.endswith(".tif") or lower.endswith(".tiff"):
+        from mouse_embryo_labeller import tools
+        return tools.load_tiff_array(path)
+    if lower.endswith(".npy"):
+        return np.load(path)
+    raise ValueError("unknown volume file type: " + repr(path))
+
+def pattern_loader(pattern):
+    "Loader function for a file pattern like 'label_%(ordinal)d.tif' (None for missing files)."
+    def loader(ordinal):
+        path = pattern % {"ordinal": ordinal}
+        if os.path.exists(path):
+            return read_volume_file(path)
+        return None
+    return loader
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert per-timestamp KLB/TIFF volumes into a memory mapped volume store.")
+    parser.add_argument("folder", help="output store folder")
+    parser.add_argument("--labels", required=True, help="label file pattern, eg 'label_reg8_%%(ordinal)d.tif'")
+    parser.add_argument("--images", default=None, help="image file pattern, eg 'nuclei_reg8_%%(ordinal)d.tif'")
+    parser.add_argument("--first", type=int, default=0, help="first ordinal")
+    parser.add_argument("--last", type=int, required=True, help="last ordinal (inclusive)")
+    parser.add_argument("--overwrite", action="store_true", help="replace volumes already in the store")
+    args = parser.parse_args(argv)
+    image_loader = None
+    if args.images:
+        image_loader = pattern_loader(args.images)
+    convert_volumes(
+        args.folder,
+        range(args.first, args.last + 1),
+        pattern_loader(args.labels),
+        image_loader,
+        overwrite=args.overwrite,
+    )
+
+if __name__ == "__main__":
+    main()
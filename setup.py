@@ -6,7 +6,7 @@ readme = open('README.md').read()
 
 setup(
     name="lineage_viewer",
-    packages=["lineage_viewer"],
+    packages=["lineage_viewer", "lineage_viewer.benchmarks"],
     version=version,
     description="Graphical interface for editing a lineage and viewing related microscopy images.",
     long_description=readme,
@@ -0,0 +1,104 @@
+"""
+Streaming graph reader against make_forest_from_haydens_json_graph, and the graph dump writer.
+"""
+
+import json
+import os
+from lineage_viewer import graph_stream
+from lineage_viewer import lineage_forest
+from lineage_viewer import lineage_files
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), "..", "examples", "Combined.json")
+
+
+def parent_map(forest):
+    return {
+        node_id: (node.timestamp_ordinal, node.label, None if node.parent is None else node.parent.node_id)
+        for (node_id, node) in forest.id_to_node.items()
+    }
+
+
+def check_same_forest(path, chunk_bytes=graph_stream.CHUNK_BYTES):
+    with open(path) as f:
+        expected = lineage_forest.make_forest_from_haydens_json_graph(json.load(f))
+    streamed = graph_stream.make_forest_from_haydens_json_file(path, chunk_bytes=chunk_bytes)
+    assert parent_map(streamed) == parent_map(expected)
+
+
+def test_example_graph():
+    check_same_forest(EXAMPLE)
+    check_same_forest(EXAMPLE, chunk_bytes=1000)
+
+
+def test_last_of_several_graphs(tmp_path):
+    graphs = {
+        "G_raw": {
+            "Edges": [{"EndNodes": ["001_001", "002_001"]}],
+            "Nodes": [{"Name": "001_001"}, {"Name": "002_001"}],
+        },
+        "G_corrected": {
+            "Nodes": [{"Name": "001_002"}],
+            "Edges": [{"EndNodes": ["001_002", "002_002"]}],
+        },
+    }
+    path = str(tmp_path / "graphs.json")
+    with open(path, "w") as f:
+        json.dump(graphs, f)
+    check_same_forest(path)
+    check_same_forest(path, chunk_bytes=7)
+    streamed = graph_stream.make_forest_from_haydens_json_file(path)
+    assert sorted(streamed.id_to_node) == ["001_002", "002_002"]
+
+
+def example_forest():
+    with open(EXAMPLE) as f:
+        return lineage_forest.make_forest_from_haydens_json_graph(json.load(f))
+
+
+def test_save_and_load_round_trip(tmp_path):
+    forest = example_forest()
+    path = str(tmp_path / "saved.json")
+    graph_stream.save_haydens_json_file(forest, path, chunk_rows=100)
+    with open(path) as f:
+        json_graph = json.load(f)
+    assert list(json_graph) == [graph_stream.GRAPH_NAME]
+    assert len(json_graph[graph_stream.GRAPH_NAME]["Nodes"]) == len(forest.id_to_node)
+    expected = parent_map(forest)
+    assert parent_map(lineage_forest.make_forest_from_haydens_json_graph(json_graph)) == expected
+    assert parent_map(graph_stream.make_forest_from_haydens_json_file(path, chunk_bytes=1000)) == expected
+    # saving the reloaded forest writes the same file
+    again = str(tmp_path / "again.json")
+    graph_stream.save_haydens_json_file(graph_stream.make_forest_from_haydens_json_file(path), again)
+    graph_stream.save_haydens_json_file(graph_stream.make_forest_from_haydens_json_file(again), path)
+    with open(path) as f, open(again) as g:
+        assert f.read() == g.read()
+
+
+def test_compact_file_to_graph_dump(tmp_path):
+    npz_path = str(tmp_path / "example.npz")
+    json_path = str(tmp_path / "example.json")
+    lineage_files.main([EXAMPLE, npz_path, "--haydens"])
+    lineage_files.main([npz_path, json_path, "--haydens"])
+    loaded = graph_stream.make_forest_from_haydens_json_file(json_path)
+    assert parent_map(loaded) == parent_map(example_forest())
+
+
+def test_empty_and_unlinked_forests(tmp_path):
+    path = str(tmp_path / "nodes.json")
+    forest = lineage_forest.Forest()
+    forest.add_node("001_001", 1, 1)
+    forest.add_node("002_003", 2, 3)
+    graph_stream.save_haydens_json_file(forest, path)
+    with open(path) as f:
+        assert json.load(f) == {graph_stream.GRAPH_NAME: {
+            "Edges": [], "Nodes": [{"Name": "001_001"}, {"Name": "002_003"}]}}
+    assert parent_map(graph_stream.make_forest_from_haydens_json_file(path)) == parent_map(forest)
+
+
+def test_assigned_labels_are_not_stored(tmp_path, capsys):
+    path = str(tmp_path / "assigned.json")
+    forest = lineage_forest.Forest()
+    forest.add_node("001_001", 1, 7)
+    graph_stream.save_haydens_json_file(forest, path)
+    assert "1 nodes" in capsys.readouterr().out
+    assert graph_stream.make_forest_from_haydens_json_file(path).id_to_node["001_001"].label == 1
@@ -0,0 +1,44 @@
+"""
+Block reductions of arrays sent at display size.
+"""
+
+import numpy as np
+from lineage_viewer import image_transport
+
+
+def test_mean_reduction_averages_blocks():
+    array = np.arange(36, dtype=np.uint8).reshape((6, 6))
+    reduced = image_transport.reduce_array(array, 3, "mean")
+    expected = array.reshape((2, 3, 2, 3)).mean(axis=(1, 3))
+    assert reduced.dtype == np.uint8
+    assert np.array_equal(reduced, np.rint(expected))
+
+
+def test_max_reduction_keeps_thin_outlines_and_colors():
+    labels = np.zeros((9, 9, 3), dtype=np.uint8)
+    labels[:, :5] = [10, 200, 30]
+    labels[4, :] = [255, 255, 255]
+    reduced = image_transport.reduce_array(labels, 3, "max")
+    assert reduced.shape == (3, 3, 3)
+    # the one pixel outline survives in every block of its row
+    assert (reduced[1] == 255).all()
+    colors = set(map(tuple, reduced.reshape((-1, 3)).tolist()))
+    assert colors <= set(map(tuple, labels.reshape((-1, 3)).tolist()))
+    # strided subsampling drops the outline
+    assert not (labels[::3, ::3] == 255).all(axis=-1).any()
+
+
+def test_mean_reduction_keeps_marked_pixels():
+    image = np.full((8, 8, 3), 100, dtype=np.uint8)
+    keep = np.zeros((8, 8), dtype=bool)
+    keep[1, 2] = True
+    image[1, 2] = [0, 250, 0]
+    reduced = image_transport.reduce_array(image, 4, "mean", keep)
+    assert reduced[0, 0].tolist() == [0, 250, 0]
+    assert reduced[1, 1].tolist() == [100, 100, 100]
+
+
+def test_ragged_edges_are_padded():
+    array = np.ones((7, 5), dtype=np.uint8)
+    assert image_transport.reduce_array(array, 2, "mean").shape == (4, 3)
+    assert image_transport.reduce_array(array, 2, "max").shape == (4, 3)
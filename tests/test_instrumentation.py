@@ -0,0 +1,64 @@
+"""
+Interaction tagging and memory measurement of instrumented stages.
+"""
+
+import threading
+from lineage_viewer import instrumentation
+
+
+def test_stages_outside_interactions_have_none():
+    recorder = instrumentation.Recorder()
+    recorder.enable()
+    with recorder.stage("before"):
+        pass
+    number = recorder.begin_interaction("click")
+    with recorder.stage("during"):
+        pass
+    recorder.end_interaction(number)
+    with recorder.stage("after"):
+        pass
+    interactions = {record["name"]: record["interaction"] for record in recorder.records}
+    assert interactions == dict(before=None, during=number, after=None)
+    summary = recorder.summary()
+    assert summary["interaction"] == number
+    assert [total["name"] for total in summary["stages"]] == ["during"]
+
+
+def test_end_of_superseded_interaction_keeps_current():
+    recorder = instrumentation.Recorder()
+    recorder.enable()
+    first = recorder.begin_interaction("first")
+    second = recorder.begin_interaction("second")
+    recorder.end_interaction(first)
+    assert recorder.interaction == second
+
+
+def test_peak_bytes_only_without_concurrent_stages():
+    recorder = instrumentation.Recorder()
+    recorder.enable(memory=True)
+    try:
+        with recorder.stage("alone"):
+            data = bytearray(10 ** 6)
+        del data
+        entered = threading.Event()
+        release = threading.Event()
+        def other_thread():
+            with recorder.stage("other"):
+                entered.set()
+                release.wait(10)
+        thread = threading.Thread(target=other_thread)
+        with recorder.stage("overlapped"):
+            thread.start()
+            entered.wait(10)
+            release.set()
+            thread.join()
+        with recorder.stage("alone again"):
+            pass
+    finally:
+        recorder.disable()
+    records = {record["name"]: record for record in recorder.records}
+    assert records["alone"]["peak_bytes"] >= 10 ** 6
+    assert "peak_bytes" in records["alone again"]
+    for name in ("overlapped", "other"):
+        assert "allocated_bytes" in records[name]
+        assert "peak_bytes" not in records[name]
@@ -0,0 +1,93 @@
+"""
+Bitset outlines against the per label boundary loop MaskImaging used before them.
+"""
+
+import numpy as np
+import pytest
+from array_gizmos import colorizers, operations3d
+from lineage_viewer import label_outlines
+from lineage_viewer import label_index
+
+
+def loop_boundaries(label_array, selected_labels):
+    "The original loop: outline each extruded label in turn, later labels drawn over earlier ones."
+    (depth, height, width) = label_array.shape
+    boundaries = np.zeros((height, width), dtype=np.int32)
+    for label in selected_labels:
+        target = (label_array == label).astype(np.ubyte)
+        projected = operations3d.extrude0(target)
+        mask = colorizers.boundary_image(projected, 1)
+        boundaries = np.choose(mask, [boundaries, label])
+    return boundaries
+
+
+def bitset_boundaries(label_array, selected_labels, boxed):
+    box = None
+    if boxed:
+        # as images_gizmos does: the union of the selected labels' boxes.
+        boxes = label_index.label_boxes(label_array)
+        box = label_index.union_box([boxes[label] for label in selected_labels if label in boxes])
+        if box is None:
+            return np.zeros(label_array.shape[1:], dtype=np.int32)
+    return label_outlines.label_boundaries(label_array, selected_labels, box)
+
+
+def small_volume():
+    "Touching labels, labels on every volume edge, a label hidden behind another and unselected neighbours."
+    labels = np.zeros((4, 9, 10), dtype=np.int32)
+    labels[:, 2:5, 2:5] = 1
+    labels[:, 2:5, 5:8] = 2  # touches 1
+    labels[1:3, 0:2, 0:10] = 3  # along the top edge
+    labels[0, 5:9, 8:10] = 4  # bottom right corner
+    labels[2:4, 3:4, 3:4] = 5  # behind label 1 along axis 0
+    labels[3, 6:9, 0:3] = 6  # bottom left corner, last plane
+    labels[:, 6:8, 4:7] = 7  # touches 2 and 4 diagonally
+    return labels
+
+
+SMALL_SELECTIONS = [
+    [1],
+    [1, 2],
+    [2, 1],
+    [3, 4, 6],
+    [5, 1],
+    [1, 5],
+    [7, 2, 4, 3],
+    [1, 2, 3, 4, 5, 6, 7],
+    [7, 6, 5, 4, 3, 2, 1],
+    [2, 9, 2],  # repeated and absent labels
+]
+
+
+@pytest.mark.parametrize("selected", SMALL_SELECTIONS)
+@pytest.mark.parametrize("boxed", [False, True])
+def test_small_volume_outlines_match_loop(selected, boxed):
+    labels = small_volume()
+    expected = loop_boundaries(labels, selected)
+    assert np.array_equal(bitset_boundaries(labels, selected, boxed), expected)
+
+
+def test_touching_and_edge_labels_are_outlined():
+    labels = small_volume()
+    boundaries = bitset_boundaries(labels, [1, 2, 3, 4], False)
+    # where 1 and 2 touch both are outlined and 2, selected later, is drawn over 1.
+    assert boundaries[4, 3] == 1 and boundaries[4, 4] == 2 and boundaries[4, 5] == 2
+    # edges are replicated: labels are not outlined along the volume edge, only towards the inside.
+    assert boundaries[0, 0] == 0 and boundaries[1, 0] == 3 and boundaries[1, 9] == 3
+    assert boundaries[8, 9] == 0 and boundaries[8, 8] == 4 and boundaries[4, 9] == 4
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("boxed", [False, True])
+def test_random_volume_outlines_match_loop(seed, boxed):
+    rng = np.random.default_rng(seed)
+    shape = (3, 12, 13)
+    # blocky labels so that labels touch and form regions, with many labels for several bitset words.
+    coarse = rng.integers(0, 90, (3, 6, 7))
+    coarse[rng.random(coarse.shape) < 0.3] = 0
+    labels = np.kron(coarse, np.ones((1, 2, 2), dtype=coarse.dtype))[:, :shape[1], :shape[2]].astype(np.int32)
+    present = [int(label) for label in np.unique(labels) if label > 0]
+    nselected = [1, 3, 10, 40, 70, len(present)][seed]
+    selected = list(rng.permutation(present)[:nselected])
+    expected = loop_boundaries(labels, selected)
+    assert np.array_equal(bitset_boundaries(labels, selected, boxed), expected)
@@ -0,0 +1,270 @@
+"""
+Incremental lineage updates against a full recomputation.
+"""
+
+import json
+import os
+import numpy as np
+import pytest
+from lineage_viewer import lineage_forest
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), "..", "examples", "Combined.json")
+
+
+def example_forest():
+    with open(EXAMPLE) as f:
+        json_graph = json.load(f)
+    forest = lineage_forest.make_forest_from_haydens_json_graph(json_graph)
+    forest.find_tracks_and_lineages()
+    forest.assign_offsets()
+    return forest
+
+
+def colors(forest):
+    return {node_id: node.color for (node_id, node) in forest.id_to_node.items()}
+
+
+def recomputed_colors(forest, lineages):
+    clone = forest.clean_clone()
+    clone.find_tracks_and_lineages()
+    if lineages:
+        clone.assign_colors_to_lineages()
+    else:
+        clone.assign_colors_to_tracks()
+    return colors(clone)
+
+
+def check_incremental_colors(edits, lineages):
+    forest = example_forest()
+    if lineages:
+        forest.assign_colors_to_lineages()
+    else:
+        forest.assign_colors_to_tracks()
+    for edit in edits:
+        before = colors(forest)
+        changes = edit(forest)
+        assert changes is not None
+        if lineages:
+            forest.assign_colors_to_tracks(id_to_collection=forest.id_to_lineage, identifiers=changes["recolor_lineage_ids"])
+        else:
+            forest.assign_colors_to_tracks(identifiers=changes["recolor_track_ids"])
+        after = colors(forest)
+        assert after == recomputed_colors(forest, lineages)
+        changed_ids = set(node.node_id for node in changes["nodes"])
+        for node_id in after:
+            if after[node_id] != before[node_id]:
+                assert node_id in changed_ids, node_id
+
+
+def disconnect_first_split(forest):
+    "Disconnect a child of the first dividing node, adding a lineage and shifting the sorted ids."
+    for node_id in sorted(forest.id_to_node):
+        node = forest.id_to_node[node_id]
+        if len(node.id_to_child) > 1:
+            child = sorted(node.id_to_child.values(), key=lambda n: n.node_id)[0]
+            return forest.disconnect(child)
+    raise AssertionError("no dividing node in example")
+
+
+def reparent_across_lineages(forest):
+    "Move a child of the last lineage root under the root of the first lineage."
+    roots = sorted(forest.id_to_lineage)
+    parent = forest.id_to_node[roots[0]]
+    child = sorted(forest.id_to_node[roots[-1]].id_to_child.values(), key=lambda n: n.node_id)[0]
+    return forest.reparent(child, parent)
+
+
+def reconnect_disconnected(forest):
+    "Attach a lineage root which is not in the first timestamp, removing the lineage."
+    roots = sorted(forest.id_to_lineage)
+    for rootid in roots:
+        child = forest.id_to_node[rootid]
+        if child.timestamp_ordinal > forest.id_to_node[roots[0]].timestamp_ordinal:
+            parent = [node for node in forest.id_to_node.values()
+                if node.timestamp_ordinal == child.timestamp_ordinal - 1 and node._lineage_root.node_id != rootid][0]
+            return forest.reparent(child, parent)
+    raise AssertionError("no lineage to reconnect")
+
+
+def layout_state(forest):
+    "Offsets, track and lineage of every node, plus the track and lineage ids."
+    nodes = {
+        node_id: (node._offset, node._track.node_id, node._lineage_root.node_id)
+        for (node_id, node) in forest.id_to_node.items()
+    }
+    return (nodes, sorted(forest.id_to_track), sorted(forest.id_to_lineage))
+
+
+def recomputed_layout_state(forest):
+    clone = forest.clean_clone()
+    clone.find_tracks_and_lineages()
+    clone.assign_offsets()
+    return layout_state(clone)
+
+
+def check_incremental_layout(edits):
+    forest = example_forest()
+    for edit in edits:
+        assert edit(forest) is not None
+        assert layout_state(forest) == recomputed_layout_state(forest)
+
+
+def test_disconnect_layout_matches_recompute():
+    check_incremental_layout([disconnect_first_split])
+
+
+def test_reparent_layout_matches_recompute():
+    check_incremental_layout([reparent_across_lineages])
+
+
+def test_reconnect_layout_matches_recompute():
+    check_incremental_layout([disconnect_first_split, reconnect_disconnected, reparent_across_lineages])
+
+
+def test_reparent_rejects_parent_in_child_subtree():
+    forest = example_forest()
+    child = [node for node in forest.id_to_node.values() if len(node.id_to_child) > 0][0]
+    descendant = list(child.id_to_child.values())[0]
+    before = layout_state(forest)
+    assert "not older" in forest.reparent_problem(child, descendant)
+    with pytest.raises(AssertionError, match="cannot reparent"):
+        forest.reparent(child, descendant)
+    # the rejected edit leaves the forest as it was
+    assert descendant.parent is child
+    assert layout_state(forest) == before
+
+
+def test_reparent_problem_finds_subtree_regardless_of_timestamps():
+    forest = example_forest()
+    child = [node for node in forest.id_to_node.values() if len(node.id_to_child) > 0][0]
+    descendant = list(child.id_to_child.values())[0]
+    # inconsistent ordinals must not let a cycle through
+    descendant.timestamp_ordinal = child.timestamp_ordinal - 1
+    assert "subtree" in forest.reparent_problem(child, descendant)
+
+
+def test_disconnect_track_colors():
+    check_incremental_colors([disconnect_first_split], lineages=False)
+
+
+def test_disconnect_lineage_colors():
+    check_incremental_colors([disconnect_first_split], lineages=True)
+
+
+def test_reparent_track_colors():
+    check_incremental_colors([reparent_across_lineages], lineages=False)
+
+
+def test_reparent_lineage_colors():
+    check_incremental_colors([reparent_across_lineages], lineages=True)
+
+
+def test_reconnect_track_colors():
+    check_incremental_colors([disconnect_first_split, reconnect_disconnected], lineages=False)
+
+
+def test_reconnect_lineage_colors():
+    check_incremental_colors([disconnect_first_split, reconnect_disconnected], lineages=True)
+
+
+def cyclic_nodes(split):
+    "Three nodes whose parent links form a cycle (set_parent refuses these, so link them directly)."
+    nodes = [lineage_forest.Node("c%s" % index, index, index) for index in range(3)]
+    for (index, node) in enumerate(nodes):
+        parent = nodes[index - 1]
+        node.parent = parent
+        parent.id_to_child[node.node_id] = node
+    if split:
+        # extra children end every track at its parent, so only the lineage walk cycles
+        for node in nodes:
+            extra = lineage_forest.Node(node.node_id + "x", 9, 9)
+            node.id_to_child[extra.node_id] = extra
+    return nodes
+
+
+def test_track_ancestor_rejects_cycles():
+    with pytest.raises(AssertionError, match="cycle"):
+        cyclic_nodes(split=False)[0].track_ancestor()
+
+
+def test_lineage_ancestor_rejects_cycles():
+    nodes = cyclic_nodes(split=True)
+    assert nodes[0].track_ancestor() is nodes[0]
+    with pytest.raises(AssertionError, match="cycle"):
+        nodes[0].lineage_ancestor()
+
+
+def test_volume_generation_follows_loaders():
+    forest = example_forest()
+    generation = forest.volume_generation
+    assert forest.clean_clone().volume_generation == generation
+    forest.use_trivial_null_loaders()
+    assert forest.volume_generation != generation
+
+
+def boxed_forest():
+    "Forest with two timestamps whose label volumes have different bounding boxes."
+    forest = lineage_forest.Forest()
+    volumes = {}
+    for (ordinal, corner) in ((1, 2), (2, 5)):
+        labels = np.zeros((10, 10, 10), dtype=np.int32)
+        labels[corner: corner + 3, corner: corner + 2, 1: 4] = 7
+        volumes[ordinal] = labels
+        forest.add_node(forest.label_node_name(ordinal, 7), ordinal, 7)
+    forest.label_volume_loader = volumes.get
+    return forest
+
+
+def test_experiment_slicing_never_scans():
+    forest = boxed_forest()
+    loads = []
+    loader = forest.label_volume_loader
+    def counted_loader(ordinal):
+        loads.append(ordinal)
+        return loader(ordinal)
+    forest.label_volume_loader = counted_loader
+    calls = []
+    ordinal_slicings = forest.ordinal_slicings
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return ordinal_slicings(*args, **kwargs)
+    forest.ordinal_slicings = counted
+    assert forest.experiment_slicing() is None
+    assert forest.label_slicing_for_timestamp(1) is None
+    # the unknown box is remembered
+    assert len(calls) == 1
+    assert loads == []
+
+
+def test_unify_slicing_saves_index_for_later_sessions(tmp_path):
+    path = str(tmp_path / "labels.json")
+    forest = boxed_forest()
+    slicing = forest.unify_slicing(processes=1, index_path=path, verbose=False)
+    assert slicing.tolist() == [[1, 8], [1, 7], [0, 4]]
+    assert forest.experiment_slicing() is slicing
+    later = boxed_forest()
+    later.label_volume_loader = None
+    later.use_label_index(path)
+    assert later.label_slicing_for_timestamp(2).tolist() == [[1, 8], [1, 7], [0, 4]]
+
+
+def test_scanned_index_invalidates_unknown_slicing(tmp_path):
+    forest = boxed_forest()
+    assert forest.experiment_slicing() is None
+    forest.use_label_index(str(tmp_path / "labels.json"))
+    forest.scan_labels(processes=1, verbose=False)
+    assert forest.experiment_slicing().tolist() == [[1, 8], [1, 7], [0, 4]]
+
+
+def test_unify_slicing_default_sidecar_next_to_label_files(tmp_path):
+    image_pattern = str(tmp_path / "image_%(ordinal)05d.klb")
+    label_pattern = str(tmp_path / "labels_%(ordinal)05d.klb")
+    forest = boxed_forest()
+    loader = forest.label_volume_loader
+    forest.load_klb_using_file_patterns(image_pattern, label_pattern)
+    forest.label_volume_loader = loader
+    forest.unify_slicing(processes=1, verbose=False)
+    assert os.path.exists(forest.default_label_index_path())
+    later = boxed_forest()
+    later.load_klb_using_file_patterns(image_pattern, label_pattern)
+    assert later.experiment_slicing().tolist() == [[1, 8], [1, 7], [0, 4]]
@@ -0,0 +1,75 @@
+"""
+Shared rotation grids and fused projections against rotating volumes with operations3d.
+"""
+
+import numpy as np
+import pytest
+from array_gizmos import operations3d
+from lineage_viewer import projection
+from lineage_viewer import label_index
+
+SHAPES = [(7, 11, 5), (10, 10, 10), (3, 20, 9), (1, 6, 6)]
+RANDOM_ANGLES = [(0.3, 0.5, 0.2), (1.2, -2.0, 3.0), (-3.1, 1.6, -0.9), (0.005, 0, 2.5)]
+QUARTER_ANGLES = [(0, 0, 0), (np.pi / 2, 0, 0), (0, -np.pi / 2, np.pi), (np.pi, np.pi / 2, -np.pi / 2)]
+
+
+def random_volume(shape, channels=(), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 50, shape + channels).astype(np.uint16)
+
+
+def rotated(volume, angles):
+    return operations3d.rotate3d(operations3d.rotation_buffer(volume), *angles)
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("angles", RANDOM_ANGLES + QUARTER_ANGLES)
+@pytest.mark.parametrize("channels", [(), (3,)])
+def test_grid_rotation_matches_rotate3d(shape, angles, channels):
+    volume = random_volume(shape, channels)
+    expected = rotated(volume, angles)
+    # precomputed indices, indices computed per slab, serial and threaded gathering
+    for (max_bytes, workers) in ((projection.GRID_BYTES, 1), (0, 1), (projection.GRID_BYTES, 3), (0, 3)):
+        grid = projection.RotationGrid(shape, *angles, max_bytes=max_bytes, slab_planes=3, workers=workers)
+        (result, missing) = grid.rotate([volume, None])
+        assert missing is None
+        assert result.shape == expected.shape
+        assert np.array_equal(result, expected)
+
+
+def test_grid_rotates_labels_and_image_together():
+    shape = (6, 9, 8)
+    labels = random_volume(shape, seed=1) % 5
+    image = random_volume(shape, (2,), seed=2)
+    angles = RANDOM_ANGLES[0]
+    grid = projection.RotationGrid(shape, *angles, workers=2)
+    (rlabels, rimage) = grid.rotate([labels, image])
+    assert np.array_equal(rlabels, rotated(labels, angles))
+    assert np.array_equal(rimage, rotated(image, angles))
+
+
+def blob_labels(shape, nlabels, seed=0):
+    "Label volume of random boxes, so labels have interiors and outlines."
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in range(1, nlabels + 1):
+        start = [rng.integers(0, n - 1) for n in shape]
+        end = [rng.integers(s + 1, min(n, s + 5) + 1) for (s, n) in zip(start, shape)]
+        labels[tuple(slice(s, e) for (s, e) in zip(start, end))] = label
+    return labels
+
+
+@pytest.mark.parametrize("angles", RANDOM_ANGLES + QUARTER_ANGLES)
+@pytest.mark.parametrize("use_boxes", [False, True])
+def test_project_outlines_matches_project_volumes(angles, use_boxes):
+    labels = blob_labels((9, 14, 12), 12)
+    image = random_volume(labels.shape, seed=3)
+    selected = [3, 7, 1, 12]
+    projected = projection.project_volumes(labels, image, *angles, selected_labels=selected)
+    boxes = label_index.label_boxes(labels) if use_boxes else None
+    bits = projection.project_outlines(
+        labels, *angles, selected, projected.crop, projected.maxlabel, boxes)
+    assert bits.labels == projected.label_bits.labels
+    assert np.array_equal(bits.bits, projected.label_bits.bits)
+    shape = projected.labels2d.shape
+    assert np.array_equal(bits.boundaries(shape), projected.label_bits.boundaries(shape))
@@ -0,0 +1,95 @@
+"""
+Size and entry limits of the least recently used caches, and shared loads of the volume cache.
+"""
+
+import threading
+import numpy as np
+import pytest
+from lineage_viewer import volume_cache
+
+
+def test_byte_limit_evicts_least_recently_used():
+    cache = volume_cache.ByteLimitedLRU(250)
+    for key in "abc":
+        cache.put(key, np.zeros((100,), dtype=np.uint8))
+    assert cache.keys() == ["b", "c"]
+    cache.get("b")
+    cache.put("d", np.zeros((100,), dtype=np.uint8))
+    assert cache.keys() == ["b", "d"]
+
+
+def test_entry_limit_evicts_values_without_bytes():
+    cache = volume_cache.ByteLimitedLRU(2 ** 20, max_entries=3)
+    for key in range(10):
+        cache.put(key, object())
+    assert cache.total_bytes == 0
+    assert cache.keys() == [7, 8, 9]
+
+
+class BlockingLoader:
+
+    "Loader which counts its calls and waits for release before returning."
+
+    def __init__(self, value="volume"):
+        self.value = value
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, ordinal):
+        self.calls.append(ordinal)
+        self.started.set()
+        assert self.release.wait(10)
+        return self.value
+
+
+def test_get_waits_for_prefetch():
+    cache = volume_cache.VolumeCache(workers=1)
+    loader = BlockingLoader()
+    cache.prefetch("labels", 3, loader)
+    assert loader.started.wait(10)
+    loader.release.set()
+    assert cache.get("labels", 3, loader) == "volume"
+    assert loader.calls == [3]
+
+
+def test_prefetch_waits_for_get():
+    cache = volume_cache.VolumeCache(workers=1)
+    loader = BlockingLoader()
+    results = []
+    reader = threading.Thread(target=lambda: results.append(cache.get("labels", 3, loader)))
+    reader.start()
+    assert loader.started.wait(10)
+    future = cache.prefetch("labels", 3, loader)
+    assert future is cache.pending[("labels", 3)]
+    loader.release.set()
+    reader.join(10)
+    assert future.result(10) == "volume"
+    assert results == ["volume"]
+    assert loader.calls == [3]
+    assert cache.pending == {}
+
+
+def test_discard_drops_loads_in_progress():
+    cache = volume_cache.VolumeCache(workers=1)
+    old_loader = BlockingLoader("old")
+    future = cache.prefetch("labels", 3, old_loader)
+    assert old_loader.started.wait(10)
+    cache.discard()
+    old_loader.release.set()
+    assert future.result(10) == "old"
+    assert ("labels", 3) not in cache.lru
+    new_loader = BlockingLoader("new")
+    new_loader.release.set()
+    assert cache.get("labels", 3, new_loader) == "new"
+    assert new_loader.calls == [3]
+
+
+def test_failed_load_is_not_pending():
+    cache = volume_cache.VolumeCache(workers=1)
+    def failing(ordinal):
+        raise IOError("no volume %s" % ordinal)
+    with pytest.raises(IOError):
+        cache.get("labels", 3, failing)
+    assert cache.pending == {}
+    assert cache.get("labels", 3, lambda ordinal: "volume") == "volume"
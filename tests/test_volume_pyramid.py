@@ -0,0 +1,23 @@
+"""
+Coarse volume levels and their size accounting.
+"""
+
+import numpy as np
+from lineage_viewer import volume_pyramid
+
+
+def test_pyramid_holds_only_coarse_levels():
+    labels = np.arange(16 * 16 * 16, dtype=np.int32).reshape((16, 16, 16)) % 7
+    image = np.random.RandomState(0).randint(0, 255, size=(16, 16, 16)).astype(np.uint8)
+    pyramid = volume_pyramid.VolumePyramid(labels, image, (1, 2, 4, 8))
+    assert pyramid.level(8) == 1
+    pyramid.build_in_background().result()
+    assert sorted(pyramid.levels) == [2, 4, 8]
+    assert pyramid.source is None
+    assert pyramid.level(8) == 8
+    assert pyramid.level(6) == 2
+    held = sum(array.nbytes for level in pyramid.levels.values() for array in level)
+    assert pyramid.nbytes == held
+    (level_labels, level_image) = pyramid.volumes(2)
+    assert level_labels.shape == labels[::2, ::2, ::2].shape
+    assert level_image.shape == image[::2, ::2, ::2].shape